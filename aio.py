@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Асинхронный API поверх parser.py для встраивания в asyncio-сервисы.
+
+	async with AsyncParser(max_documents=8, timeouts=StageTimeouts(section=120, document=900)) as p:
+		header, section = await p.parse_pdf("doc.pdf")
+		async for event in p.stream_sections("doc.pdf"):
+			...  # DocumentStart, затем готовые разделы верхнего уровня
+
+Для простых случаев есть модульные parse_pdf/stream_sections на общем экземпляре.
+
+Конвертация marker идёт в пуле потоков (или в переданном executor — например, пуле
+процессов), всё, что трогает llama.cpp, — в одном выделенном потоке: контекст модели один
+на процесс, а guidance держит состояние ролей глобально. Документы в полёте чередуются на
+модели по границам стадий (разделы верхнего уровня), так что длинный документ не
+задерживает остальные целиком; одновременно в работе не больше max_documents документов.
+Отмена и таймауты срабатывают для вызывающего кода сразу, а сам разбор останавливается на
+ближайшей проверке перед вызовом модели (идущая генерация llama.cpp не прерывается).
+"""
+
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional, Tuple, Union
+
+import parser as caterpillar
+
+
+@dataclass
+class StageTimeouts:
+	"""Таймауты стадий в секундах; None — без ограничения."""
+	convert: Optional[float] = None  # marker
+	prologue: Optional[float] = None  # классификация, метаданные и корень первого чанка
+	section: Optional[float] = None  # каждый раздел верхнего уровня
+	document: Optional[float] = None  # весь документ, включая ожидание слота
+
+class StageTimeout(asyncio.TimeoutError):
+	def __init__(self, stage: str, seconds: Optional[float]):
+		super().__init__(f"stage {stage!r} timed out after {seconds:.1f}s" if seconds is not None else f"stage {stage!r} timed out")
+		self.stage = stage
+		self.seconds = seconds
+
+class AsyncParser:
+	def __init__(
+		self,
+		*,
+		max_documents: int = 4,
+		convert_workers: int = 2,
+		workers: int = 1,
+		convert_executor: Optional[Executor] = None,
+		timeouts: Optional[StageTimeouts] = None,
+	):
+		"""
+		max_documents — сколько документов одновременно в работе, остальные ждут слота.
+		workers > 1 — подразделы разбираются пулом процессов с моделью (см. parser.SectionWorkers);
+		ярус контекста со своим числом процессов (ContextTier.workers) его переопределяет.
+		convert_executor — свой executor для marker; должен принимать parser.convert_pdf.
+		"""
+		self.workers = workers
+		self.timeouts = timeouts or StageTimeouts()
+		self._slots = asyncio.Semaphore(max_documents)
+		self._llm = ThreadPoolExecutor(1, thread_name_prefix="caterpillar-llm")
+		self._own_convert = convert_executor is None
+		self._convert = convert_executor or ThreadPoolExecutor(convert_workers, thread_name_prefix="caterpillar-marker")
+
+	async def __aenter__(self) -> "AsyncParser":
+		return self
+
+	async def __aexit__(self, *exc) -> None:
+		self.close()
+
+	def close(self) -> None:
+		self._llm.shutdown(wait=False, cancel_futures=True)
+		if self._own_convert:
+			self._convert.shutdown(wait=False, cancel_futures=True)
+
+	async def warmup(self) -> None:
+		"""Загружает модели в потоке модели, не блокируя цикл событий."""
+		await asyncio.get_running_loop().run_in_executor(self._llm, caterpillar.warmup)
+
+	async def _stage(self, stage: str, timeout: Optional[float], deadline: Optional[float], aw):
+		# Берём меньший из таймаута стадии и остатка таймаута документа
+		if deadline is not None:
+			left = max(deadline - asyncio.get_running_loop().time(), 0.0)
+			if timeout is None or left < timeout:
+				stage, timeout = "document", left
+		try:
+			return await asyncio.wait_for(aw, timeout)
+		except asyncio.TimeoutError:
+			raise StageTimeout(stage, timeout) from None
+
+	def _deadline(self, timeouts: StageTimeouts) -> Optional[float]:
+		if timeouts.document is None:
+			return None
+		return asyncio.get_running_loop().time() + timeouts.document
+
+	async def convert(self, path: str, *, timeouts: Optional[StageTimeouts] = None, _deadline: Optional[float] = None) -> str:
+		t = timeouts or self.timeouts
+		loop = asyncio.get_running_loop()
+		if self._own_convert:
+			# Свой пул потоков: контекст (профиль документа) переносим в поток marker
+			call = loop.run_in_executor(self._convert, contextvars.copy_context().run, caterpillar.convert_pdf, path)
+		else:
+			call = loop.run_in_executor(self._convert, caterpillar.convert_pdf, path)
+		html, _ = await self._stage("convert", t.convert, _deadline, call)
+		return html
+
+	def _run_llm(self, ctx: contextvars.Context, fn: Callable, *args) -> asyncio.Future:
+		return asyncio.get_running_loop().run_in_executor(self._llm, ctx.run, fn, *args)
+
+	def _start(self, html: str):
+		html, tables = caterpillar.split_tables(html)
+		return html, self._document(html, tables)
+
+	def _document(self, html: str, tables):
+		# Ярус занят, пока генератор не закрыт: чередующиеся документы других ярусов его не выгрузят
+		tok = caterpillar.get_tokenizer()
+		with caterpillar.tier_models(caterpillar.context_tier(tok, html), self.workers) as (lm, pool):
+			yield from caterpillar.iter_document(lm, tok, html, workers=pool, tables=tables)
+
+	async def _events(
+		self,
+		path: str,
+		timeouts: Optional[StageTimeouts],
+		on_html: Optional[Callable[[str], None]] = None,
+	) -> AsyncIterator[Union["caterpillar.DocumentStart", "caterpillar.Section"]]:
+		t = timeouts or self.timeouts
+		deadline = self._deadline(t)
+		await self._stage("queue", None, deadline, self._slots.acquire())
+		cancel = threading.Event()
+		ctx = contextvars.copy_context()
+		ctx.run(caterpillar.set_cancel_event, cancel)
+		events = None
+		try:
+			html = await self.convert(path, timeouts=t, _deadline=deadline)
+			html, events = await self._stage("prologue", t.prologue, deadline, self._run_llm(ctx, self._start, html))
+			if on_html is not None:
+				on_html(html)
+			stage, timeout = "prologue", t.prologue
+			while True:
+				event = await self._stage(stage, timeout, deadline, self._run_llm(ctx, next, events, None))
+				if event is None:
+					return
+				yield event
+				stage, timeout = "section", t.section
+		finally:
+			# Останавливаем разбор на ближайшей проверке; генератор закрывается в потоке модели после текущего шага
+			cancel.set()
+			if events is not None:
+				try:
+					self._llm.submit(ctx.run, events.close)
+				except RuntimeError:
+					pass  # executor уже остановлен close()
+			self._slots.release()
+
+	def stream_sections(
+		self,
+		path: str,
+		*,
+		timeouts: Optional[StageTimeouts] = None,
+	) -> AsyncIterator[Union["caterpillar.DocumentStart", "caterpillar.Section"]]:
+		"""DocumentStart, затем готовые разделы верхнего уровня — как parser.iter_document."""
+		return self._events(path, timeouts)
+
+	async def parse_pdf(
+		self,
+		path: str,
+		*,
+		previous: Optional["caterpillar.DocumentTree"] = None,
+		timeouts: Optional[StageTimeouts] = None,
+	) -> Tuple["caterpillar.Header", "caterpillar.Section"]:
+		"""
+		Дерево документа целиком. С previous — инкрементальный разбор новой редакции
+		(parser.reparse_document); он идёт одним шагом модели под таймаутом документа.
+		"""
+		if previous is not None:
+			return await self._reparse(path, previous, timeouts or self.timeouts)
+		parsed = []
+		start, children = None, []
+		async for event in self._events(path, timeouts, parsed.append):
+			if start is None:
+				start = event
+			else:
+				children.append(event)
+		return start.header, caterpillar.document_root(start, children, parsed[0])
+
+	async def _reparse(self, path: str, previous: "caterpillar.DocumentTree", t: StageTimeouts):
+		deadline = self._deadline(t)
+		await self._stage("queue", None, deadline, self._slots.acquire())
+		cancel = threading.Event()
+		ctx = contextvars.copy_context()
+		ctx.run(caterpillar.set_cancel_event, cancel)
+		try:
+			html = await self.convert(path, timeouts=t, _deadline=deadline)
+
+			def run():
+				tok = caterpillar.get_tokenizer()
+				with caterpillar.tier_models(caterpillar.context_tier(tok, html), self.workers) as (lm, pool):
+					return caterpillar.reparse_document(lm, tok, previous, html, workers=pool)
+
+			return await self._stage("document", None, deadline, self._run_llm(ctx, run))
+		finally:
+			cancel.set()
+			self._slots.release()
+
+_DEFAULT: Optional[AsyncParser] = None
+
+def default_parser() -> AsyncParser:
+	"""Общий экземпляр с настройками по умолчанию для модульных parse_pdf/stream_sections."""
+	global _DEFAULT
+	if _DEFAULT is None:
+		_DEFAULT = AsyncParser()
+	return _DEFAULT
+
+async def parse_pdf(path: str, **kwargs) -> Tuple["caterpillar.Header", "caterpillar.Section"]:
+	return await default_parser().parse_pdf(path, **kwargs)
+
+def stream_sections(path: str, **kwargs) -> AsyncIterator[Union["caterpillar.DocumentStart", "caterpillar.Section"]]:
+	return default_parser().stream_sections(path, **kwargs)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Пакетный разбор каталога PDF или JSONL-манифеста с конвейером стадий.
+
+	python batch.py test_files/ --out out/
+	python batch.py manifest.jsonl --out out/ --convert-workers 4
+
+Строка манифеста: {"path": "doc.pdf", "out": "doc.xml"} ("out" необязателен).
+
+Стадии связаны ограниченными очередями:
+	marker  — пул процессов, каждый со своим PdfConverter; в полёте не больше --prefetch документов;
+	llm     — резидентная модель в основном процессе; из готовых документов сначала идут документы
+	          яруса контекста, загруженного сейчас, так что модель меняется только когда они кончились;
+	write   — отдельный поток пишет XML на диск.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import parser as caterpillar
+from xml_writer import render_document
+
+
+@dataclass
+class StageStats:
+	docs: int = 0
+	busy_seconds: float = 0.0
+	errors: int = 0
+
+	def add(self, seconds: float) -> None:
+		self.docs += 1
+		self.busy_seconds += seconds
+
+	def docs_per_sec(self) -> float:
+		return self.docs / self.busy_seconds if self.busy_seconds else 0.0
+
+@dataclass
+class BatchReport:
+	stages: Dict[str, StageStats] = field(default_factory=lambda: {s: StageStats() for s in ("marker", "llm", "write")})
+	wall_seconds: float = 0.0
+	failed: List[Tuple[str, str]] = field(default_factory=list)
+
+	def as_dict(self) -> dict:
+		done = self.stages["write"].docs
+		return {
+			"docs": done,
+			"wall_seconds": self.wall_seconds,
+			"docs_per_sec": done / self.wall_seconds if self.wall_seconds else 0.0,
+			"stages": {
+				name: {"docs": s.docs, "busy_seconds": s.busy_seconds, "docs_per_sec": s.docs_per_sec(), "errors": s.errors}
+				for name, s in self.stages.items()
+			},
+			"failed": [{"path": p, "error": e} for p, e in self.failed],
+		}
+
+def iter_inputs(source: str, out_dir: str) -> Iterator[Tuple[str, str]]:
+	"""Пары (pdf, xml) из каталога или JSONL-манифеста."""
+	def default_out(path: str) -> str:
+		return os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".xml")
+
+	if os.path.isdir(source):
+		for name in sorted(os.listdir(source)):
+			if name.lower().endswith(".pdf"):
+				path = os.path.join(source, name)
+				yield path, default_out(path)
+		return
+	with open(source, "r", encoding="utf-8") as f:
+		for line in f:
+			if not line.strip():
+				continue
+			item = json.loads(line)
+			yield item["path"], item.get("out") or default_out(item["path"])
+
+def _convert(path: str) -> Tuple[str, float]:
+	t0 = time.perf_counter()
+	html, _ = caterpillar.convert_pdf(path)
+	return html, time.perf_counter() - t0
+
+def _writer(jobs: "queue.Queue[Optional[Tuple[str, str, str]]]", report: BatchReport) -> None:
+	# Ошибка записи — ошибка одного документа: поток продолжает разбирать очередь, иначе run_batch повиснет на put
+	while True:
+		item = jobs.get()
+		if item is None:
+			return
+		path, out, xml = item
+		t0 = time.perf_counter()
+		try:
+			os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+			with open(out, "w", encoding="utf-8") as f:
+				f.write(xml)
+		except Exception as e:
+			report.stages["write"].errors += 1
+			report.failed.append((path, f"{type(e).__name__}: {e}"))
+			continue
+		report.stages["write"].add(time.perf_counter() - t0)
+
+def _parse(tok, tier: "caterpillar.ContextTier", html: str, section_workers: int):
+	# Ссылки на модель яруса живут только в этом кадре: при смене яруса прежняя выгружается целиком
+	with caterpillar.tier_models(tier, section_workers) as (lm, pool):
+		return caterpillar.process_document(lm, tok, html, workers=pool)
+
+def run_batch(
+	inputs: Iterator[Tuple[str, str]],
+	*,
+	convert_workers: int = 2,
+	prefetch: int = 4,
+	write_queue: int = 16,
+	section_workers: int = 1,
+) -> BatchReport:
+	report = BatchReport()
+	t_start = time.perf_counter()
+
+	tok = caterpillar.get_tokenizer()
+
+	to_write: "queue.Queue[Optional[Tuple[str, str, str]]]" = queue.Queue(maxsize=write_queue)
+	writer = threading.Thread(target=_writer, args=(to_write, report), name="xml-writer", daemon=True)
+	writer.start()
+
+	inputs = iter(inputs)
+	in_flight: Dict = {}
+	# Сконвертированные документы по ярусам контекста: (pdf, xml, html)
+	ready: Dict["caterpillar.ContextTier", List[Tuple[str, str, str]]] = {}
+	tier = None
+	with ProcessPoolExecutor(
+		max_workers=convert_workers,
+		mp_context=multiprocessing.get_context("spawn"),
+		initializer=caterpillar.configure_cache,
+		initargs=caterpillar.cache_args(),
+	) as marker:
+		def refill() -> None:
+			# Держим marker на шаг впереди модели, но не больше prefetch документов в памяти
+			while len(in_flight) + sum(map(len, ready.values())) < prefetch:
+				item = next(inputs, None)
+				if item is None:
+					return
+				in_flight[marker.submit(_convert, item[0])] = item
+
+		refill()
+		while in_flight or ready:
+			# Забираем всё, что уже сконвертировано; ждём marker, только если разбирать нечего
+			done, _ = wait(in_flight, timeout=0 if ready else None, return_when=FIRST_COMPLETED)
+			for fut in done:
+				path, out = in_flight.pop(fut)
+				try:
+					html, seconds = fut.result()
+				except Exception as e:
+					report.stages["marker"].errors += 1
+					report.failed.append((path, f"{type(e).__name__}: {e}"))
+					continue
+				report.stages["marker"].add(seconds)
+				try:
+					doc_tier = caterpillar.context_tier(tok, html)
+				except Exception as e:
+					report.stages["llm"].errors += 1
+					report.failed.append((path, f"{type(e).__name__}: {e}"))
+					continue
+				ready.setdefault(doc_tier, []).append((path, out, html))
+			if not ready:
+				refill()
+				continue
+
+			# Документы загруженного яруса подряд; иначе — ярус, где готовых больше всего
+			if tier not in ready:
+				tier = max(ready, key=lambda t: len(ready[t]))
+			path, out, html = ready[tier].pop(0)
+			if not ready[tier]:
+				del ready[tier]
+			refill()
+
+			t0 = time.perf_counter()
+			try:
+				header, section = _parse(tok, tier, html, section_workers)
+			except Exception as e:
+				report.stages["llm"].errors += 1
+				report.failed.append((path, f"{type(e).__name__}: {e}"))
+				continue
+			report.stages["llm"].add(time.perf_counter() - t0)
+			to_write.put((path, out, render_document(header, section)))
+
+	to_write.put(None)
+	writer.join()
+	report.wall_seconds = time.perf_counter() - t_start
+	return report
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("source", help="каталог с PDF или JSONL-манифест")
+	ap.add_argument("--out", default="out", help="каталог для XML, если в манифесте не указан out")
+	ap.add_argument("--convert-workers", type=int, default=2, help="процессов marker")
+	ap.add_argument("--prefetch", type=int, default=4, help="документов, сконвертированных впрок; среди них документы группируются по ярусу контекста")
+	ap.add_argument("--write-queue", type=int, default=16)
+	ap.add_argument("--workers", type=int, default=1, help="процессов с моделью для параллельного разбора подразделов")
+	ap.add_argument("--cache-dir", help="дисковый кэш результатов marker и LLM-стадий")
+	ap.add_argument("--cache-max-bytes", type=int, default=caterpillar.DEFAULT_MAX_BYTES)
+	args = ap.parse_args()
+	caterpillar.configure_cache(args.cache_dir, args.cache_max_bytes)
+
+	report = run_batch(
+		iter_inputs(args.source, args.out),
+		convert_workers=args.convert_workers,
+		prefetch=args.prefetch,
+		write_queue=args.write_queue,
+		section_workers=args.workers,
+	)
+	print(json.dumps(report.as_dict(), indent=2, ensure_ascii=False))
+	sys.exit(1 if report.failed else 0)
+
+if __name__ == "__main__":
+	main()
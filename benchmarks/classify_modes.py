@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Точность и задержка классификации: по генерации на уровень против одного прохода по префиксному дереву.
+
+	python -m benchmarks.classify_modes [--labels labels.json] [--top-k 3] [test_files/*.pdf]
+
+labels.json — {"путь к pdf": "level1/level2/..."}; без разметки точность считается
+относительно режима levels (совпадение пути и общая глубина совпавшего префикса).
+"""
+
+import argparse
+import glob
+import json
+import time
+
+import parser as caterpillar
+
+
+def _common_depth(a, b) -> int:
+	n = 0
+	for x, y in zip(a, b):
+		if x != y:
+			break
+		n += 1
+	return n
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("pdfs", nargs="*", default=sorted(glob.glob("test_files/*.pdf")))
+	ap.add_argument("--labels")
+	ap.add_argument("--top-k", type=int, default=1)
+	args = ap.parse_args()
+
+	labels = {}
+	if args.labels:
+		with open(args.labels, "r", encoding="utf-8") as f:
+			labels = {k: v.split("/") for k, v in json.load(f).items()}
+
+	lm = caterpillar.get_lm()
+	rows = []
+	for pdf in args.pdfs:
+		html = caterpillar.get_converter()(pdf).html
+		t0 = time.perf_counter()
+		levels = caterpillar.classify_document(lm, html, mode="levels")
+		t_levels = time.perf_counter() - t0
+		t0 = time.perf_counter()
+		ranked = caterpillar.classify_paths(lm, html, top_k=args.top_k)
+		t_trie = time.perf_counter() - t0
+		trie = ranked[0][0]
+
+		reference = labels.get(pdf, list(levels))
+		row = {
+			"pdf": pdf,
+			"levels": {"path": "/".join(levels), "seconds": t_levels},
+			"trie": {
+				"path": "/".join(trie),
+				"seconds": t_trie,
+				"alternatives": [{"path": "/".join(p), "log_prob": lp} for p, lp in ranked],
+			},
+			"reference": "/".join(reference),
+			"exact": {"levels": list(levels) == reference, "trie": trie == reference},
+			"common_depth": {"levels": _common_depth(levels, reference), "trie": _common_depth(trie, reference)},
+		}
+		print(f"{pdf}: levels {t_levels:.1f}s {row['levels']['path']!r} | trie {t_trie:.1f}s {row['trie']['path']!r}")
+		rows.append(row)
+
+	n = max(len(rows), 1)
+	summary = {
+		mode: {
+			"exact_match": sum(r["exact"][mode] for r in rows) / n,
+			"mean_seconds": sum(r[mode]["seconds"] for r in rows) / n,
+		}
+		for mode in ("levels", "trie")
+	}
+	summary["reference"] = "labels" if labels else "levels"
+	print(json.dumps({"summary": summary, "documents": rows}, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
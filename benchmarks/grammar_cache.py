@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Накладные расходы на построение JSON-грамматики в одном вызове стадии: с кэшем и без.
+
+	python -m benchmarks.grammar_cache [--calls 200] [--tools 8]
+
+Модель не нужна: меряется только то, что раньше делал каждый вызов до генерации, —
+gjson(schema=Header), gjson(schema=ExtractResult) и union-схема Tools.tool_call
+(create_model + TypeAdapter по всем инструментам), против chat_template.json_grammar
+и кэша Tools.
+"""
+
+import argparse
+import json
+import time
+from typing import Callable, Optional
+
+from guidance import json as gjson
+
+import parser as caterpillar
+from chat_template import Tools, clear_grammar_cache, json_grammar
+
+
+def make_tools(n: int) -> Tools:
+	tools = Tools()
+	for i in range(n):
+		def fn(query: str, limit: int = 10, exact: Optional[bool] = None) -> str:
+			return query
+		fn.__name__ = f"tool_{i}"
+		tools._register(fn, description=f"Test tool {i}")
+	return tools
+
+def per_call_us(fn: Callable[[], object], calls: int) -> float:
+	fn()  # первый вызов (импорты, прогрев pydantic) не считаем
+	t0 = time.perf_counter()
+	for _ in range(calls):
+		fn()
+	return (time.perf_counter() - t0) / calls * 1e6
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--calls", type=int, default=200)
+	ap.add_argument("--tools", type=int, default=8, help="инструментов в union-схеме")
+	args = ap.parse_args()
+
+	tools = make_tools(args.tools)
+	cases = {
+		"metainfo": (
+			lambda: gjson(name="header", schema=caterpillar.Header, max_tokens=1024),
+			lambda: json_grammar("header", caterpillar.Header, max_tokens=1024),
+		),
+		"sections": (
+			lambda: gjson(name="section", schema=caterpillar.ExtractResult, max_tokens=2048),
+			lambda: json_grammar("section", caterpillar.ExtractResult, max_tokens=2048),
+		),
+		"tool_call": (
+			lambda: gjson(name="call", schema=tools._build_union()),
+			lambda: tools._tool_call_grammar("call"),
+		),
+	}
+
+	clear_grammar_cache()
+	report = {}
+	for name, (uncached, cached) in cases.items():
+		before, after = per_call_us(uncached, args.calls), per_call_us(cached, args.calls)
+		report[name] = {"uncached_us": before, "cached_us": after, "saved_us": before - after}
+		print(f"{name:10s} {before:10.1f} us -> {after:8.2f} us per call")
+	print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
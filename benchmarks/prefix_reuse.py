@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Префилл и время classify_document: нынешний промпт против промпта до общего префикса.
+
+	python -m benchmarks.prefix_reuse [test_files/*.pdf]
+
+Для каждого PDF классификация прогоняется в трёх вариантах, каждый с пустого кэша движка:
+	baseline      — раскладка промпта до PrefixCache: документ внутри system-инструкции
+	                классификатора, на каждом уровне новый user-ход (движок llama.cpp при этом
+	                сам переиспользует общий с прошлым вызовом префикс токенов);
+	shared_prefix — нынешний classify_document: нейтральный system + документ, общий со
+	                стадиями метаданных и разделов, инструкции — после документа;
+	no_reuse      — нынешний промпт со сбросом кэша перед каждым уровнем: верхняя граница
+	                префилла, а не исходное поведение.
+speedup и prefill_ratio считаются относительно baseline.
+"""
+
+import argparse
+import glob
+import json
+import textwrap
+import time
+
+from guidance import assistant, system, user
+
+import parser as caterpillar
+from kvcache import PrefixCache, reset_cache
+
+
+def baseline_classify(lm, html: str, prefix: PrefixCache) -> list:
+	"""classify_document в раскладке до общего префикса; рассуждение — по той же политике стадии."""
+	llm = lm
+	with system():
+		llm += textwrap.dedent(f'''
+			You are a document classifier. Check the following document against the given category.
+			Use 'other' only if the document doesn't fit any existing category.
+
+			Document MetaInfo:
+
+			Document:
+
+			```
+				{html}
+			```
+		''')
+
+	suffix = ["."]
+	node = caterpillar.get_classifier()
+	while node.children:
+		variants, category = node.options(suffix)
+		with prefix.branch():
+			tlm = llm
+			with user():
+				tlm += "Choose the most appropriate category: " + '\n'.join(variants) + '\n\n'
+				tlm += "Category: "
+			with assistant():
+				tlm = caterpillar._think("classify", tlm, html)
+				tlm += category
+		choice = variants.index(tlm['category'])
+		if choice == len(variants) - 1:
+			break
+		node = list(node.children.values())[choice]
+		suffix.append(node.value)
+	return suffix[1:]
+
+def measure(lm, html: str, variant: str) -> dict:
+	# Каждый вариант начинает с пустого кэша движка: префилл документа на первом уровне платят все
+	reset_cache(lm)
+	prefix = PrefixCache(lm, reuse=variant != "no_reuse")
+	t0 = time.perf_counter()
+	if variant == "baseline":
+		path = baseline_classify(lm, html, prefix)
+	else:
+		path = caterpillar.classify_document(lm, html, prefix=prefix, mode="levels")
+	return {
+		"seconds": time.perf_counter() - t0,
+		"levels": prefix.stats.branches,
+		"tokens_evaluated": prefix.stats.tokens_evaluated,
+		"tokens_reused": prefix.stats.tokens_reused,
+		"class": "/".join(path),
+	}
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("pdfs", nargs="*", default=sorted(glob.glob("test_files/*.pdf")))
+	args = ap.parse_args()
+
+	lm = caterpillar.get_lm()
+	tok = caterpillar.get_tokenizer()
+	report = []
+	for pdf in args.pdfs:
+		html = caterpillar.get_converter()(pdf).html
+		row = {
+			"pdf": pdf,
+			"document_tokens": len(tok.tokenize(html.encode("utf-8"), add_bos=False, special=True)),
+		}
+		for variant in ("baseline", "shared_prefix", "no_reuse"):
+			row[variant] = measure(lm, html, variant)
+		base, warm = row["baseline"], row["shared_prefix"]
+		row["prefill_ratio"] = base["tokens_evaluated"] / max(warm["tokens_evaluated"], 1)
+		row["speedup"] = base["seconds"] / max(warm["seconds"], 1e-9)
+		print(f"{pdf}: {row['document_tokens']} tok, {warm['levels']} levels, "
+			f"evaluated {base['tokens_evaluated']} -> {warm['tokens_evaluated']} "
+			f"({row['prefill_ratio']:.1f}x), {base['seconds']:.1f}s -> {warm['seconds']:.1f}s, "
+			f"no reuse {row['no_reuse']['tokens_evaluated']} tok")
+		report.append(row)
+	print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
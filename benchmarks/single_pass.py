@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Время до первого токена и объём префилла для трёх стадий документа (классификация,
+метаданные, разбор корня) при общем префиксе с документом и без него.
+
+	python -m benchmarks.single_pass [test_files/*.pdf]
+
+"before" — каждая стадия считает system + документ заново (PrefixCache(reuse=False)),
+"after" — стадии ветвятся от одного document_context, как в process_chunk.
+Каждый прогон начинается с пустого кэша движка; варианты чередуются (--repeats раз, чётные
+повторы — в обратном порядке), в отчёте медиана времени по повторам.
+"""
+
+import argparse
+import glob
+import json
+import statistics
+import time
+
+from guidance import assistant, gen
+
+import parser as caterpillar
+from kvcache import PrefixCache, reset_cache
+
+
+def stage_prompts(context, html: str, title: str):
+	variants = ['./' + v for v in caterpillar.get_classifier().get_next_variants(["."])] + ['other']
+	root = caterpillar.SectionPtr(heading=title, raw_html=html, base_level=1)
+	return [
+		("classify", caterpillar.classify_prompt(context, variants)),
+		("metainfo", caterpillar.metainfo_prompt(context, [])),
+		("sections", caterpillar.sections_prompt(context, root)),
+	]
+
+def measure(lm, html: str, *, reuse: bool) -> dict:
+	# Иначе второй вариант получал бы документ в KV от первого
+	reset_cache(lm)
+	prefix = PrefixCache(lm, reuse=reuse)
+	context = caterpillar.document_context(lm, html)
+	ttft = {}
+	for stage, prompt in stage_prompts(context, html, title=""):
+		t0 = time.perf_counter()
+		with prefix.branch():
+			with assistant():
+				prompt += gen("probe", max_tokens=1)
+		ttft[stage] = time.perf_counter() - t0
+	return {
+		"ttft_seconds": ttft,
+		# один сгенерированный токен на стадию в префилл не входит
+		"prefill_tokens": prefix.stats.tokens_evaluated - prefix.stats.branches,
+	}
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("pdfs", nargs="*", default=sorted(glob.glob("test_files/*.pdf")))
+	ap.add_argument("--repeats", type=int, default=2, help="прогонов каждого варианта, порядок чередуется")
+	args = ap.parse_args()
+
+	lm = caterpillar.get_lm()
+	report = []
+	for pdf in args.pdfs:
+		html = caterpillar.get_converter()(pdf).html
+		runs = {"before": [], "after": []}
+		for r in range(max(args.repeats, 1)):
+			order = ("before", "after") if r % 2 == 0 else ("after", "before")
+			for variant in order:
+				runs[variant].append(measure(lm, html, reuse=variant == "after"))
+		row = {"pdf": pdf}
+		for variant, results in runs.items():
+			row[variant] = {
+				"ttft_seconds": {k: statistics.median(m["ttft_seconds"][k] for m in results) for k in results[0]["ttft_seconds"]},
+				"prefill_tokens": results[-1]["prefill_tokens"],
+				"runs": len(results),
+			}
+		b, a = row["before"], row["after"]
+		print(f"{pdf}: prefill {b['prefill_tokens']} -> {a['prefill_tokens']} tok; " + ", ".join(
+			f"{k} ttft {b['ttft_seconds'][k]:.2f}s -> {a['ttft_seconds'][k]:.2f}s" for k in b["ttft_seconds"]))
+		report.append(row)
+	print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
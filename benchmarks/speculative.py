@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Скорость генерации extract_sections со спекулятивным декодированием и без него.
+
+	python -m benchmarks.speculative [test_files/*.pdf] [--draft-model models/Qwen3-0.6B.gguf]
+	python -m benchmarks.speculative --html-dir html/ --draft-tokens 12
+
+Для каждого документа корень первого чанка разбирается один раз для прогрева (в KV остаётся
+промпт, так что дальше меряется в основном генерация), затем по разу в каждом режиме:
+off, lookup и, если задана, черновая модель. Модель одна, режимы включаются на её движке.
+tokens/sec — сгенерированные токены (с рассуждениями) на секунду стадии; same_output —
+совпал ли ответ с режимом off.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import parser as caterpillar
+import profiling
+import speculative
+from benchmarks.suite import load_html
+
+
+def run_stage(lm, ptr) -> dict:
+	with profiling.profile() as prof:
+		result = caterpillar.extract_sections(lm, ptr, depth=0)
+	row = prof.summary()["sections@0"]
+	return {
+		"seconds": row["seconds"],
+		"generated_tokens": row["generated_tokens"],
+		"tokens_per_sec": row["tokens_per_sec"],
+		"output": result.model_dump_json(),
+	}
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("pdfs", nargs="*", default=sorted(glob.glob("test_files/*.pdf")))
+	ap.add_argument("--html-dir", help="готовый HTML <имя pdf>.html вместо конвертации marker")
+	ap.add_argument("--draft-model", help="черновая GGUF-модель с тем же словарём")
+	ap.add_argument("--draft-tokens", type=int, default=8)
+	args = ap.parse_args()
+
+	lm = caterpillar.get_lm()
+	tok = caterpillar.get_tokenizer()
+	modes = {"lookup": lambda: speculative.PromptLookupDrafter(num_pred_tokens=args.draft_tokens)}
+	if args.draft_model:
+		modes["draft"] = lambda: speculative.DraftModelDrafter(
+			args.draft_model, num_pred_tokens=args.draft_tokens, n_ctx=caterpillar.N_CTX, n_gpu_layers=-1)
+	drafters = {}
+
+	report = []
+	for pdf in args.pdfs:
+		html = load_html(pdf, args.html_dir) if args.html_dir else caterpillar.convert_pdf(pdf)[0]
+		html, _ = caterpillar.split_tables(html)
+		chunk = next(caterpillar.chunk_text(html, tok))
+		ptr = caterpillar.SectionPtr(heading=os.path.basename(pdf), raw_html=chunk, base_level=1)
+
+		run_stage(lm, ptr)  # прогрев: префилл промпта
+		off = run_stage(lm, ptr)
+		row = {"pdf": pdf, "off": {k: v for k, v in off.items() if k != "output"}}
+		for mode, make in modes.items():
+			drafter = drafters.get(mode) or drafters.setdefault(mode, make())
+			spec = speculative.enable(lm, drafter)
+			try:
+				res = run_stage(lm, ptr)
+			finally:
+				speculative.disable(lm)
+			row[mode] = {
+				**{k: v for k, v in res.items() if k != "output"},
+				"speedup": res["tokens_per_sec"] / off["tokens_per_sec"] if off["tokens_per_sec"] else 0.0,
+				"acceptance": spec.stats.acceptance,
+				"same_output": res["output"] == off["output"],
+			}
+		print(f"{os.path.basename(pdf)}: off {off['tokens_per_sec']:.1f} tok/s, "
+			+ ", ".join(f"{m} {row[m]['tokens_per_sec']:.1f} tok/s ({row[m]['acceptance']:.0%} accepted)" for m in modes),
+			file=sys.stderr)
+		report.append(row)
+	print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
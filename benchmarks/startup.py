@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Замер холодного старта parser.py: время и пиковый RSS в отдельном процессе на каждый сценарий.
+
+	python -m benchmarks.startup [--repeat 3] [--skip-eager]
+
+Сценарии:
+	import  — только `import parser` (так теперь платит любой импорт/вызов CLI до первого документа);
+	warmup  — `import parser; parser.warmup()` (всё резидентное загружено один раз);
+	eager   — как было раньше: два PdfConverter + классификатор прямо при импорте.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+_PROBE = """
+import json, resource, time
+t0 = time.perf_counter()
+{body}
+dt = time.perf_counter() - t0
+print(json.dumps({{"seconds": dt, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+SCENARIOS = {
+	"import": "import parser",
+	"warmup": "import parser\nparser.warmup()",
+	"eager": "import parser\nfrom marker.models import create_model_dict\ncreate_model_dict()\ncreate_model_dict()\nparser.Classifier.from_csv(parser.CLASSIFIER_CSV)",
+}
+
+def run_scenario(body: str) -> dict:
+	out = subprocess.run(
+		[sys.executable, "-c", _PROBE.format(body=body)],
+		check=True, capture_output=True, text=True,
+	).stdout
+	return json.loads(out.strip().splitlines()[-1])
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--repeat", type=int, default=3)
+	ap.add_argument("--skip-eager", action="store_true", help="не мерить старое поведение (две загрузки marker)")
+	args = ap.parse_args()
+
+	names = [n for n in SCENARIOS if not (args.skip_eager and n == "eager")]
+	results = {}
+	for name in names:
+		runs = [run_scenario(SCENARIOS[name]) for _ in range(args.repeat)]
+		results[name] = {
+			"seconds_median": statistics.median(r["seconds"] for r in runs),
+			"max_rss_mb": max(r["max_rss_kb"] for r in runs) / 1024,
+		}
+		print(f"{name:8s} {results[name]['seconds_median']:8.2f} s  {results[name]['max_rss_mb']:9.1f} MiB")
+
+	if "eager" in results:
+		saved = results["eager"]["seconds_median"] - results["import"]["seconds_median"]
+		rss = results["eager"]["max_rss_mb"] - results["import"]["max_rss_mb"]
+		print(f"saved on cold start: {saved:.2f} s, {rss:.1f} MiB peak RSS")
+	print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк всего конвейера на test_files/: документы в секунду, перцентили задержек стадий,
+обработанные токены и пиковый RSS, со сравнением с сохранённым базовым прогоном.
+
+	python -m benchmarks.suite                                   # стаб-модель: без GPU и сети
+	python -m benchmarks.suite --model models/small.gguf         # настоящая GGUF-модель
+	python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+	python -m benchmarks.suite --compare benchmarks/baseline.json --tolerance 0.15
+
+Стаб-модель детерминированно заменяет LLM-стадии разбором по заголовкам HTML, а токены
+считает регулярным выражением: так меряется всё, кроме самой модели (таблицы, чанки,
+нарезка разделов, сборка дерева, XML), и результат не зависит от железа под llama.cpp.
+Marker конвертирует каждый PDF один раз (--html-dir — взять готовый HTML и не звать marker,
+--save-html — сохранить его для следующих прогонов), остальные стадии повторяются --repeat раз.
+Времена стадий берутся из profiling; --compare завершается с кодом 1 при регрессии.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import platform
+import re
+import sys
+import time
+from html import escape
+from typing import Dict, List
+
+import parser as caterpillar
+import profiling
+from chunking import heading_level, html_blocks, visible_text
+from xml_writer import render_document
+
+
+class StubTokenizer:
+	"""Токены — слова и знаки препинания: детерминированно и без словаря модели."""
+	_TOKEN_RE = re.compile(rb"\w+|[^\w\s]")
+
+	def tokenize(self, data: bytes, add_bos: bool = False, special: bool = True) -> List[bytes]:
+		return self._TOKEN_RE.findall(data)
+
+@profiling.traced("classify")
+def _stub_classify(lm, html: str, *, context=None, prefix=None, mode=None) -> List[str]:
+	return []
+
+@profiling.traced("metainfo")
+def _stub_metainfo(lm, document_class, html: str, *, context=None, prefix=None) -> "caterpillar.Header":
+	title = next((visible_text(html[b.start:b.end]) for b in html_blocks(html) if b.is_heading), "")
+	return caterpillar.Header(
+		title=title or "untitled", authors=[], date=None, language="und",
+		keywords=[], summary="", document_class=list(document_class),
+	)
+
+@profiling.traced("sections", "depth")
+def _stub_sections(lm, section, *, max_json_tokens: int = 2048, context=None, prefix=None, depth: int = 0):
+	"""Подразделы — заголовки самого высокого уровня после собственного заголовка раздела."""
+	html = section.raw_html
+	blocks = html_blocks(html)
+	first = 1 if blocks and blocks[0].is_heading else 0
+	levels = [heading_level(b) for b in blocks[first:] if b.is_heading]
+	starts = [i for i in range(first, len(blocks)) if blocks[i].is_heading and heading_level(blocks[i]) == min(levels)] if levels else []
+
+	level = section.base_level
+	shell = [f"<section><h{level}>{escape(section.heading)}</h{level}>"]
+	for b in blocks[first:starts[0] if starts else len(blocks)]:
+		fragment = html[b.start:b.end]
+		shell.append(fragment if b.tag == "table" else f"<p>{escape(visible_text(fragment))}</p>")
+	shell.append("</section>")
+	return caterpillar.ExtractResult(
+		heading=section.heading,
+		base_level=level,
+		xml_shell="".join(shell),
+		child_blocks=[caterpillar.ChildBlock(heading=visible_text(html[blocks[i].start:blocks[i].end]), start_block=i) for i in starts],
+	)
+
+def install_stub() -> StubTokenizer:
+	"""Подменяет LLM-стадии parser.py; остальной конвейер остаётся настоящим."""
+	tok = StubTokenizer()
+	caterpillar.document_context = lambda lm, html: None
+	caterpillar.classify_document = _stub_classify
+	caterpillar.extract_metainfo = _stub_metainfo
+	caterpillar.extract_sections = _stub_sections
+	caterpillar.get_tokenizer = lambda model_path=None: tok
+	return tok
+
+def load_html(pdf: str, html_dir: str) -> str:
+	with open(os.path.join(html_dir, os.path.splitext(os.path.basename(pdf))[0] + ".html"), "r", encoding="utf-8") as f:
+		return f.read()
+
+def save_html(pdf: str, html_dir: str, html: str) -> None:
+	os.makedirs(html_dir, exist_ok=True)
+	with open(os.path.join(html_dir, os.path.splitext(os.path.basename(pdf))[0] + ".html"), "w", encoding="utf-8") as f:
+		f.write(html)
+
+def percentile(values: List[float], q: float) -> float:
+	"""Перцентиль по ближайшему рангу (без интерполяции — стабилен на малых выборках)."""
+	ordered = sorted(values)
+	if not ordered:
+		return 0.0
+	return ordered[max(0, min(len(ordered), math.ceil(q / 100 * len(ordered))) - 1)]
+
+def _count_sections(section) -> int:
+	return 1 + sum(_count_sections(c) for c in section.children)
+
+def run(pdfs: List[str], *, lm, tok, repeat: int, html_dir: str = None, save_html_dir: str = None) -> dict:
+	samples: Dict[str, List[float]] = {}
+	tokens = {"input": 0, "prompt": 0, "generated": 0}
+	documents = []
+	wall, runs = 0.0, 0
+
+	def collect(prof: profiling.Profiler) -> None:
+		for span in prof.spans():
+			key = profiling.Span(**span).key
+			samples.setdefault(key, []).append(span["seconds"])
+
+	for pdf in pdfs:
+		if html_dir:
+			html = load_html(pdf, html_dir)
+		else:
+			with profiling.profile(pdf) as prof:
+				html, _ = caterpillar.convert_pdf(pdf)
+			collect(prof)
+			if save_html_dir:
+				save_html(pdf, save_html_dir, html)
+
+		input_tokens = caterpillar.count_tokens(tok, html)
+		doc_seconds = []
+		for _ in range(repeat):
+			with profiling.profile(pdf) as prof:
+				t0 = time.perf_counter()
+				header, section = caterpillar.process_document(lm, tok, html)
+				with profiling.stage("xml"):
+					render_document(header, section)
+				dt = time.perf_counter() - t0
+			collect(prof)
+			summary = prof.summary()
+			tokens["input"] += input_tokens
+			tokens["prompt"] += sum(row["prompt_tokens"] for row in summary.values())
+			tokens["generated"] += sum(row["generated_tokens"] for row in summary.values())
+			doc_seconds.append(dt)
+			samples.setdefault("document", []).append(dt)
+			wall += dt
+			runs += 1
+
+		# Нарезка на чанки внутри process_document не размечена — меряем её отдельно
+		stripped, _ = caterpillar.split_tables(html)
+		t0 = time.perf_counter()
+		chunks = list(caterpillar.chunk_text(stripped, tok))
+		samples.setdefault("chunking", []).append(time.perf_counter() - t0)
+
+		documents.append({
+			"pdf": pdf,
+			"input_tokens": input_tokens,
+			"chunks": len(chunks),
+			"sections": _count_sections(section),
+			"seconds_p50": percentile(doc_seconds, 50),
+		})
+		print(f"{os.path.basename(pdf)}: {input_tokens} tok, {len(chunks)} chunks, "
+			f"{documents[-1]['sections']} sections, p50 {documents[-1]['seconds_p50']:.3f}s", file=sys.stderr)
+
+	return {
+		"docs": len(pdfs),
+		"runs": runs,
+		"docs_per_sec": runs / wall if wall else 0.0,
+		"stages": {
+			name: {
+				"n": len(v),
+				"mean": sum(v) / len(v),
+				"p50": percentile(v, 50),
+				"p90": percentile(v, 90),
+				"p99": percentile(v, 99),
+			}
+			for name, v in sorted(samples.items())
+		},
+		"tokens": tokens,
+		"peak_rss_mb": profiling.process_peak_rss_kb() / 1024,
+		"documents": documents,
+	}
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+	"""Регрессии: p50 стадии медленнее базы больше чем на tolerance, или меньше документов в секунду."""
+	problems = []
+	if current.get("model") != baseline.get("model"):
+		print(f"warning: baseline model {baseline.get('model')!r} != {current.get('model')!r}", file=sys.stderr)
+	print(f"{'stage':16s} {'base p50':>10s} {'now p50':>10s} {'ratio':>7s}", file=sys.stderr)
+	for name, now in current["stages"].items():
+		base = baseline.get("stages", {}).get(name)
+		if base is None or not base["p50"]:
+			continue
+		ratio = now["p50"] / base["p50"]
+		print(f"{name:16s} {base['p50']:10.4f} {now['p50']:10.4f} {ratio:7.2f}", file=sys.stderr)
+		if ratio > 1 + tolerance:
+			problems.append(f"{name}: p50 {base['p50']:.4f}s -> {now['p50']:.4f}s")
+	base_dps = baseline.get("docs_per_sec", 0.0)
+	if base_dps and current["docs_per_sec"] < base_dps * (1 - tolerance):
+		problems.append(f"docs/sec {base_dps:.3f} -> {current['docs_per_sec']:.3f}")
+	return problems
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("pdfs", nargs="*", default=sorted(glob.glob("test_files/*.pdf")))
+	ap.add_argument("--model", default="stub", help="stub (по умолчанию) или путь к GGUF")
+	ap.add_argument("--repeat", type=int, default=3)
+	ap.add_argument("--html-dir", help="готовый HTML <имя pdf>.html вместо конвертации marker")
+	ap.add_argument("--save-html", metavar="DIR", help="сохранить HTML marker'а для --html-dir")
+	ap.add_argument("--out", help="записать отчёт в JSON")
+	ap.add_argument("--save-baseline", metavar="JSON", help="записать отчёт как базовый")
+	ap.add_argument("--compare", metavar="JSON", help="сравнить с базовым отчётом")
+	ap.add_argument("--tolerance", type=float, default=0.10, help="допустимое замедление p50, доля")
+	args = ap.parse_args()
+	if not args.pdfs:
+		ap.error("no input PDFs")
+
+	if args.model == "stub":
+		lm, tok = None, install_stub()
+	else:
+		caterpillar.configure(model_path=args.model)
+		lm, tok = caterpillar.get_lm(), caterpillar.get_tokenizer()
+
+	report = run(args.pdfs, lm=lm, tok=tok, repeat=args.repeat, html_dir=args.html_dir, save_html_dir=args.save_html)
+	report.update({"model": args.model, "repeat": args.repeat, "python": platform.python_version(), "machine": platform.machine()})
+
+	text = json.dumps(report, ensure_ascii=False, indent=2)
+	print(text)
+	for path in (args.out, args.save_baseline):
+		if path:
+			with open(path, "w", encoding="utf-8") as f:
+				f.write(text)
+
+	if args.compare:
+		with open(args.compare, "r", encoding="utf-8") as f:
+			problems = compare(report, json.load(f), args.tolerance)
+		for p in problems:
+			print(f"REGRESSION {p}", file=sys.stderr)
+		if problems:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Дисковый кэш результатов по хэшу содержимого: HTML marker'а, классификация, Header, ExtractResult.
+
+Ключ складывается из хэша входа (байты PDF, HTML раздела), отпечатка файла модели и
+версии промпта стадии, поэтому правка промпта разбора разделов не сбрасывает кэш marker'а,
+а неизменившиеся разделы новой редакции документа не уходят в модель повторно.
+Размер ограничен; при переполнении удаляются записи, к которым дольше всего не обращались.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from functools import lru_cache
+from typing import Any, Optional, Union
+
+DEFAULT_MAX_BYTES = 4 << 30
+
+
+def content_key(*parts: Union[str, bytes, int]) -> str:
+	h = hashlib.sha256()
+	for part in parts:
+		if isinstance(part, str):
+			part = part.encode("utf-8")
+		elif isinstance(part, int):
+			part = str(part).encode("ascii")
+		h.update(len(part).to_bytes(8, "little"))
+		h.update(part)
+	return h.hexdigest()
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(chunk_size), b""):
+			h.update(block)
+	return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def model_fingerprint(path: str, sample: int = 1 << 20) -> str:
+	"""
+	Отпечаток GGUF без чтения всех гигабайт: размер, заголовок с метаданными и хвост файла.
+	"""
+	size = os.path.getsize(path)
+	h = hashlib.sha256(str(size).encode("ascii"))
+	with open(path, "rb") as f:
+		h.update(f.read(sample))
+		if size > sample:
+			f.seek(max(sample, size - sample))
+			h.update(f.read(sample))
+	return h.hexdigest()
+
+class ResultCache:
+	def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+		self.root = root
+		self.max_bytes = max_bytes
+		self._lock = threading.Lock()
+		os.makedirs(root, exist_ok=True)
+		self._size = sum(os.path.getsize(p) for p in self._entries())
+
+	def _path(self, namespace: str, key: str) -> str:
+		return os.path.join(self.root, namespace, key[:2], key)
+
+	def _entries(self):
+		for dirpath, _, files in os.walk(self.root):
+			for name in files:
+				if not name.startswith(".tmp"):
+					yield os.path.join(dirpath, name)
+
+	def get(self, namespace: str, key: str) -> Optional[bytes]:
+		path = self._path(namespace, key)
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return None
+		# mtime служит отметкой последнего обращения для LRU
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			pass
+		return data
+
+	def path(self, namespace: str, key: str) -> Optional[str]:
+		"""Путь к записи для чтения на месте (без загрузки в память) или None, если её нет."""
+		path = self._path(namespace, key)
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return None
+		return path
+
+	def put(self, namespace: str, key: str, data: bytes) -> None:
+		path = self._path(namespace, key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(tmp, path)  # атомарно и для соседних процессов
+		with self._lock:
+			self._size += len(data)
+			if self._size > self.max_bytes:
+				self._evict()
+
+	def get_json(self, namespace: str, key: str) -> Optional[Any]:
+		data = self.get(namespace, key)
+		return None if data is None else json.loads(data)
+
+	def put_json(self, namespace: str, key: str, value: Any) -> None:
+		self.put(namespace, key, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+	def _evict(self) -> None:
+		# Пересчитываем с диска: в кэш могут писать и другие процессы
+		entries = []
+		for path in self._entries():
+			try:
+				st = os.stat(path)
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime, st.st_size, path))
+		entries.sort()
+		total = sum(size for _, size, _ in entries)
+		target = self.max_bytes * 9 // 10
+		for _, size, path in entries:
+			if total <= target:
+				break
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+		self._size = total
@@ -8,8 +8,10 @@ from guidance.chat import ChatTemplate, UnsupportedRoleException
 from guidance.models import LlamaCpp
 from typing import Any, Annotated, Literal, Union, get_origin, get_args
 
-import inspect, json, typing
-from dataclasses import dataclass
+import asyncio, hashlib, inspect, json, re, threading, time, typing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
 from typing import Any, get_origin
 
 from pydantic import BaseModel, TypeAdapter, create_model, ConfigDict, Field
@@ -209,17 +211,138 @@ class Qwen3ChatTemplate(ChatTemplate):
     def get_role_end(self, role_name: str | None = None) -> str:
         return "<|im_end|>"
 
+# Process-wide cache of JSON grammars: building one from a schema (pydantic schema
+# generation + guidance grammar construction) costs far more than using it, and the
+# same few schemas are used on every call of a stage.
+_GRAMMARS: dict[tuple, Any] = {}
+_GRAMMARS_LOCK = threading.Lock()
+
+def _schema_key(schema: Any) -> Any:
+    """Model classes and adapters are keyed by identity, plain JSON schemas by content."""
+    if isinstance(schema, (dict, list)):
+        return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+    return schema
+
+def json_grammar(name: str, schema: Any, **kwargs):
+    """
+    gjson(name=name, schema=schema, **kwargs), built once per process for each
+    (name, schema, kwargs). Grammars are immutable, so the cached one can be
+    appended to any lm, from any thread.
+    """
+    key = (name, _schema_key(schema), tuple(sorted(kwargs.items())))
+    grammar = _GRAMMARS.get(key)
+    if grammar is None:
+        with _GRAMMARS_LOCK:
+            grammar = _GRAMMARS.get(key)
+            if grammar is None:
+                grammar = gjson(name=name, schema=schema, **kwargs)
+                _GRAMMARS[key] = grammar
+    return grammar
+
+def clear_grammar_cache() -> None:
+    with _GRAMMARS_LOCK:
+        _GRAMMARS.clear()
+
+class ResultMemo:
+    """Thread-safe LRU of tool results with an optional time-to-live in seconds."""
+
+    def __init__(self, maxsize: int = 128, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return False, None
+            stored, value = item
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            return True, value
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
 @dataclass
 class ToolSpec:
     name: str
     description: str
     Params: type[BaseModel]
     fn: typing.Callable
+    timeout: float | None = None  # seconds; None falls back to the default of execute_many
+    memo: ResultMemo | None = None  # only for pure tools: same validated params -> same result
+
+@dataclass
+class ToolCall:
+    name: str
+    arguments: dict
+
+@dataclass
+class ToolResult:
+    call: ToolCall
+    value: Any = None
+    error: BaseException | None = None
+    cached: bool = False
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def content(self) -> str:
+        """Text for the <tool_response> block."""
+        if self.error is not None:
+            return json.dumps({"error": f"{type(self.error).__name__}: {self.error}"}, ensure_ascii=False)
+        if isinstance(self.value, str):
+            return self.value
+        return json.dumps(self.value, ensure_ascii=False, default=str)
+
+TOOL_CALL_RE = re.compile(r"<tool_call>\s*(.*?)\s*</tool_call>", re.S)
+
+def parse_tool_calls(text: str) -> list[ToolCall]:
+    """All <tool_call> blocks of an assistant message, in order."""
+    calls = []
+    for body in TOOL_CALL_RE.findall(text):
+        data = json.loads(body)
+        calls.append(ToolCall(data["name"], data.get("arguments") or {}))
+    return calls
+
+def tool_responses(results: list[ToolResult]) -> str:
+    """Results of one turn as consecutive <tool_response> blocks, in call order."""
+    return "\n".join(f"<tool_response>\n{r.content()}\n</tool_response>" for r in results)
+
+def _run_awaitable(name: str, value: Any) -> Any:
+    """Result of a coroutine tool called from sync code; asyncio.run cannot nest in a running loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(value)
+    if inspect.iscoroutine(value):
+        value.close()
+    raise RuntimeError(f"tool {name!r} is async and an event loop is running in this thread; use aexecute_many")
 
 class Tools:
-    def __init__(self, *, strict_primitives: bool = False):
+    def __init__(self, *, strict_primitives: bool = False, max_workers: int = 8):
         self._by_name: dict[str, ToolSpec] = {}
         self._strict_primitives = strict_primitives
+        self._max_workers = max_workers
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_lock = threading.Lock()
+        # Built from the current tool set; dropped by _register
+        self._union: Any = None
+        self._grammars: dict[str, Any] = {}
 
     def _strictify(self, annot: Any) -> Any:
         """Optionally map primitives to Strict* types (no coercion)."""
@@ -254,23 +377,39 @@ class Tools:
     class _ForbidExtra(BaseModel):
         model_config = ConfigDict(extra='forbid')  # no unknown keys anywhere
 
-    def _register(self, *functions: typing.Callable, description: str | None = None, name: str | None = None):
+    def _register(
+        self,
+        *functions: typing.Callable,
+        description: str | None = None,
+        name: str | None = None,
+        pure: bool = False,
+        timeout: float | None = None,
+        cache_size: int = 128,
+        cache_ttl: float | None = None,
+    ):
+        """
+        pure=True marks a tool whose result depends only on its arguments: results are
+        memoized (LRU of cache_size entries, expiring after cache_ttl seconds if set).
+        """
         for fn in functions:
             sig = inspect.signature(fn)
             fields: dict[str, tuple[Any, Any]] = {}
-            for name, p in sig.parameters.items():
+            for param_name, p in sig.parameters.items():
                 if p.kind in (inspect.Parameter.VAR_KEYWORD, inspect.Parameter.VAR_POSITIONAL):
                     # **kwargs / *args are not representable in JSON
                     continue
                 annot = p.annotation if p.annotation is not inspect._empty else Any
                 annot = self._strictify(annot)
                 default = p.default if p.default is not inspect._empty else ...
-                fields[name] = (annot, default)
+                fields[param_name] = (annot, default)
 
             tool_name = name or fn.__name__
             desc = (description or fn.__doc__ or tool_name).strip()
             Params = create_model(f"{fn.__name__}Params", __base__=self._ForbidExtra, **fields)
-            self._by_name[tool_name] = ToolSpec(tool_name, desc, Params, fn)
+            memo = ResultMemo(cache_size, cache_ttl) if pure else None
+            self._by_name[tool_name] = ToolSpec(tool_name, desc, Params, fn, timeout, memo)
+        self._union = None
+        self._grammars = {}
 
     def system_preface(self) -> str:
 
@@ -297,13 +436,139 @@ class Tools:
             "</tool_call>"
         )
 
-    def execute(self, name: str, arguments: dict) -> Any:
-        """Validate with Pydantic, then call the Python function."""
+    def _prepare(self, name: str, arguments: dict) -> tuple[ToolSpec, dict, str]:
+        """Validated call: spec, keyword arguments and the memo key (canonical JSON of the params)."""
         if name not in self._by_name:
             raise ValueError(f"Unknown tool: {name!r}")
         spec = self._by_name[name]
-        args = spec.Params.model_validate(arguments).model_dump()
-        return spec.fn(**args)
+        params = spec.Params.model_validate(arguments)
+        return spec, params.model_dump(), params.model_dump_json()
+
+    def _call(self, spec: ToolSpec, args: dict, key: str) -> Any:
+        if spec.memo is not None:
+            hit, value = spec.memo.get(key)
+            if hit:
+                return value
+        value = spec.fn(**args)
+        if inspect.isawaitable(value):
+            value = _run_awaitable(spec.name, value)
+        if spec.memo is not None:
+            spec.memo.put(key, value)
+        return value
+
+    def execute(self, name: str, arguments: dict) -> Any:
+        """
+        Validate with Pydantic, then call the Python function (or return the memoized result of a pure tool).
+        Coroutine tools are run to completion here, so inside a running event loop use aexecute_many.
+        """
+        spec, args, key = self._prepare(name, arguments)
+        return self._call(spec, args, key)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self._max_workers, thread_name_prefix="tools")
+            return self._pool
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def execute_many(self, calls: list[ToolCall], *, timeout: float | None = None) -> list[ToolResult]:
+        """
+        Run the calls of one turn concurrently on a thread pool; results come back in call order.
+        Each call waits at most its tool's timeout (or `timeout`); a call that times out is
+        reported as a TimeoutError, but its thread is not interrupted. Errors, including
+        validation errors, are returned in ToolResult.error rather than raised. Identical calls
+        to a pure tool within a turn run once.
+        """
+        results = [ToolResult(call) for call in calls]
+        pending: list[tuple[int, Future, float | None, float]] = []
+        shared: dict[tuple[str, str], Future] = {}
+        for i, call in enumerate(calls):
+            try:
+                spec, args, key = self._prepare(call.name, call.arguments)
+            except Exception as e:
+                results[i].error = e
+                continue
+            if spec.memo is not None:
+                hit, value = spec.memo.get(key)
+                if hit:
+                    results[i].value, results[i].cached = value, True
+                    continue
+            future = shared.get((spec.name, key)) if spec.memo is not None else None
+            if future is None:
+                future = self._executor().submit(self._call, spec, args, key)
+                if spec.memo is not None:
+                    shared[(spec.name, key)] = future
+            limit = spec.timeout if spec.timeout is not None else timeout
+            pending.append((i, future, limit, time.monotonic()))
+
+        for i, future, limit, started in pending:
+            left = None if limit is None else max(limit - (time.monotonic() - started), 0.0)
+            try:
+                results[i].value = future.result(timeout=left)
+            except FutureTimeoutError:
+                results[i].error = TimeoutError(f"tool {calls[i].name!r} timed out after {limit}s")
+            except Exception as e:
+                results[i].error = e
+            results[i].seconds = time.monotonic() - started
+        return results
+
+    async def aexecute_many(self, calls: list[ToolCall], *, timeout: float | None = None) -> list[ToolResult]:
+        """execute_many for asyncio code: coroutine tools run on the loop, plain ones on the thread pool."""
+        loop = asyncio.get_running_loop()
+        shared: dict[tuple[str, str], asyncio.Future] = {}
+        # Calls still awaiting each task: identical pure calls share one, so only the last one to leave cancels it
+        waiting: dict[asyncio.Future, int] = {}
+
+        async def run(call: ToolCall) -> ToolResult:
+            result = ToolResult(call)
+            started = time.monotonic()
+            try:
+                spec, args, key = self._prepare(call.name, call.arguments)
+                if spec.memo is not None:
+                    hit, value = spec.memo.get(key)
+                    if hit:
+                        result.value, result.cached = value, True
+                        return result
+                task = shared.get((spec.name, key)) if spec.memo is not None else None
+                if task is None:
+                    if inspect.iscoroutinefunction(spec.fn):
+                        task = asyncio.ensure_future(self._acall(spec, args, key))
+                    else:
+                        task = loop.run_in_executor(self._executor(), self._call, spec, args, key)
+                    if spec.memo is not None:
+                        shared[(spec.name, key)] = task
+                limit = spec.timeout if spec.timeout is not None else timeout
+                waiting[task] = waiting.get(task, 0) + 1
+                try:
+                    result.value = await asyncio.wait_for(asyncio.shield(task), limit)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"tool {call.name!r} timed out after {limit}s") from None
+                except asyncio.CancelledError:
+                    # The tool's own task was cancelled, not this call: report it like any tool error
+                    if not task.cancelled():
+                        raise
+                    raise RuntimeError(f"tool {call.name!r} was cancelled") from None
+                finally:
+                    waiting[task] -= 1
+                    if not waiting[task] and not task.done():
+                        task.cancel()
+            except Exception as e:
+                result.error = e
+            result.seconds = time.monotonic() - started
+            return result
+
+        return list(await asyncio.gather(*(run(call) for call in calls)))
+
+    async def _acall(self, spec: ToolSpec, args: dict, key: str) -> Any:
+        value = await spec.fn(**args)
+        if spec.memo is not None:
+            spec.memo.put(key, value)
+        return value
 
     # Decorator form
     def tool(self, *dargs, **dkwargs):
@@ -315,7 +580,12 @@ class Tools:
         return wrap
 
     def _tool_call_union_type(self) -> Any:
-        """Build a discriminated union over name -> arguments schema."""
+        """Discriminated union over name -> arguments schema, rebuilt only when the tool set changes."""
+        if self._union is None:
+            self._union = self._build_union()
+        return self._union
+
+    def _build_union(self) -> Any:
         if not self._by_name:
             raise ValueError("No tools registered")
 
@@ -334,29 +604,166 @@ class Tools:
         # Discriminated union keyed by "name"
         return TypeAdapter(Annotated[Union[tuple(call_models)], Field(discriminator="name")])
 
+    def _tool_call_grammar(self, var_name: str):
+        grammar = self._grammars.get(var_name)
+        if grammar is None:
+            grammar = self._grammars[var_name] = gjson(name=var_name, schema=self._tool_call_union_type())
+        return grammar
+
     # Guidance template: now takes a schema argument
     @guidance(stateless=True)
     def tool_call(self, lm, var_name):
         """Emit: <tool_call>...</tool_call> for a tool call."""
         lm += special_token("<tool_call>") + "\n"
-        lm += gjson(name=var_name, schema=self._tool_call_union_type())
+        lm += self._tool_call_grammar(var_name)
         lm += special_token("</tool_call>")
         return lm
 
+    @guidance
+    def tool_calls(self, lm, var_name: str = "tool_calls", max_calls: int = 8):
+        """
+        Emit one or more <tool_call> blocks separated by newlines, as the Qwen3 template
+        allows; the model ends the turn after any of them. Calls are captured as
+        var_name.0, var_name.1, ... (see captured_calls).
+        """
+        lm += self.tool_call(var_name=f"{var_name}.0")
+        for i in range(1, max_calls):
+            lm += select(["\n", ""], name=f"{var_name}._more")
+            if lm[f"{var_name}._more"] != "\n":
+                break
+            lm += self.tool_call(var_name=f"{var_name}.{i}")
+        return lm
+
+    @staticmethod
+    def captured_calls(lm, var_name: str = "tool_calls") -> list[ToolCall]:
+        """Calls emitted by tool_calls(var_name=...), in order."""
+        calls = []
+        i = 0
+        while lm.get(f"{var_name}.{i}") is not None:
+            data = json.loads(lm[f"{var_name}.{i}"])
+            calls.append(ToolCall(data["name"], data["arguments"]))
+            i += 1
+        return calls
+
 @contextmanager
 def thoughts(lm):
     lm += special_token("<think>") + "\n"
     yield lm
     lm += special_token("</think>") + "\n\n"
 
+@dataclass(frozen=True)
+class ReasoningPolicy:
+    """
+    How much a stage may think inside <think>...</think>.
+
+    mode: "free"     -> no limit (the model decides when to close the block)
+          "off"      -> empty think block
+          "capped"   -> at most max_tokens, then </think> is forced
+          "adaptive" -> ratio * input tokens, clamped to [min_tokens, max_tokens]
+    """
+    mode: str = "free"
+    max_tokens: int = 0
+    ratio: float = 0.05
+    min_tokens: int = 64
+
+    ADAPTIVE_MAX_TOKENS = 4096
+
+    def __post_init__(self):
+        if self.mode not in ("free", "off", "capped", "adaptive"):
+            raise ValueError("mode must be 'free', 'off', 'capped' or 'adaptive'")
+        if self.mode == "capped" and self.max_tokens <= 0:
+            raise ValueError("capped reasoning needs max_tokens > 0")
+
+    @classmethod
+    def parse(cls, spec: str) -> "ReasoningPolicy":
+        """'free', 'off', '<N>' (capped), 'adaptive' or 'adaptive:<ratio>[:<min>[:<max>]]'."""
+        spec = spec.strip().lower()
+        if spec in ("free", "off"):
+            return cls(spec)
+        if spec.isdigit():
+            return cls("capped", max_tokens=int(spec))
+        if spec.startswith("adaptive"):
+            parts = spec.split(":")[1:]
+            kwargs: dict[str, Any] = {}
+            if len(parts) > 0:
+                kwargs["ratio"] = float(parts[0])
+            if len(parts) > 1:
+                kwargs["min_tokens"] = int(parts[1])
+            if len(parts) > 2:
+                kwargs["max_tokens"] = int(parts[2])
+            return cls("adaptive", **kwargs)
+        raise ValueError(f"bad reasoning policy: {spec!r}")
+
+    @property
+    def needs_input_size(self) -> bool:
+        return self.mode == "adaptive"
+
+    def budget(self, input_tokens: int = 0) -> int | None:
+        """Token budget for the think block: None = unlimited, 0 = skip thinking."""
+        if self.mode == "free":
+            return None
+        if self.mode == "off":
+            return 0
+        if self.mode == "capped":
+            return self.max_tokens
+        cap = self.max_tokens or self.ADAPTIVE_MAX_TOKENS
+        return max(self.min_tokens, min(cap, int(input_tokens * self.ratio)))
+
+def reason(lm, budget: int | None = None, name: str = "thoughts"):
+    """
+    Emit a <think> block under a token budget and return the new lm.
+    None lets the model think freely; 0 emits an empty block; N caps the
+    generation at N tokens and closes the block with a forced </think>.
+    """
+    lm += special_token("<think>") + "\n"
+    if budget is None:
+        lm += gen(name)
+    elif budget > 0:
+        lm += gen(name, max_tokens=budget)
+    lm += special_token("</think>") + "\n"
+    return lm
+
 LINE_OR_BLANK = r"(?:- [^\n]{1,160}\n|\n)"
 
+MD_LIST_MAX_ITEMS = 64
+MD_ITEM_CHARS = 160
+MD_ITEM_TOKENS = 160
 
-def md_list(lm, style: str = "bullet") -> list[str]:
+def md_list_regex(style: str = "bullet", max_items: int = MD_LIST_MAX_ITEMS) -> str:
+    """
+    Regex for a whole markdown list of at most max_items lines followed by a blank line.
+    Numbered lists are nested optional groups, so item k can only be "k. ..." and
+    numbering cannot skip or restart.
+    """
+    if style not in ("bullet", "numbered"):
+        raise ValueError("style must be 'bullet' or 'numbered'")
+    item = rf"[^\n]{{1,{MD_ITEM_CHARS}}}\n"
+    if style == "bullet":
+        return rf"(?:- {item}){{0,{max_items}}}\n"
+    body = ""
+    for i in range(max_items, 0, -1):
+        body = rf"(?:{i}\. {item}{body})?"
+    return body + r"\n"
+
+_MD_PREFIX_RE = re.compile(r"^(?:- |\d+\. )")
+
+def parse_md_list(text: str) -> list[str]:
+    """Items of a generated markdown list, without the "- " / "N. " prefix."""
+    items = []
+    for line in text.split("\n"):
+        if not line.strip():
+            break  # the terminating blank line (or a list cut off by max_tokens)
+        items.append(_MD_PREFIX_RE.sub("", line).strip())
+    return items
+
+def md_list(lm, style: str = "bullet", *, max_items: int = MD_LIST_MAX_ITEMS, name: str = "md_list") -> list[str]:
     """
     Generate a markdown list directly into `lm`, stopping when the model emits a blank line.
     Returns a Python list[str] of the captured items (without the prefix).
 
+    The whole list is one constrained gen (see md_list_regex), so it costs one grammar
+    and one decode call however many items it has.
+
     style: "bullet"  -> lines like "- item\n"
            "numbered"-> lines like "1. item\n", "2. item\n", ...
 
@@ -364,36 +771,8 @@ def md_list(lm, style: str = "bullet") -> list[str]:
         lm += "List 3–5 concise tips, then end with a blank line:\n"
         tips = md_list(lm, style="bullet")
     """
-    if style not in ("bullet", "numbered"):
-        raise ValueError("style must be 'bullet' or 'numbered'")
-
-    items: list[str] = []
-    MAX_ITEMS = 64  
-
-    for i in range(1, MAX_ITEMS):
-        if style == "bullet":
-            pattern = r"(?:- [^\n]+\n|\n)"
-        else:
-            pattern = rf"(?:{i}\. [^\n]+\n|\n)"
-
-        name = f"mdline{i}x"
-        lm += gen(name=name, regex=pattern, max_tokens=160)
-        line = lm[name]
-
-        if line == "\n":
-            break
-
-        # Strip trailing newline and the visible prefix
-        line_no_nl = line[:-1]  # drop '\n'
-        if style == "bullet":
-            text = line_no_nl[2:] if line_no_nl.startswith("- ") else line_no_nl
-        else:
-            pref = f"{i+1}. "
-            text = line_no_nl[len(pref):] if line_no_nl.startswith(pref) else line_no_nl
-
-        items.append(text.strip())
-
-    return items
+    lm += gen(name=name, regex=md_list_regex(style, max_items), max_tokens=MD_ITEM_TOKENS * max_items)
+    return parse_md_list(lm[name])
 
 if __name__ == "__main__":
     lm = LlamaCpp(model="models/Qwen3-4B-Thinking-2507-F16.gguf", 
@@ -403,11 +782,11 @@ if __name__ == "__main__":
             n_gpu_layers=-1)
 
     tools = Tools()
-    @tools.tool(description="Multiply two integers")
+    @tools.tool(description="Multiply two integers", pure=True)
     def multiply(a1: int, a2: int) -> int:
         return a1 * a2
 
-    @tools.tool(description="Get current time for a timezone")
+    @tools.tool(description="Get current time for a timezone", timeout=5.0)
     def get_time(timezone: str) -> str:
         from datetime import datetime
         from zoneinfo import ZoneInfo
@@ -420,10 +799,11 @@ if __name__ == "__main__":
         lm += "Multiply 2 and 2"
 
     with assistant():
-        lm += thoughts()
-        lm += tools.tool_call(var_name="tool_args")
+        lm = reason(lm, ReasoningPolicy.parse("512").budget())
+        lm += tools.tool_calls(var_name="tool_args")
         #lm += gen(name="answer")
     print(lm["thoughts"])
     #print(lm["answer"])
-    print(lm["tool_args"])
+    results = tools.execute_many(tools.captured_calls(lm, "tool_args"))
+    print(tool_responses(results))
 
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Разбиение HTML от marker на блоки верхнего уровня, чанки под бюджет токенов и сравнение фрагментов по тексту."""
+
+import hashlib
+import re
+from dataclasses import dataclass
+from html import unescape
+from html.parser import HTMLParser
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from tables import PLACEHOLDER_RE
+
+# Обёртки, внутрь которых спускаемся: блоками считаются их дети
+CONTAINER_TAGS = {"html", "body", "div", "section", "article", "main", "header", "footer"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+
+@dataclass
+class Block:
+	start: int  # смещения в исходной строке HTML
+	end: int
+	tag: str
+
+	@property
+	def is_heading(self) -> bool:
+		return self.tag in HEADING_TAGS
+
+class _BlockScanner(HTMLParser):
+	def __init__(self, html: str):
+		super().__init__(convert_charrefs=False)
+		self.html = html
+		self.blocks: List[Block] = []
+		self._line_starts = [0]
+		pos = html.find("\n")
+		while pos >= 0:
+			self._line_starts.append(pos + 1)
+			pos = html.find("\n", pos + 1)
+		self._stack: List[str] = []  # открытые теги внутри текущего блока
+		self._block_start = -1
+		self._block_tag = ""
+		self._text_start = -1  # текст прямо в контейнере, вне тегов
+
+	def _offset(self) -> int:
+		line, col = self.getpos()
+		return self._line_starts[line - 1] + col
+
+	def _tag_end(self, pos: int) -> int:
+		return self.html.index(">", pos) + 1
+
+	def _flush_text(self, end: int) -> None:
+		if self._text_start >= 0:
+			if self.html[self._text_start:end].strip():
+				self.blocks.append(Block(self._text_start, end, "#text"))
+			self._text_start = -1
+
+	def handle_starttag(self, tag, attrs):
+		pos = self._offset()
+		if self._stack:
+			if tag not in VOID_TAGS:
+				self._stack.append(tag)
+			return
+		self._flush_text(pos)
+		if tag in CONTAINER_TAGS:
+			return
+		if tag in VOID_TAGS:
+			self.blocks.append(Block(pos, self._tag_end(pos), tag))
+			return
+		self._stack.append(tag)
+		self._block_start, self._block_tag = pos, tag
+
+	def handle_startendtag(self, tag, attrs):
+		pos = self._offset()
+		if self._stack:
+			return
+		self._flush_text(pos)
+		if tag not in CONTAINER_TAGS:
+			self.blocks.append(Block(pos, self._tag_end(pos), tag))
+
+	def handle_endtag(self, tag):
+		pos = self._offset()
+		if not self._stack:
+			# закрытие контейнера или мусорный тег
+			self._flush_text(pos)
+			return
+		if tag in self._stack:
+			# допускаем незакрытые вложенные теги: снимаем всё до совпавшего
+			while self._stack.pop() != tag:
+				pass
+		if not self._stack:
+			self.blocks.append(Block(self._block_start, self._tag_end(pos), self._block_tag))
+
+	def handle_data(self, data):
+		if not self._stack and self._text_start < 0 and data.strip():
+			self._text_start = self._offset()
+
+	def close(self):
+		super().close()
+		if self._stack:
+			# оборванный документ — остаток считаем одним блоком
+			self.blocks.append(Block(self._block_start, len(self.html), self._block_tag))
+		self._flush_text(len(self.html))
+
+def html_blocks(html: str) -> List[Block]:
+	"""Блоки верхнего уровня (абзацы, заголовки, таблицы, списки...) в порядке документа."""
+	scanner = _BlockScanner(html)
+	scanner.feed(html)
+	scanner.close()
+	return scanner.blocks
+
+def number_blocks(html: str, blocks: Optional[List[Block]] = None) -> str:
+	"""HTML с маркером <!--bN--> перед каждым блоком верхнего уровня: по этим номерам модель указывает границы подразделов."""
+	if blocks is None:
+		blocks = html_blocks(html)
+	parts, pos = [], 0
+	for i, b in enumerate(blocks):
+		parts.append(html[pos:b.start])
+		parts.append(f"<!--b{i}-->")
+		pos = b.start
+	parts.append(html[pos:])
+	return "".join(parts)
+
+@dataclass
+class Chunk:
+	text: str
+	start: int
+	end: int
+	tokens: int
+
+def iter_chunks(
+	html: str,
+	count_tokens: Callable[[str], int],
+	*,
+	max_tokens: int,
+	overlap_tokens: int = 0,
+) -> Iterator[Chunk]:
+	"""
+	Жадно набирает блоки в чанк, пока влезает бюджет. Резать предпочитаем перед заголовком
+	во второй половине чанка, иначе — по границе любого блока; таблица или абзац не режутся никогда,
+	поэтому блок больше бюджета уходит отдельным чанком. Следующий чанк начинается с хвостовых
+	блоков предыдущего общим объёмом не больше overlap_tokens.
+	"""
+	if max_tokens <= 0:
+		raise ValueError("max_tokens must be > 0")
+	if not 0 <= overlap_tokens < max_tokens:
+		raise ValueError("overlap_tokens must be in [0, max_tokens)")
+
+	blocks = html_blocks(html)
+	sizes = [count_tokens(html[b.start:b.end]) for b in blocks]
+
+	def make(i: int, j: int) -> Chunk:
+		return Chunk(html[blocks[i].start:blocks[j - 1].end], blocks[i].start, blocks[j - 1].end, sum(sizes[i:j]))
+
+	i, n = 0, len(blocks)
+	while i < n:
+		j, total = i, 0
+		while j < n and (j == i or total + sizes[j] <= max_tokens):
+			total += sizes[j]
+			j += 1
+		if j < n:
+			# ищем заголовок во второй половине чанка, чтобы не отрывать его от текста
+			acc = 0
+			for k in range(i, j):
+				if k > i and blocks[k].is_heading and acc >= max_tokens // 2:
+					j = k
+					break
+				acc += sizes[k]
+		yield make(i, j)
+		if j >= n:
+			return
+		# перекрытие: хвост текущего чанка, но обязательно с продвижением вперёд
+		k, acc = j, 0
+		while k - 1 > i and acc + sizes[k - 1] <= overlap_tokens:
+			k -= 1
+			acc += sizes[k]
+		i = k
+
+def iter_chunks_stream(
+	pieces: Iterable[str],
+	count_tokens: Callable[[str], int],
+	*,
+	max_tokens: int,
+	overlap_tokens: int = 0,
+) -> Iterator[Chunk]:
+	"""
+	iter_chunks по HTML, который приходит кусками (окнами страниц), с теми же границами, что и
+	для склеенного текста: чанк, за которым уже есть блоки, от продолжения не зависит и отдаётся
+	сразу, последний придерживается до следующего куска. Куски должны состоять из целых блоков;
+	смещения чанков — в склеенном тексте.
+	"""
+	buf, base = "", 0
+	for piece in pieces:
+		buf += piece
+		held = None
+		for chunk in iter_chunks(buf, count_tokens, max_tokens=max_tokens, overlap_tokens=overlap_tokens):
+			if held is not None:
+				yield Chunk(held.text, held.start + base, held.end + base, held.tokens)
+			held = chunk
+		if held is not None:
+			# Последний чанк может дорасти: следующий кусок режем заново с его начала
+			buf, base = buf[held.start:], base + held.start
+	for chunk in iter_chunks(buf, count_tokens, max_tokens=max_tokens, overlap_tokens=overlap_tokens):
+		yield Chunk(chunk.text, chunk.start + base, chunk.end + base, chunk.tokens)
+
+_BODY_RE = re.compile(r"<body[^>]*>(.*)</body\s*>", re.I | re.S)
+
+def body_html(html: str) -> str:
+	"""Содержимое <body> полного HTML-документа (или сам HTML, если обёртки нет)."""
+	m = _BODY_RE.search(html)
+	return m.group(1) if m else html
+
+def _join_headings(a: str, b: str) -> str:
+	"""<hN>начало</hN> + <hN>конец</hN> -> <hN>начало конец</hN>, атрибуты — от первого."""
+	inner_b = b[b.index(">") + 1:b.rindex("</")]
+	close = a.rindex("</")
+	return f"{a[:close].rstrip()} {inner_b.strip()}{a[close:]}"
+
+def stitch_windows(windows: Iterable[str]) -> Iterator[str]:
+	"""
+	Склеивает HTML окон страниц, сконвертированных по отдельности. Заголовок в конце окна
+	придерживается до следующего: если то начинается с заголовка того же уровня, это один
+	заголовок, разорванный переносом страницы, и они объединяются; иначе он просто переносится
+	в начало следующего окна, к своему тексту. Каждое отданное окно состоит из целых блоков.
+	"""
+	carry = ""  # придержанный заголовок предыдущего окна
+	carry_tag = ""
+	for window in windows:
+		html = body_html(window)
+		blocks = html_blocks(html)
+		if carry:
+			if blocks and blocks[0].tag == carry_tag:
+				first = blocks[0]
+				html = html[:first.start] + _join_headings(carry, html[first.start:first.end]) + html[first.end:]
+			else:
+				at = blocks[0].start if blocks else len(html)
+				html = html[:at] + carry + html[at:]
+			carry = ""
+			blocks = html_blocks(html)
+		if blocks and blocks[-1].is_heading:
+			last = blocks[-1]
+			carry, carry_tag = html[last.start:last.end], last.tag
+			html = html[:last.start] + html[last.end:]
+		if html.strip():
+			yield html
+	if carry:
+		yield carry
+
+_TAG_RE = re.compile(r"<[^>]*>")
+_WS_RE = re.compile(r"\s+")
+_NON_WORD_RE = re.compile(r"\W+")
+
+def visible_text(html: str) -> str:
+	return _WS_RE.sub(" ", unescape(_TAG_RE.sub(" ", html))).strip()
+
+def normalize_text(html: str) -> str:
+	"""
+	Видимый текст фрагмента без разметки и различий в пробелах/регистре.
+	Плейсхолдеры вырезанных таблиц входят в текст своим id: он зависит от содержимого таблицы.
+	"""
+	html = PLACEHOLDER_RE.sub(lambda m: f" [{m.group(2)}] ", html)
+	return visible_text(html).casefold()
+
+def text_digest(html: str) -> str:
+	return hashlib.sha256(normalize_text(html).encode("utf-8")).hexdigest()
+
+def heading_key(text: str) -> str:
+	"""Ключ для сравнения заголовков: только буквы и цифры."""
+	return _NON_WORD_RE.sub("", normalize_text(text))
+
+def heading_level(block: Block) -> int:
+	return int(block.tag[1])
+
+def find_heading(html: str, blocks: List[Block], heading: str, start: int = 0) -> Optional[int]:
+	"""Индекс первого блока-заголовка не раньше start с тем же текстом, что heading."""
+	key = heading_key(heading)
+	for i in range(start, len(blocks)):
+		if blocks[i].is_heading and heading_key(html[blocks[i].start:blocks[i].end]) == key:
+			return i
+	return None
+
+def intro_digest(html: str, first_child_heading: str) -> Optional[str]:
+	"""Хэш собственного текста раздела — всего, что идёт до заголовка первого подраздела."""
+	blocks = html_blocks(html)
+	i = find_heading(html, blocks, first_child_heading)
+	if i is None:
+		return None
+	return text_digest(html[:blocks[i].start])
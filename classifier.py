@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Дерево корпоративного классификатора.
+
+Узлы хранят детей в словаре (поиск по значению за O(1)) и кэшируют select-грамматику
+своего уровня. Дерево собирается из CSV один раз и сохраняется в компактный бинарный
+снимок рядом с CSV; при старте снимок открывается через mmap, а узлы читаются из него
+лениво — только те, до которых дошёл спуск классификации.
+
+	python classifier.py corporate_classifier.csv   # пересобрать снимок
+"""
+
+import csv
+import mmap
+import os
+import struct
+import sys
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+SNAPSHOT_SUFFIX = ".idx"
+_MAGIC = b"CATX"
+_VERSION = 1
+# magic, version, число узлов, смещение строк, размер и mtime исходного CSV
+_HEADER = struct.Struct("<4sIIIQQ")
+# смещение и длина значения, индекс первого ребёнка, число детей
+_RECORD = struct.Struct("<IIII")
+
+
+class Classifier:
+	__slots__ = ("value", "_children_map", "_snapshot", "_index", "_options", "_path_grammar")
+
+	def __init__(self, value: str, *, _snapshot: Optional["_Snapshot"] = None, _index: int = -1):
+		self.value = value
+		self._snapshot = _snapshot
+		self._index = _index
+		# У узлов из снимка дети читаются при первом обращении
+		self._children_map: Optional[Dict[str, "Classifier"]] = None if _snapshot is not None else {}
+		self._options: Optional[Tuple[List[str], Any]] = None
+		self._path_grammar: Any = None
+
+	@property
+	def children(self) -> Dict[str, "Classifier"]:
+		if self._children_map is None:
+			self._children_map = self._snapshot.children_of(self._index)
+		return self._children_map
+
+	def _children(self, path: List[str]) -> List["Classifier"]:
+		node = self.node(path)
+		return list(node.children.values()) if node is not None else []
+
+	def _append_child(self, path: List[str], value: str = "") -> bool:
+		# Удаляем пустые элементы пути по краям и в середине
+		path = [p for p in path if p]  # фильтруем '', None
+
+		if not path:
+			return True
+
+		# Текущий узел должен совпадать с первым элементом пути
+		if self.value != path[0]:
+			return False
+
+		node = self
+		for key in path[1:]:
+			child = node.children.get(key)
+			if child is None:
+				# Не найден — создаём
+				child = node.children[key] = Classifier(key)
+			node = child
+		return True
+
+	def to_str(self, indent=0):
+		print('\t' * indent + self.value, '\n')
+		for child in self.children.values():
+			child.to_str(indent + 1)
+
+	@staticmethod
+	def from_csv(catalog='corporate_classifier.csv') -> 'Classifier':
+		root = Classifier('.')
+		with open(catalog, 'r', encoding='utf-8') as f:
+			reader = csv.reader(f)
+			next(reader)  # пропустить заголовок
+			for level1, level2, level3, level4, level5, description in reader:
+				# Строим путь из непустых уровней; точка — явный корень
+				path = ['.', level1, level2, level3, level4, level5]
+				root._append_child(path)       # description НЕ используем для структуры
+		return root
+
+	@staticmethod
+	def load(catalog='corporate_classifier.csv') -> 'Classifier':
+		"""Дерево из снимка рядом с CSV; если снимка нет или CSV новее — пересобирает и сохраняет снимок."""
+		snapshot = catalog + SNAPSHOT_SUFFIX
+		st = os.stat(catalog)
+		try:
+			return Classifier.load_snapshot(snapshot, source=st)
+		except (OSError, ValueError):
+			pass
+		root = Classifier.from_csv(catalog)
+		try:
+			root.save_snapshot(snapshot, source=st)
+		except OSError:
+			pass  # каталог только для чтения — просто работаем без снимка
+		return root
+
+	def node(self, path: List[str]) -> Optional['Classifier']:
+		"""Узел по пути; path может начинаться с '.' или сразу с уровня 1."""
+		node = self
+		for key in path:
+			if not key or key == '.':
+				continue
+			node = node.children.get(key)
+			if node is None:
+				return None  # не нашли указанный путь
+		return node
+
+	def resolve(self, path: str) -> Optional[List[str]]:
+		"""
+		Значения уровней для пути 'level1/level2/...' из ответа модели. Значения категорий сами
+		могут содержать '/' и пробелы по краям, поэтому путь разбирается по дереву, а не split.
+		None — такого пути в дереве нет.
+		"""
+		for child in self.children.values():
+			if path == child.value:
+				return [child.value]
+			if path.startswith(child.value + '/'):
+				rest = child.resolve(path[len(child.value) + 1:])
+				if rest is not None:
+					return [child.value] + rest
+		return None
+
+	def get_next_variants(self, path: List[str]) -> List[str]:
+		"""
+		Возвращает варианты следующего уровня для узла, заданного path.
+		path может начинаться с '.' или сразу с уровня 1.
+		"""
+		node = self.node(path)
+		return list(node.children) if node is not None else []
+
+	def options(self, path: List[str]) -> Tuple[List[str], Any]:
+		"""
+		Варианты выбора на уровне этого узла в виде 'path/variant' плюс 'other' и готовая
+		select-грамматика по ним. path — путь до этого узла; считается один раз на узел.
+		"""
+		if self._options is None:
+			from guidance import select
+
+			variants = ['/'.join(path + [v]) for v in self.children] + ['other']
+			self._options = (variants, select(name="category", options=variants))
+		return self._options
+
+	def outline(self, indent: int = 0) -> str:
+		"""Дерево потомков отступами — чтобы модель видела всю таксономию в одном промпте."""
+		lines = []
+		for child in self.children.values():
+			lines.append('  ' * indent + child.value)
+			if child.children:
+				lines.append(child.outline(indent + 1))
+		return '\n'.join(lines)
+
+	def _path_options(self, path: List[str], exclude: frozenset) -> List[Any]:
+		from guidance import select
+
+		options = []
+		for child in self.children.values():
+			child_path = path + [child.value]
+			tails = []
+			if '/'.join(child_path) not in exclude:
+				tails.append("")  # можно остановиться на этом уровне
+			if child.children:
+				deeper = child._path_options(child_path, exclude)
+				if deeper:
+					tails.append("/" + select(deeper))
+			if tails:
+				options.append(child.value + (tails[0] if len(tails) == 1 else select(tails)))
+		return options
+
+	def path_grammar(self, name: str = "category_path", exclude: frozenset = frozenset()) -> Any:
+		"""
+		Грамматика всего префиксного дерева: модель выдаёт 'level1/level2/...' за один проход,
+		и на каждом шаге допустимы только существующие продолжения. exclude — полные пути
+		(и 'other'), которые выдавать нельзя; без исключений грамматика строится один раз.
+		"""
+		from guidance import select
+
+		if not exclude and self._path_grammar is not None:
+			return self._path_grammar
+		options = self._path_options([], exclude)
+		if 'other' not in exclude:
+			options.append('other')
+		grammar = select(options, name=name)
+		if not exclude:
+			self._path_grammar = grammar
+		return grammar
+
+	def save_snapshot(self, path: str, *, source: Optional[os.stat_result] = None) -> None:
+		nodes: List[Classifier] = []
+		order = deque([self])
+		while order:  # обход в ширину: дети каждого узла лежат подряд
+			node = order.popleft()
+			nodes.append(node)
+			order.extend(node.children.values())
+
+		strings = bytearray()
+		records = bytearray()
+		next_child = 1
+		for node in nodes:
+			value = node.value.encode("utf-8")
+			records += _RECORD.pack(len(strings), len(value), next_child, len(node.children))
+			strings += value
+			next_child += len(node.children)
+
+		strings_off = _HEADER.size + len(records)
+		size, mtime = (source.st_size, source.st_mtime_ns) if source is not None else (0, 0)
+		tmp = path + ".tmp"
+		with open(tmp, "wb") as f:
+			f.write(_HEADER.pack(_MAGIC, _VERSION, len(nodes), strings_off, size, mtime))
+			f.write(records)
+			f.write(strings)
+		os.replace(tmp, path)
+
+	@staticmethod
+	def load_snapshot(path: str, *, source: Optional[os.stat_result] = None) -> 'Classifier':
+		"""Открывает снимок через mmap; source — stat исходного CSV, чтобы не взять устаревший снимок."""
+		snapshot = _Snapshot(path)
+		if source is not None and (snapshot.source_size, snapshot.source_mtime_ns) != (source.st_size, source.st_mtime_ns):
+			raise ValueError(f"{path} is stale")
+		return snapshot.root()
+
+class _Snapshot:
+	def __init__(self, path: str):
+		with open(path, "rb") as f:
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if len(self._mm) < _HEADER.size:
+			raise ValueError(f"{path} is not a classifier snapshot")
+		magic, version, self.count, self._strings, self.source_size, self.source_mtime_ns = _HEADER.unpack_from(self._mm, 0)
+		if magic != _MAGIC or version != _VERSION:
+			raise ValueError(f"{path} is not a classifier snapshot")
+
+	def _record(self, i: int) -> Tuple[int, int, int, int]:
+		return _RECORD.unpack_from(self._mm, _HEADER.size + i * _RECORD.size)
+
+	def _value(self, off: int, length: int) -> str:
+		start = self._strings + off
+		return self._mm[start:start + length].decode("utf-8")
+
+	def root(self) -> Classifier:
+		off, length, _, _ = self._record(0)
+		return Classifier(self._value(off, length), _snapshot=self, _index=0)
+
+	def children_of(self, i: int) -> Dict[str, Classifier]:
+		_, _, first, count = self._record(i)
+		out: Dict[str, Classifier] = {}
+		for j in range(first, first + count):
+			off, length, _, _ = self._record(j)
+			value = self._value(off, length)
+			out[value] = Classifier(value, _snapshot=self, _index=j)
+		return out
+
+if __name__ == "__main__":
+	catalog = sys.argv[1] if len(sys.argv) > 1 else 'corporate_classifier.csv'
+	root = Classifier.from_csv(catalog)
+	root.save_snapshot(catalog + SNAPSHOT_SUFFIX, source=os.stat(catalog))
+	print(f"{catalog}{SNAPSHOT_SUFFIX}: {len(root._children([]))} top-level categories")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Картинки marker'а на диске вместо словаря PIL-объектов в памяти.
+
+Ключи — имена из <img src="..."> в HTML marker'а, поэтому HTML не переписывается:
+ссылка на картинку в нём уже и есть её идентификатор. В памяти держатся только пути,
+изображение открывается с диска при обращении (PIL читает файл лениво).
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Dict, Iterator, Mapping, Optional
+
+
+def encode_image(image) -> bytes:
+	buf = io.BytesIO()
+	image.save(buf, format="PNG")
+	return buf.getvalue()
+
+def image_id(data: bytes) -> str:
+	return hashlib.sha256(data).hexdigest()
+
+class ImageStore(Mapping):
+	"""
+	Отображение имя -> PIL.Image, где картинки лежат файлами. root=None — временный каталог,
+	который удаляется вместе с хранилищем; одинаковые картинки пишутся один раз.
+	"""
+
+	def __init__(self, root: Optional[str] = None):
+		if root is None:
+			root = tempfile.mkdtemp(prefix="caterpillar-img-")
+			self._cleanup = weakref.finalize(self, shutil.rmtree, root, True)
+		else:
+			os.makedirs(root, exist_ok=True)
+		self.root = root
+		self._files: Dict[str, str] = {}
+
+	def add(self, name: str, data: bytes) -> str:
+		"""Сохраняет закодированную картинку; возвращает её id (хэш содержимого)."""
+		key = image_id(data)
+		path = os.path.join(self.root, key + ".png")
+		if not os.path.exists(path):
+			fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=self.root)
+			with os.fdopen(fd, "wb") as f:
+				f.write(data)
+			os.replace(tmp, path)
+		self._files[name] = path
+		return key
+
+	def add_file(self, name: str, path: str) -> None:
+		"""Картинка, которая уже лежит на диске (например, в кэше результатов)."""
+		self._files[name] = path
+
+	def path(self, name: str) -> str:
+		return self._files[name]
+
+	def __getitem__(self, name: str):
+		from PIL import Image
+		return Image.open(self._files[name])
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self._files)
+
+	def __len__(self) -> int:
+		return len(self._files)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Переиспользование KV-кэша llama.cpp для общего префикса промпта (system + документ).
+
+Движок guidance для llama.cpp сам сравнивает новый промпт с последним вычисленным
+и досчитывает только расхождение. PrefixCache делает этот префикс явным:
+ветки (уровни классификатора, стадии разбора) запускаются от одного состояния,
+а при необходимости состояние llama.cpp снимается и восстанавливается целиком.
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import profiling
+
+
+def llama_engine(lm) -> Optional[Any]:
+	"""Движок LlamaCpp под guidance-моделью (атрибут отличается между версиями guidance); None для прочих бэкендов."""
+	engine = getattr(lm, "engine", None)
+	if engine is None:
+		engine = getattr(getattr(lm, "_interpreter", None), "engine", None)
+	if engine is None or not hasattr(engine, "model_obj"):
+		return None
+	return engine
+
+# Имя списка закэшированных токенов в движке: guidance до 0.2.1 — _cache_token_ids, с 0.2.2 — _cached_token_ids
+_TOKEN_ATTRS = ("_cache_token_ids", "_cached_token_ids")
+
+def token_attr(engine) -> Optional[str]:
+	"""Атрибут движка со списком токенов в KV-кэше; None, если версия guidance его не ведёт."""
+	if engine is None:
+		return None
+	for name in _TOKEN_ATTRS:
+		if isinstance(getattr(engine, name, None), list):
+			return name
+	return None
+
+def reset_cache(lm) -> bool:
+	"""Забывает закэшированный префикс: следующий вызов движка считает промпт с нуля. False — сбрасывать нечего."""
+	engine = llama_engine(lm)
+	attr = token_attr(engine)
+	if attr is None:
+		return False
+	setattr(engine, attr, [])
+	return True
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+	n = min(len(a), len(b))
+	i = 0
+	while i < n and a[i] == b[i]:
+		i += 1
+	return i
+
+@dataclass
+class PrefillStats:
+	branches: int = 0
+	tokens_reused: int = 0
+	tokens_evaluated: int = 0  # префилл + сгенерированные токены
+
+	def __iadd__(self, other: "PrefillStats") -> "PrefillStats":
+		self.branches += other.branches
+		self.tokens_reused += other.tokens_reused
+		self.tokens_evaluated += other.tokens_evaluated
+		return self
+
+class PrefixCache:
+	"""
+	Общий префикс для нескольких веток генерации.
+
+	reuse=False сбрасывает кэш движка перед каждой веткой — так выглядит прогон без переиспользования,
+	полезно для сравнения. snapshot=True после первой ветки сохраняет состояние llama.cpp
+	(save_state копирует весь использованный KV — для 40k токенов это гигабайты RAM) и
+	восстанавливает его, если между ветками движком пользовался кто-то ещё.
+	"""
+
+	def __init__(self, lm, *, reuse: bool = True, snapshot: bool = False):
+		self.engine = llama_engine(lm)
+		self._attr = token_attr(self.engine)
+		self.reuse = reuse
+		self.snapshot = snapshot
+		self.stats = PrefillStats()
+		self._state = None
+		self._state_tokens: Optional[List[int]] = None
+		self._last_tokens: Optional[List[int]] = None
+
+	@property
+	def _cached(self) -> List[int]:
+		return list(getattr(self.engine, self._attr))
+
+	def _restore(self) -> None:
+		self.engine.model_obj.load_state(self._state)
+		setattr(self.engine, self._attr, list(self._state_tokens))
+
+	@contextmanager
+	def branch(self):
+		"""Оборачивает одну генерацию, начинающуюся с общего префикса."""
+		if self._attr is None:
+			# Не llama.cpp (например, удалённый API) или незнакомая версия движка — кэшем управлять нечем
+			yield
+			return
+		if not self.reuse:
+			setattr(self.engine, self._attr, [])
+		elif self._state is not None and self._cached != self._last_tokens:
+			# Между ветками движок считал чужой промпт — возвращаем свой префикс
+			self._restore()
+		before = self._cached
+
+		yield
+
+		after = self._cached
+		reused = _common_prefix(before, after)
+		self.stats.branches += 1
+		self.stats.tokens_reused += reused
+		self.stats.tokens_evaluated += len(after) - reused
+		profiling.count(prompt_tokens_reused=reused, tokens_evaluated=len(after) - reused)
+		if self.reuse and self.snapshot and self._state is None:
+			self._state = self.engine.model_obj.save_state()
+			self._state_tokens = after
+		self._last_tokens = after
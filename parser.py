@@ -1,36 +1,402 @@
 #!/usr/bin/env python3
 
 
-from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
 from datetime import date
+import gc
+import json
+import os
+import queue
+import re
 import sys
-from turtle import title
-from typing import Dict, Generator, List, Optional, Tuple, Union
+import threading
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
 import textwrap
 from pydantic import BaseModel, Field, ConfigDict, field_validator
-from marker.converters.pdf import PdfConverter
-from marker.models import create_model_dict
-from marker.config.parser import ConfigParser
 from guidance.models import LlamaCpp
 from guidance import system, user, assistant, gen,  special_token, select, sequence
-from guidance import json as gjson
-import csv
-from chat_template import Qwen3ChatTemplate, md_list, thoughts
+from chat_template import Qwen3ChatTemplate, ReasoningPolicy, json_grammar, md_list, reason, thoughts
+from classifier import Classifier
+from kvcache import PrefixCache, llama_engine
+import profiling
+import speculative
+from xml_writer import render_document, stream_document_xml
+from cache import DEFAULT_MAX_BYTES, ResultCache, content_key, file_digest, model_fingerprint
+from chunking import (
+	Chunk, find_heading, heading_key, heading_level, html_blocks, intro_digest, iter_chunks, iter_chunks_stream, normalize_text,
+	number_blocks, stitch_windows, text_digest, visible_text,
+)
+from tables import extract_tables, placeholder, placeholder_ids
+from images import ImageStore, encode_image, image_id
+import llama_cpp
 from llama_cpp import Llama
 
 
-converter = PdfConverter(
-	artifact_dict=create_model_dict(),
-)
+MODEL_PATH = "models/Qwen3-4B-Thinking-2507-F16.gguf"
+CLASSIFIER_CSV = "corporate_classifier.csv"
+N_CTX = 45000
+# Бюджет чанка оставляет в контексте место под инструкции стадий и ответ модели
+CHUNK_TOKENS = 25_000
+CHUNK_OVERLAP_TOKENS = 1_000
+# Запас контекста сверх самого длинного чанка и бюджета <think>: system, инструкции стадий и JSON-ответ
+CTX_RESERVE_TOKENS = 8192
 
-cfg = ConfigParser({"output_format": "html"})
-converter = PdfConverter(
-	artifact_dict=create_model_dict(),
-	config=cfg.generate_config_dict(),
-	processor_list=cfg.get_processors(),
-	renderer=cfg.get_renderer(),
-	llm_service=cfg.get_llm_service()
-)
+@dataclass(frozen=True)
+class ContextTier:
+	"""
+	Размер контекста и тип K/V-кэша llama.cpp (f16, q8_0, q4_0) для документов, которые в него помещаются.
+	workers — сколько процессов пула разделов держать на этом ярусе вместо общего --workers (0 — как общий):
+	малому KV-кэшу на хосте помещается больше процессов.
+	"""
+	n_ctx: int
+	kv_type: str = "f16"
+	workers: int = 0
+
+	def llama_kwargs(self) -> Dict[str, Any]:
+		if self.kv_type == "f16":
+			return {}
+		ggml_type = getattr(llama_cpp, f"GGML_TYPE_{self.kv_type.upper()}")
+		# Квантованный V-кэш llama.cpp поддерживает только с flash attention
+		return {"type_k": ggml_type, "type_v": ggml_type, "flash_attn": True}
+
+	def pool_size(self, workers: int) -> int:
+		return self.workers or workers
+
+	@classmethod
+	def parse(cls, spec: str) -> "ContextTier":
+		"""'16384', '32768:q8_0' или с числом процессов пула: '12288x4', '20480:f16x2'."""
+		spec, _, workers = spec.partition("x")
+		n_ctx, _, kv_type = spec.partition(":")
+		return cls(int(n_ctx), kv_type or "f16", int(workers or 0))
+
+	def spec(self) -> str:
+		return f"{self.n_ctx}:{self.kv_type}" + (f"x{self.workers}" if self.workers else "")
+
+# Маленькому документу — маленький KV-кэш: самый длинный чанк (не больше CHUNK_TOKENS), бюджет <think> и запас
+CTX_TIERS = (ContextTier(12288), ContextTier(20480), ContextTier(32768, "q8_0"), ContextTier(N_CTX, "q8_0"))
+
+# Реестр тяжёлых объектов процесса: каждый создаётся один раз, при первом обращении.
+_RESIDENT: Dict[Tuple, Any] = {}
+_RESIDENT_LOCK = threading.RLock()
+
+def _resident(key: Tuple, factory: Callable[[], Any]) -> Any:
+	obj = _RESIDENT.get(key)
+	if obj is None:
+		with _RESIDENT_LOCK:
+			obj = _RESIDENT.get(key)
+			if obj is None:
+				obj = factory()
+				_RESIDENT[key] = obj
+	return obj
+
+def _marker_models() -> Dict[str, Any]:
+	# marker тянет torch и веса моделей — импортируем только когда конвертер реально нужен
+	from marker.models import create_model_dict
+	return _resident(("marker_models",), create_model_dict)
+
+def _build_converter(page_range: Optional[str] = None):
+	from marker.converters.pdf import PdfConverter
+	from marker.config.parser import ConfigParser
+
+	options = {"output_format": "html"}
+	if page_range is not None:
+		options["page_range"] = page_range
+	cfg = ConfigParser(options)
+	return PdfConverter(
+		artifact_dict=_marker_models(),
+		config=cfg.generate_config_dict(),
+		processor_list=cfg.get_processors(),
+		renderer=cfg.get_renderer(),
+		llm_service=cfg.get_llm_service()
+	)
+
+def get_converter():
+	"""PdfConverter marker'а с HTML-рендерером, общий для всего процесса."""
+	return _resident(("converter",), _build_converter)
+
+def get_lm(model_path: Optional[str] = None, n_ctx: int = N_CTX, **llama_kwargs) -> LlamaCpp:
+	"""
+	Guidance-модель llama.cpp; состояние не накапливает, поэтому её можно переиспользовать между документами.
+	model_path по умолчанию — SETTINGS.model_path.
+	llama_kwargs уходят в llama_cpp.Llama (n_threads, ...) и входят в ключ реестра.
+	"""
+	model_path = model_path or SETTINGS.model_path
+	return _resident(_lm_key(model_path, n_ctx, llama_kwargs), lambda: _build_lm(model_path, n_ctx, llama_kwargs))
+
+def _lm_key(model_path: str, n_ctx: int, llama_kwargs: Dict[str, Any]) -> Tuple:
+	return ("lm", model_path, n_ctx, tuple(sorted(llama_kwargs.items())), SETTINGS.draft, SETTINGS.draft_tokens)
+
+def _build_lm(model_path: str, n_ctx: int, llama_kwargs: Dict[str, Any]) -> LlamaCpp:
+	lm = LlamaCpp(
+		model=model_path,
+		chat_template=Qwen3ChatTemplate,
+		n_ctx=n_ctx,
+		echo=True,
+		n_gpu_layers=-1,
+		**llama_kwargs)
+	if SETTINGS.draft:
+		drafter = speculative.parse_draft(SETTINGS.draft, num_pred_tokens=SETTINGS.draft_tokens, n_ctx=n_ctx)
+		speculative.enable(lm, drafter)
+	return lm
+
+# Ключи реестра, загруженные по ярусам контекста, от давно не использованных к недавним
+_TIERED: "OrderedDict[Tuple, Optional[Callable[[Any], None]]]" = OrderedDict()
+# Сколько разборов сейчас держат объект яруса (tier_models): занятый ярус не выгружается
+_TIER_LEASES: Dict[Tuple, int] = {}
+
+def _use_tier(key: Tuple, close: Optional[Callable[[Any], None]] = None, *, lease: bool = False) -> None:
+	"""
+	Отмечает ключ яруса как используемый (lease — ещё и занимает его) и выгружает лишние
+	свободные ярусы того же рода до загрузки нового, чтобы два яруса не жили в памяти сразу.
+	"""
+	with _RESIDENT_LOCK:
+		_TIERED[key] = close
+		_TIERED.move_to_end(key)
+		if lease:
+			_TIER_LEASES[key] = _TIER_LEASES.get(key, 0) + 1
+	_evict_tiers(key[0])
+
+def _release_tier(key: Tuple) -> None:
+	with _RESIDENT_LOCK:
+		left = _TIER_LEASES.pop(key, 0) - 1
+		if left > 0:
+			_TIER_LEASES[key] = left
+	_evict_tiers(key[0])
+
+def _evict_tiers(kind: str) -> None:
+	"""
+	Выгружает самые старые ярусы рода kind сверх SETTINGS.resident_tiers, но только свободные:
+	пул, которым пользуется разбор, не останавливается под ним, а модель не остаётся жить в его
+	генераторах. Если все ярусы заняты, лишний выгружается, когда его отпустят (_release_tier).
+	"""
+	evicted = []
+	with _RESIDENT_LOCK:
+		same_kind = [k for k in _TIERED if k[0] == kind]
+		excess = len(same_kind) - SETTINGS.resident_tiers
+		for old in same_kind:
+			if excess <= 0:
+				break
+			if _TIER_LEASES.get(old):
+				continue
+			evicted.append((_TIERED.pop(old), _RESIDENT.pop(old, None)))
+			excess -= 1
+		for closer, obj in evicted:
+			if obj is not None and closer is not None:
+				closer(obj)
+	if evicted:
+		gc.collect()  # веса и KV-кэш освобождаются вместе с последней ссылкой на модель
+
+def context_tier(tok, html: str) -> ContextTier:
+	"""
+	Наименьший ярус, куда помещается самый длинный чанк документа с маркерами блоков (<!--bN-->,
+	как его видит стадия разделов), самый большой бюджет <think> по SETTINGS.reasoning и запас
+	CTX_RESERVE_TOKENS. Считается по HTML как есть, с таблицами, — то есть с запасом. Стадии без
+	потолка рассуждений (по умолчанию) может не хватить любого яруса — им достаётся наибольший.
+	"""
+	raw = count_tokens(tok, html)
+	numbered = count_tokens(tok, number_blocks(html))
+	# Чанки режутся по HTML без маркеров: доля маркеров в чанке — как во всём документе
+	chunk = numbered if raw <= CHUNK_TOKENS else -(-CHUNK_TOKENS * numbered // max(raw, 1))
+	budgets = [SETTINGS.reasoning.get(stage, ReasoningPolicy()).budget(chunk) for stage in REASONING_STAGES]
+	if None in budgets:
+		return SETTINGS.ctx_tiers[-1]
+	needed = chunk + max(budgets) + CTX_RESERVE_TOKENS
+	for tier in SETTINGS.ctx_tiers:
+		if needed <= tier.n_ctx:
+			return tier
+	return SETTINGS.ctx_tiers[-1]
+
+def get_lm_for(tier: ContextTier, model_path: Optional[str] = None) -> LlamaCpp:
+	"""
+	Модель яруса из пула без аренды (прогрев); свободные ярусы сверх SETTINGS.resident_tiers
+	выгружаются. Для разбора — tier_models.
+	"""
+	kwargs = tier.llama_kwargs()
+	_use_tier(_lm_key(model_path or SETTINGS.model_path, tier.n_ctx, kwargs))
+	return get_lm(model_path, tier.n_ctx, **kwargs)
+
+def get_tokenizer(model_path: Optional[str] = None) -> Llama:
+	"""Только словарь модели — для подсчёта токенов без загрузки весов."""
+	model_path = model_path or SETTINGS.model_path
+	return _resident(("tok", model_path), lambda: Llama(model_path=model_path, vocab_only=True, verbose=False))
+
+def get_classifier(catalog: str = CLASSIFIER_CSV) -> Classifier:
+	return _resident(("classifier", catalog), lambda: Classifier.load(catalog))
+
+@dataclass
+class Settings:
+	"""Настройки стадий, которые меняются из CLI; дочерние процессы получают копию."""
+	# "levels" — по генерации на уровень классификатора, "trie" — весь путь одной генерацией
+	classify_mode: str = "levels"
+	# GGUF по умолчанию для get_lm/get_tokenizer и пула разделов
+	model_path: str = MODEL_PATH
+	# Потолок приватной памяти процесса (МБ) — проверяется перед каждым вызовом модели; None — без потолка
+	memory_limit_mb: Optional[int] = None
+	# Куда складывать картинки marker'а; None — временный каталог на время жизни ImageStore
+	image_dir: Optional[str] = None
+	# Спекулятивное декодирование: None — выключено, "lookup" — черновик из промпта, иначе путь к черновой GGUF
+	draft: Optional[str] = None
+	draft_tokens: int = 8
+	# Ярусы контекста по возрастанию: документ разбирается моделью наименьшего подходящего яруса
+	ctx_tiers: Tuple[ContextTier, ...] = CTX_TIERS
+	# Сколько ярусов держать загруженными одновременно; остальные выгружаются
+	resident_tiers: int = 1
+	# Страниц в окне marker'а: разбор начинается, пока конвертируются следующие окна; 0 — весь PDF одним вызовом
+	page_window: int = 0
+	# Бюджет <think> по стадиям: classify, metainfo, sections; нет записи — без ограничений
+	reasoning: Dict[str, ReasoningPolicy] = field(default_factory=dict)
+
+SETTINGS = Settings()
+
+REASONING_STAGES = ("classify", "metainfo", "sections")
+
+@dataclass
+class ReasoningStats:
+	calls: int = 0
+	input_tokens: int = 0
+	thought_tokens: int = 0
+	budget_hits: int = 0  # сколько раз рассуждение упёрлось в бюджет
+
+	def add(self, other: "ReasoningStats") -> None:
+		self.calls += other.calls
+		self.input_tokens += other.input_tokens
+		self.thought_tokens += other.thought_tokens
+		self.budget_hits += other.budget_hits
+
+_REASONING_STATS: Dict[str, ReasoningStats] = {}
+_REASONING_LOCK = threading.Lock()
+
+def reasoning_stats() -> Dict[str, Dict[str, int]]:
+	"""Накопленные с начала процесса (или reset) токены рассуждений по стадиям."""
+	with _REASONING_LOCK:
+		return {stage: dict(vars(st)) for stage, st in _REASONING_STATS.items()}
+
+def reset_reasoning_stats() -> None:
+	with _REASONING_LOCK:
+		_REASONING_STATS.clear()
+
+def _record_reasoning(stage: str, delta: ReasoningStats) -> None:
+	with _REASONING_LOCK:
+		_REASONING_STATS.setdefault(stage, ReasoningStats()).add(delta)
+
+def _reasoning_budget(stage: str, text: str) -> Tuple[Optional[int], int]:
+	"""Бюджет <think> для стадии и размер её входа в токенах (считается только если нужен)."""
+	policy = SETTINGS.reasoning.get(stage, ReasoningPolicy())
+	input_tokens = count_tokens(get_tokenizer(), text) if policy.needs_input_size else 0
+	return policy.budget(input_tokens), input_tokens
+
+def _think(stage: str, lm, text: str):
+	"""<think>-блок стадии по её политике; учёт токенов — в _REASONING_STATS."""
+	budget, input_tokens = _reasoning_budget(stage, text)
+	lm = reason(lm, budget)
+	thoughts_text = lm["thoughts"] if budget != 0 else ""
+	used = count_tokens(get_tokenizer(), thoughts_text) if thoughts_text else 0
+	_record_reasoning(stage, ReasoningStats(1, input_tokens, used, int(budget is not None and used >= budget)))
+	profiling.count(generated_tokens=used, thought_tokens=used)
+	return lm
+
+def _count_generated(text: str) -> None:
+	"""Токены ответа стадии (кроме рассуждений) — только для профиля, без него не токенизируем."""
+	if text and profiling.enabled():
+		profiling.count(generated_tokens=count_tokens(get_tokenizer(), text))
+
+def configure(**changes) -> Settings:
+	for name, value in changes.items():
+		if not hasattr(SETTINGS, name):
+			raise TypeError(f"unknown setting: {name}")
+		setattr(SETTINGS, name, value)
+	return SETTINGS
+
+# Отмена разбора извне (см. aio.py): флаг в contextvar проверяется перед каждым вызовом модели.
+# Уже идущая генерация llama.cpp не прерывается — разбор останавливается на следующей проверке.
+class Cancelled(Exception):
+	"""Разбор документа отменён вызывающим кодом."""
+
+_CANCEL: ContextVar[Optional[threading.Event]] = ContextVar("caterpillar_cancel", default=None)
+
+def set_cancel_event(event: Optional[threading.Event]) -> None:
+	"""Привязывает флаг отмены к текущему контексту (для потока — через contextvars.Context.run)."""
+	_CANCEL.set(event)
+
+def check_cancelled() -> None:
+	event = _CANCEL.get()
+	if event is not None and event.is_set():
+		raise Cancelled()
+
+class MemoryLimitExceeded(MemoryError):
+	"""Приватная память процесса выше SETTINGS.memory_limit_mb даже после сборки мусора."""
+
+def _malloc_trim() -> None:
+	# glibc не возвращает освобождённые арены ядру сама; на других libc просто пропускаем
+	try:
+		import ctypes
+		ctypes.CDLL("libc.so.6").malloc_trim(0)
+	except (OSError, AttributeError):
+		pass
+
+def check_memory() -> None:
+	limit = SETTINGS.memory_limit_mb
+	if not limit or profiling.private_rss_kb() <= limit * 1024:
+		return
+	gc.collect()
+	_malloc_trim()
+	used = profiling.private_rss_kb()
+	if used > limit * 1024:
+		raise MemoryLimitExceeded(f"private RSS {used // 1024} MiB exceeds the {limit} MiB limit")
+
+def checkpoint() -> None:
+	"""Перед каждым вызовом модели: отмена разбора и потолок памяти."""
+	check_cancelled()
+	check_memory()
+
+# Версии промптов стадий: увеличивать при любой правке промпта, иначе кэш вернёт старые ответы
+PROMPT_VERSION = {"classify": 2, "classify_trie": 2, "metainfo": 2, "sections": 3}
+
+_RESULT_CACHE: Optional[ResultCache] = None
+
+def configure_cache(cache_dir: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+	"""Включает (или выключает при None) дисковый кэш результатов для этого процесса."""
+	global _RESULT_CACHE
+	_RESULT_CACHE = ResultCache(cache_dir, max_bytes) if cache_dir else None
+
+def cache_args() -> Tuple[Optional[str], int]:
+	# Для передачи настроек кэша в дочерние процессы
+	if _RESULT_CACHE is None:
+		return None, DEFAULT_MAX_BYTES
+	return _RESULT_CACHE.root, _RESULT_CACHE.max_bytes
+
+def _model_key(lm) -> str:
+	engine = llama_engine(lm)
+	model = getattr(engine, "model_obj", None)
+	path = getattr(model, "model_path", None) or SETTINGS.model_path
+	key = model_fingerprint(path) if os.path.exists(path) else path
+	# Квантованный KV-кэш немного меняет логиты — такие ответы кэшируются отдельно
+	type_k = getattr(getattr(model, "context_params", None), "type_k", llama_cpp.GGML_TYPE_F16)
+	if type_k != llama_cpp.GGML_TYPE_F16:
+		key += f":kv{type_k}"
+	return key
+
+def _stage_key(stage: str, lm, *parts) -> Optional[str]:
+	if _RESULT_CACHE is None:
+		return None
+	# Бюджет рассуждений меняет ответ, поэтому входит в ключ (без политики ключи прежние)
+	policy = SETTINGS.reasoning.get(stage.split("_")[0])
+	if policy is not None:
+		parts += (repr(policy),)
+	return content_key(stage, PROMPT_VERSION[stage], _model_key(lm), *parts)
+
+def warmup(*, converter: bool = True, llm: bool = True, classifier: bool = True) -> None:
+	"""Заранее загружает тяжёлые объекты, чтобы первый документ в долгоживущем воркере не платил за старт."""
+	if converter:
+		get_converter()
+	if llm:
+		get_lm_for(SETTINGS.ctx_tiers[0])
+		get_tokenizer()
+	if classifier:
+		get_classifier()
 
 class Header(BaseModel):
 	title: str
@@ -54,102 +420,28 @@ class Header(BaseModel):
 				out.append(s)
 		return out
 
-class Classifier:
-	def __init__(self, value: str):
-		self.value = value
-		self.children: List['Classifier'] = []
-
-	def _children(self, path: List[str]):
-		if not path:
-			return self.children
-		for child in self.children:
-			if child.value == path[0]:
-				return child._children(path[1:])
-		return []
-
-	def _append_child(self, path: List[str], value: str = "") -> bool:
-		# Удаляем пустые элементы пути по краям и в середине
-		path = [p for p in path if p]  # фильтруем '', None
-
-		if not path:
-			return True
-
-		# Текущий узел должен совпадать с первым элементом пути
-		if self.value != path[0]:
-			return False
-
-		# Если путь заканчивается на текущем узле — ничего добавлять не надо
-		if len(path) == 1:
-			return True
-
-		# Дальше идём к/создаём узел со значением следующего уровня
-		next_key = path[1]
-
-		# Ищем уже существующего ребёнка
-		for child in self.children:
-			if child.value == next_key:
-				return child._append_child(path[1:], value)
-
-		# Не найден — создаём
-		new_child = Classifier(next_key)
-		self.children.append(new_child)
-		return new_child._append_child(path[1:], value)
-
-	def to_str(self, indent=0):
-		print('\t' * indent + self.value, '\n')
-		for child in self.children:
-			child.to_str(indent + 1)
-
-	@staticmethod
-	def from_csv(catalog='corporate_classifier.csv') -> 'Classifier':
-		root = Classifier('.')
-		with open(catalog, 'r', encoding='utf-8') as f:
-			reader = csv.reader(f)
-			next(reader)  # пропустить заголовок
-			for level1, level2, level3, level4, level5, description in reader:
-				# Строим путь из непустых уровней; точка — явный корень
-				path = ['.', level1, level2, level3, level4, level5]
-				path = [p for p in path if p]  # убираем пустые уровни
-				root._append_child(path)       # description НЕ используем для структуры
-		return root
-
-	def get_next_variants(self, path: List[str]) -> List[str]:
-		"""
-		Возвращает варианты следующего уровня для узла, заданного path.
-		path может начинаться с '.' или сразу с уровня 1.
-		"""
-		# нормализуем путь: уберём пустые и ведущую точку
-		path = [p for p in path if p and p != '.']
-
-		# Спускаемся по дереву согласно path
-		node = self
-		for key in path:
-			for child in node.children:
-				if child.value == key:
-					node = child
-					break
-			else:
-				return []  # не нашли указанный путь
-
-		# Возвращаем детей найденного узла
-		return [child.value for child in node.children]
-
 class TablePtr(BaseModel):
 	caption: str
 	raw_html: str
+	# id плейсхолдера <table data-source-id="..."/>, которым таблица заменена в тексте раздела
+	source_id: Optional[str] = None
 
 class SectionPtr(BaseModel):
 	heading: str
 	raw_html: str
 	base_level: int
 
+class ChildBlock(BaseModel):
+	"""Граница подраздела: сам HTML вырезается из исходника по номеру блока, модель его не переписывает."""
+	heading: str
+	start_block: int  # N из маркера <!--bN--> блока, с которого начинается подраздел
+
 class ExtractResult(BaseModel):
-	"""Что возвращает LLM для одного раздела: оболочка + сырые подглавы + сырые таблицы."""
+	"""Что возвращает LLM для одного раздела: оболочка + границы подглав. Таблицы модель видит только плейсхолдерами."""
 	heading: str
 	base_level: int
 	xml_shell: str
-	child_blocks: List[SectionPtr] = []
-	tables: List[TablePtr] = []
+	child_blocks: List[ChildBlock] = []
 
 class Section(BaseModel):
 	"""Итоговый узел дерева: оболочка + таблицы + рекурсивно распарсенные дети."""
@@ -158,54 +450,160 @@ class Section(BaseModel):
 	xml_shell: str
 	tables: List[TablePtr] = []
 	children: List["Section"] = []
+	# Хэши нормализованного текста исходного HTML раздела и его вступления (до первого подраздела) —
+	# по ним повторный разбор новой редакции документа находит неизменившиеся поддеревья
+	source_digest: Optional[str] = None
+	intro_digest: Optional[str] = None
 
+class DocumentTree(BaseModel):
+	"""Результат разбора в виде, пригодном для сохранения и инкрементального повторного разбора."""
+	header: Header
+	section: Section
 
-CLASSIFIER = Classifier.from_csv()
+DOCUMENT_SYSTEM = textwrap.dedent("""
+	You are a document analysis assistant. The next message contains a document (or a part of it) as raw HTML converted from PDF.
+	Every top-level block of the HTML is preceded by a numbered marker <!--bN-->.
+	Further messages give you tasks about this document; follow the instructions of the latest task exactly.
+""").strip()
 
-def classify_document(llm, html: str) -> Tuple[str]:
+def document_context(llm, html: str):
+	"""
+	Общий префикс всех стадий: нейтральная system-роль и сам документ.
+	Инструкции конкретной задачи идут после документа, поэтому префикс одинаков для
+	классификации, метаданных и разбора разделов и префиллится один раз.
+	"""
 	with system():
-		llm += textwrap.dedent(f'''
-			You are a document classifier. Check the following document against the given category.
+		llm += DOCUMENT_SYSTEM
+	with user():
+		llm += number_blocks(html)
+	return llm
+
+def classify_prompt(context, variants: List[str]):
+	with user():
+		context += textwrap.dedent('''
+			You are a document classifier. Check the document above against the given categories.
 			Use 'other' only if the document doesn't fit any existing category.
 
-			Document MetaInfo: 
+		''').lstrip()
+		context += "Choose the most appropriate category: " + '\n'.join(variants) + '\n\n'
+		context += "Category: "
+	return context
 
-			Document: 
-			
-			```
-				{html}
-			```
-		''')
+def _classifier_digest(catalog: str = CLASSIFIER_CSV) -> str:
+	return _resident(("digest", catalog), lambda: file_digest(catalog))
 
-	suffix = ["."]
+def classify_trie_prompt(context, classifier: Classifier):
+	with user():
+		context += textwrap.dedent('''
+			You are a document classifier. Check the document above against the category tree below.
+			Answer with the most specific fitting category as a path of its levels joined by '/', e.g. `level1/level2/level3`.
+			Stop at a higher level if no deeper category fits. Use 'other' only if the document doesn't fit any existing category.
 
-	while True:
-		variants = CLASSIFIER.get_next_variants(suffix)
-		if not variants:
-			break
+			Categories:
+		''').lstrip()
+		context += classifier.outline() + '\n\n'
+		context += "Category: "
+	return context
 
-		variants = ['/'.join(suffix + [variant]) for variant in variants] + ['other']
+def classify_paths(
+	llm,
+	html: str,
+	*,
+	top_k: int = 1,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+) -> List[Tuple[List[str], Optional[float]]]:
+	"""
+	Классификация одним проходом: одно рассуждение и весь путь под грамматикой префиксного дерева.
+	top_k > 1 — альтернативы: после рассуждения путь декодируется ещё раз с исключёнными уже
+	найденными путями (рассуждение и промпт при этом в KV-кэше, досчитывается только путь).
+	Оценка — лог-вероятность выбора, если её отдаёт бэкенд guidance, иначе None.
+	Возвращает пути без корня '.'; 'other' — пустой путь.
+	"""
+	if context is None:
+		context = document_context(llm, html)
+	if prefix is None:
+		prefix = PrefixCache(llm)
+	classifier = get_classifier()
 
-		tlm = llm
-		with user():
-			tlm += "Choose the most appropriate category: " + '\n'.join(variants) + '\n\n'
-			tlm += "Category: "
+	results: List[Tuple[List[str], Optional[float]]] = []
+	exclude: set = set()
+	with prefix.branch():
+		tlm = classify_trie_prompt(context, classifier)
 		with assistant():
-			tlm += special_token("<think>") + '\n'
-			tlm += gen("thoughts")
-			tlm += special_token("</think>") + '\n'
-			tlm += select(name="category", options=variants)
-		selected = tlm['category'].split('/')[-1].strip()
-		if selected == 'other':
+			tlm = _think("classify", tlm, html)
+			for _ in range(top_k):
+				olm = tlm + classifier.path_grammar(exclude=frozenset(exclude))
+				path = olm["category_path"]
+				_count_generated(path)
+				score = olm.log_prob("category_path") if hasattr(olm, "log_prob") else None
+				results.append(([] if path == 'other' else classifier.resolve(path) or [], score))
+				exclude.add(path)
+	return results
+
+@profiling.traced("classify")
+def classify_document(
+	llm,
+	html: str,
+	*,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+	mode: Optional[str] = None,
+) -> Tuple[str]:
+	"""
+	Спускается по дереву классификатора, по одной генерации на уровень.
+	Все уровни начинаются с одного префикса (system + документ), поэтому документ
+	префиллится один раз, а на каждом уровне досчитывается только короткий user-ход.
+	mode="trie" (по умолчанию SETTINGS.classify_mode) — весь путь за одну генерацию, см. classify_paths.
+	"""
+	checkpoint()
+	mode = mode or SETTINGS.classify_mode
+	if mode not in ("levels", "trie"):
+		raise ValueError("mode must be 'levels' or 'trie'")
+	stage = "classify" if mode == "levels" else "classify_trie"
+	key = _stage_key(stage, llm, _classifier_digest(), html)
+	if key is not None and (hit := _RESULT_CACHE.get_json("classify", key)) is not None:
+		profiling.count(cache_hits=1)
+		return hit
+
+	if mode == "trie":
+		path = classify_paths(llm, html, context=context, prefix=prefix)[0][0]
+		if key is not None:
+			_RESULT_CACHE.put_json("classify", key, path)
+		return path
+
+	if context is None:
+		context = document_context(llm, html)
+	if prefix is None:
+		prefix = PrefixCache(llm)
+	suffix = ["."]
+
+	node = get_classifier()
+	while node.children:
+		variants, category = node.options(suffix)
+
+		with prefix.branch():
+			tlm = classify_prompt(context, variants)
+			with assistant():
+				tlm = _think("classify", tlm, html)
+				tlm += category
+		_count_generated(tlm['category'])
+		# Вариант сопоставляем с узлом по позиции: значения категорий могут содержать '/' и пробелы по краям.
+		# Последний вариант — 'other', как и ответ вне списка.
+		choice = variants.index(tlm['category']) if tlm['category'] in variants else len(variants) - 1
+		if choice == len(variants) - 1:
 			break
-		suffix.append(selected)
+		node = list(node.children.values())[choice]
+		suffix.append(node.value)
 
+	if key is not None:
+		_RESULT_CACHE.put_json("classify", key, suffix[1:])
 	return suffix[1:]
 
-def extract_metainfo(llm, document_class: str, html: str) -> Header:
-	with system():
-		llm += textwrap.dedent(f'''
-			You are a metadata extraction tool. From the provided HTML, extract global document-level metadata to JSON.
+def metainfo_prompt(context, document_class: List[str]):
+	with user():
+		context += textwrap.dedent(f'''
+			You are a metadata extraction tool. From the HTML document above, extract global document-level metadata to JSON.
 			Follow these rules:
 
 			- Prefer information in explicit metadata: <title>, <meta name="author">, <meta property="article:author">,
@@ -231,30 +629,55 @@ def extract_metainfo(llm, document_class: str, html: str) -> Header:
 				"document_class": [{', '.join([f'"{v}"' for v in document_class])}],
 			}}
 		'''.strip())
-	with user():
-		llm += html
-	with assistant():
-		llm += special_token("<think>") + "\n"
-		llm += gen("thoughts")
-		llm += special_token("</think>") + '\n'
-		llm += gjson(name="header", schema=Header, max_tokens=1024)
+	return context
 
-	return Header.model_validate_json(llm['header'])
+@profiling.traced("metainfo")
+def extract_metainfo(llm, document_class: str, html: str, *, context=None, prefix: Optional[PrefixCache] = None) -> Header:
+	checkpoint()
+	key = _stage_key("metainfo", llm, json.dumps(list(document_class), ensure_ascii=False), html)
+	if key is not None and (hit := _RESULT_CACHE.get("metainfo", key)) is not None:
+		profiling.count(cache_hits=1)
+		return Header.model_validate_json(hit)
 
-def normalize_table_stub(table: TablePtr) -> TablePtr:
-	"""Пока просто возвращает исходный HTML (на будущее подключите реальный нормализатор)."""
-	return ""
+	if context is None:
+		context = document_context(llm, html)
+	if prefix is None:
+		prefix = PrefixCache(llm)
+	with prefix.branch():
+		llm = metainfo_prompt(context, document_class)
+		with assistant():
+			llm = _think("metainfo", llm, html)
+			llm += json_grammar("header", Header, max_tokens=1024)
+
+	_count_generated(llm['header'])
+	if key is not None:
+		_RESULT_CACHE.put("metainfo", key, llm['header'].encode("utf-8"))
+	return Header.model_validate_json(llm['header'])
 
-def extract_sections(lm, section: SectionPtr, *, max_json_tokens: int = 2048) -> ExtractResult:
+@profiling.traced("tables")
+def split_tables(html: str) -> Tuple[str, Dict[str, TablePtr]]:
 	"""
-	Выполняет независимый прогон LLM для одного раздела.
-	lm — объект модели (например, LlamaCpp/OpenAI), НЕ «накапливаем» состояние.
+	Таблицы вырезаются из HTML до LLM и нормализуются без модели (rowspan/colspan -> сетка);
+	модель видит только плейсхолдеры <table data-source-id="..."/> и переносит их в оболочку.
 	"""
-	llm = lm
-	with system():
+	html, found = extract_tables(html)
+	return html, {t.source_id: TablePtr(caption=t.caption, raw_html=t.html, source_id=t.source_id) for t in found}
+
+def attach_tables(section: Section, tables: Dict[str, TablePtr]) -> Section:
+	"""Проставляет разделу и его потомкам таблицы по плейсхолдерам в их оболочках."""
+	own = {t.source_id: t for t in section.tables if t.source_id}
+	found = [tables.get(i) or own.get(i) for i in placeholder_ids(section.xml_shell)]
+	return section.model_copy(update={
+		"tables": [t for t in found if t is not None],
+		"children": [attach_tables(c, tables) for c in section.children],
+	})
+
+def sections_prompt(context, section: SectionPtr):
+	llm = context
+	with user():
 		llm += textwrap.dedent(f"""
-				You task is to split a given raw HTML into its logical section and (if present) child subsections. 
-				You also produce the section's own XML shell content WITHOUT embedding the child sections, and you extract raw tables for a dedicated table-normalizer.
+				You task is to split the raw HTML above into its logical section and (if present) child subsections. 
+				You also produce the section's own XML shell content WITHOUT embedding the child sections.
 				Raw HTML structure more visual: heading levels not reliable, some hidings may be omitted or wrong. So it must be switched to a logical structure at first.
 				The current block has the following heading: `<h{section.base_level}>{section.heading}</h{section.base_level}>`.
 				This section is a chapter or article. Current block may contains subsections.
@@ -266,8 +689,8 @@ def extract_sections(lm, section: SectionPtr, *, max_json_tokens: int = 2048) ->
 					- Keep links as <a>, images as <img>.
 					- Strip purely visual tags like <br>, preserve only logical structure of the block.
 					- DO NOT include child subsection bodies; DO include any inline content that belongs to THIS block only.
-					- Replace each original HTML <table> within THIS block (not <table> in child sections) with a placeholder: <table data-source-id="<appropriate table caption>" />.
-				- Child subsections must be returned as RAW HTML fragments, each with a heading, for recursive processing.
+					- Tables are already replaced with placeholders like <table data-source-id="t-..."/>. Copy each placeholder that belongs to THIS block (not to child sections) into the shell verbatim, at its place.
+				- Do NOT copy child subsections: return only where each one starts. start_block is the number N of the <!--bN--> marker of the block that opens the subsection (usually its heading). A subsection runs until the next one starts; list them in document order.
 				- You MAY correct minor typos. Do not invent facts.
 				- Output ONLY the JSON object defined below. No extra text or code fences.
 
@@ -279,126 +702,1028 @@ def extract_sections(lm, section: SectionPtr, *, max_json_tokens: int = 2048) ->
 					"child_blocks": [
 						{{
 							"heading": string,
-							"raw_html": string, // escaped string
-							"base_level": {min(section.base_level + 1, 6)}
-						}}
-					],
-					"tables": [
-						{{
-							"caption": string,
-							"raw_html": string
+							"start_block": int
 						}}
 					]
 				}}
 			""").strip()
+	return llm
 
-	with user():
-		llm += section.raw_html
+@profiling.traced("sections", "depth")
+def extract_sections(
+	lm,
+	section: SectionPtr,
+	*,
+	max_json_tokens: int = 2048,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+	depth: int = 0,
+) -> ExtractResult:
+	"""
+	Выполняет независимый прогон LLM для одного раздела.
+	lm — объект модели (например, LlamaCpp/OpenAI), НЕ «накапливаем» состояние.
+	context — уже собранный document_context с raw_html этого раздела (для корня — общий с остальными стадиями).
+	depth — глубина раздела в дереве, только для профиля.
+	"""
+	checkpoint()
+	key = _stage_key("sections", lm, section.heading, section.base_level, max_json_tokens, section.raw_html)
+	if key is not None and (hit := _RESULT_CACHE.get("sections", key)) is not None:
+		profiling.count(cache_hits=1)
+		return ExtractResult.model_validate_json(hit)
+
+	if context is None:
+		context = document_context(lm, section.raw_html)
+	if prefix is None:
+		prefix = PrefixCache(lm)
+
+	with prefix.branch():
+		llm = sections_prompt(context, section)
+		with assistant():
+			# Мыслительный блок: отдельная генерация под бюджетом стадии, затем JSON.
+			llm = _think("sections", llm, section.raw_html)
+
+			# Строго структурированный JSON
+			llm += json_grammar("section", ExtractResult, max_tokens=max_json_tokens)
 
-	with assistant():
-		# Мыслительный блок: отдельная генерация, затем JSON.
-		llm += special_token("<think>") + "\n"
-		llm += gen("thoughts")
-		llm += special_token("</think>") + "\n"
+	_count_generated(llm["section"])
+	result = ExtractResult.model_validate_json(llm["section"])
+	if key is not None:
+		_RESULT_CACHE.put("sections", key, llm["section"].encode("utf-8"))
+	return result
 
-		# Строго структурированный JSON
-		llm += gjson(name="section", schema=ExtractResult, max_tokens=max_json_tokens)
+def _depth_limit_section(section_ptr: SectionPtr) -> Section:
+	# Жёсткая защита от зацикливания/глубины
+	return Section(
+		heading=section_ptr.heading,
+		base_level=section_ptr.base_level,
+		xml_shell=f"<section><h{section_ptr.base_level}>{section_ptr.heading}</h{section_ptr.base_level}><p>[depth limit]</p></section>",
+		tables=[],
+		children=[]
+	)
+
+def _child_spans(section_ptr: SectionPtr, result: ExtractResult) -> List[Tuple[str, int, int]]:
+	"""
+	(заголовок, начало, конец) подразделов в raw_html раздела по номерам блоков, которые вернула
+	модель: подраздел идёт от своего блока до начала следующего, последний — до конца раздела.
+	Номера вне диапазона и не по возрастанию отбрасываются; единственный подраздел с нулевого
+	блока под заголовком самого раздела — тоже (это сам раздел). Единственный подраздел с другим
+	заголовком остаётся: чанк часто начинается прямо с заголовка раздела.
+	"""
+	html = section_ptr.raw_html
+	blocks = html_blocks(html)
+	starts: List[ChildBlock] = []
+	for child in result.child_blocks:
+		if 0 <= child.start_block < len(blocks) and (not starts or child.start_block > starts[-1].start_block):
+			starts.append(child)
+	if len(starts) == 1 and starts[0].start_block == 0 and heading_key(starts[0].heading) == heading_key(section_ptr.heading):
+		return []
+	return [
+		(child.heading, blocks[child.start_block].start, blocks[starts[n + 1].start_block].start if n + 1 < len(starts) else len(html))
+		for n, child in enumerate(starts)
+	]
+
+def _child_ptrs(section_ptr: SectionPtr, result: ExtractResult, skip_before: int = 0) -> Iterator[SectionPtr]:
+	"""
+	Подразделы по одному: raw_html подраздела — копия среза родителя (не view: SectionPtr хранит
+	строку), но делается, только когда до подраздела дошла очередь, так что при обходе в глубину
+	в памяти живёт одна копия на уровень, а не все подразделы сразу.
+	Подразделы, начинающиеся раньше смещения skip_before, пропускаются.
+	"""
+	next_level = min(section_ptr.base_level + 1, 6)
+	for heading, start, end in _child_spans(section_ptr, result):
+		if start < skip_before:
+			continue
+		yield SectionPtr(heading=heading, raw_html=section_ptr.raw_html[start:end], base_level=next_level)
 
-	print(llm["section"])
-	return ExtractResult.model_validate_json(llm["section"])
+def _keep_placeholders(section_ptr: SectionPtr, result: ExtractResult) -> str:
+	"""Плейсхолдеры таблиц раздела, потерянные моделью (и не ушедшие в подразделы), дописываем в конец оболочки."""
+	taken = set(placeholder_ids(result.xml_shell))
+	for _, start, end in _child_spans(section_ptr, result):
+		taken.update(placeholder_ids(section_ptr.raw_html, start, end))
+	missing = "".join(placeholder(i) for i in placeholder_ids(section_ptr.raw_html) if i not in taken)
+	return _append_shell(result.xml_shell, missing)
+
+def _append_shell(shell: str, extra: str) -> str:
+	"""Дописывает разметку в конец оболочки — внутрь закрывающего </section>, если он есть."""
+	if not extra:
+		return shell
+	if shell.rstrip().endswith("</section>"):
+		shell = shell.rstrip()
+		return shell[:-len("</section>")] + extra + "</section>"
+	return shell + extra
+
+_SHELL_HEAD_RE = re.compile(r"\s*<section\b[^>]*>\s*(?:<h[1-6]\b[^>]*>.*?</h[1-6]>)?", re.S)
+
+def _shell_body(shell: str) -> str:
+	"""Оболочка без обёртки <section> и своего заголовка — то, что дописывается к другому разделу."""
+	if (m := _SHELL_HEAD_RE.match(shell)) is None:
+		return shell.strip()
+	body = shell[m.end():].rstrip()
+	if body.endswith("</section>"):
+		body = body[:-len("</section>")]
+	return body.strip()
+
+def _assemble(section_ptr: SectionPtr, result: ExtractResult, children: List[Section]) -> Section:
+	# Таблицы проставляются по плейсхолдерам уже на уровне документа (attach_tables)
+	return Section(
+		heading=result.heading,
+		base_level=result.base_level,
+		xml_shell=_keep_placeholders(section_ptr, result),
+		children=children,
+		source_digest=text_digest(section_ptr.raw_html),
+		intro_digest=intro_digest(section_ptr.raw_html, children[0].heading) if children else None,
+	)
+
+def _reused(section_ptr: SectionPtr, reuse: Optional[Dict[str, Section]]) -> Optional[Section]:
+	if not reuse:
+		return None
+	return reuse.get(text_digest(section_ptr.raw_html))
 
 def parse_section_recursive(
 	llm,
 	section_ptr: SectionPtr,
 	*,
 	max_depth: int = 32,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+	reuse: Optional[Dict[str, Section]] = None,
 	_depth: int = 0
 ) -> Section:
+	"""
+	context/prefix относятся только к корню: дети получают собственный префикс со своим raw_html.
+	reuse — готовые разделы прошлого разбора по source_digest; совпавший раздел берётся целиком, без LLM.
+	"""
 	lm = llm
 	if _depth >= max_depth:
-		# Жёсткая защита от зацикливания/глубины
-		return Section(
-			heading=section_ptr.heading,
-			base_level=section_ptr.base_level,
-			xml_shell=f"<section><h{section_ptr.base_level}>{section_ptr.heading}</h{section_ptr.base_level}><p>[depth limit]</p></section>",
-			tables=[],
-			children=[]
-		)
+		return _depth_limit_section(section_ptr)
+	if (hit := _reused(section_ptr, reuse)) is not None:
+		return hit
 
 	# 1) LLM-разбор текущей главы
-	result = extract_sections(lm, section_ptr)
+	result = extract_sections(lm, section_ptr, context=context, prefix=prefix, depth=_depth)
 
-	# 2) Заглушечная нормализация таблиц
-	normalized_tables = [normalize_table_stub(t) for t in result.tables]
+	# 2) Рекурсия по подглавам
+	children = [
+		parse_section_recursive(lm, child_ptr, max_depth=max_depth, reuse=reuse, _depth=_depth + 1)
+		for child_ptr in _child_ptrs(section_ptr, result)
+	]
 
-	# 3) Рекурсия по подглавам
-	children: List[Section] = []
-	for child_ptr in result.child_blocks:
-		# Перепроверим уровень
-		next_level = min(section_ptr.base_level + 1, 6)
-		child_ptr = SectionPtr(
-			heading=child_ptr.heading,
-			raw_html=child_ptr.raw_html,
-			base_level=next_level
+	# 3) Собираем дерево
+	return _assemble(section_ptr, result, children)
+
+# Пул процессов для разбора разделов: в каждом процессе своя резидентная модель.
+# Процессы, а не потоки: guidance держит состояние ролей в глобальном контексте,
+# а отдельный процесс ещё и не делит GIL с токенизацией и грамматикой.
+_WORKER_LLAMA_KWARGS: Dict[str, Any] = {}
+
+def _section_worker_init(
+	model_path: str,
+	n_ctx: int,
+	llama_kwargs: Dict[str, Any],
+	cache_config: Tuple,
+	settings: Settings,
+) -> None:
+	configure_cache(*cache_config)
+	configure(**vars(settings))
+	_WORKER_LLAMA_KWARGS.update(model_path=model_path, n_ctx=n_ctx, **llama_kwargs)
+	get_lm(**_WORKER_LLAMA_KWARGS)
+
+def _section_worker_extract(ptr_json: str, depth: int, profiled: bool) -> Tuple[str, Dict[str, Dict[str, int]], List[Dict[str, Any]]]:
+	"""ExtractResult в JSON, прирост счётчиков рассуждений и стадии профиля — их сводит родительский процесс."""
+	reset_reasoning_stats()
+	ptr = SectionPtr.model_validate_json(ptr_json)
+	lm = get_lm(**_WORKER_LLAMA_KWARGS)
+	if not profiled:
+		return extract_sections(lm, ptr, depth=depth).model_dump_json(), reasoning_stats(), []
+	with profiling.profile() as prof:
+		result = extract_sections(lm, ptr, depth=depth).model_dump_json()
+	return result, reasoning_stats(), prof.spans()
+
+class SectionWorkers:
+	"""Пул из n процессов с моделью; каждый вызов extract_sections — независимая задача."""
+
+	def __init__(self, workers: int, model_path: Optional[str] = None, n_ctx: int = N_CTX, **llama_kwargs):
+		import multiprocessing
+		from concurrent.futures import ProcessPoolExecutor
+
+		if workers < 1:
+			raise ValueError("workers must be >= 1")
+		self.workers = workers
+		model_path = model_path or SETTINGS.model_path
+		# Делим ядра между процессами, чтобы llama.cpp не переподписывал CPU
+		llama_kwargs = {"n_threads": max(1, (multiprocessing.cpu_count() or 1) // workers), **llama_kwargs}
+		self._executor = ProcessPoolExecutor(
+			max_workers=workers,
+			mp_context=multiprocessing.get_context("spawn"),
+			initializer=_section_worker_init,
+			initargs=(model_path, n_ctx, llama_kwargs, cache_args(), SETTINGS),
 		)
-		child_node = parse_section_recursive(lm, child_ptr, max_depth=max_depth, _depth=_depth + 1)
-		children.append(child_node)
 
-	# 4) Собираем дерево
+	def submit(self, section_ptr: SectionPtr, depth: int = 0):
+		"""Future с (ExtractResult JSON, счётчики рассуждений воркера, стадии профиля воркера)."""
+		return self._executor.submit(_section_worker_extract, section_ptr.model_dump_json(), depth, profiling.enabled())
+
+	def shutdown(self) -> None:
+		self._executor.shutdown(wait=True, cancel_futures=True)
+
+def get_section_workers(workers: int, model_path: Optional[str] = None, n_ctx: int = N_CTX, **llama_kwargs) -> SectionWorkers:
+	model_path = model_path or SETTINGS.model_path
+	return _resident(_workers_key(workers, model_path, n_ctx, llama_kwargs), lambda: SectionWorkers(workers, model_path, n_ctx, **llama_kwargs))
+
+def _workers_key(workers: int, model_path: str, n_ctx: int, llama_kwargs: Dict[str, Any]) -> Tuple:
+	key = ("section_workers", workers, model_path, n_ctx)
+	return key + (tuple(sorted(llama_kwargs.items())),) if llama_kwargs else key
+
+@contextmanager
+def tier_models(tier: ContextTier, workers: int = 1, model_path: Optional[str] = None) -> Iterator[Tuple[LlamaCpp, Optional[SectionWorkers]]]:
+	"""
+	Модель яруса и, если на ярусе больше одного процесса (tier.pool_size(workers)), пул разделов
+	на время разбора одного документа. Пока они арендованы, ярус не выгружается; свободные ярусы
+	сверх SETTINGS.resident_tiers выгружаются до загрузки нового. После выхода вызывающий код не
+	должен держать ссылки на модель и пул — иначе выгруженный ярус останется в памяти.
+	"""
+	model_path = model_path or SETTINGS.model_path
+	kwargs = tier.llama_kwargs()
+	size = tier.pool_size(workers)
+	keys = [_lm_key(model_path, tier.n_ctx, kwargs)]
+	_use_tier(keys[0], lease=True)
+	try:
+		pool = None
+		if size > 1:
+			keys.append(_workers_key(size, model_path, tier.n_ctx, kwargs))
+			_use_tier(keys[1], SectionWorkers.shutdown, lease=True)
+			pool = get_section_workers(size, model_path, tier.n_ctx, **kwargs)
+		yield get_lm(model_path, tier.n_ctx, **kwargs), pool
+	finally:
+		for key in reversed(keys):
+			_release_tier(key)
+
+@dataclass
+class _PendingSection:
+	ptr: SectionPtr
+	depth: int
+	result: Optional[ExtractResult] = None
+	reused: Optional[Section] = None
+	children: List["_PendingSection"] = field(default_factory=list)
+
+def parse_section_parallel(
+	llm,
+	section_ptr: SectionPtr,
+	workers: SectionWorkers,
+	*,
+	max_depth: int = 32,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+	_depth: int = 0,
+) -> Section:
+	"""
+	То же дерево, что parse_section_recursive, но подразделы разбираются пулом процессов.
+	Корень считается в текущем процессе (он ветвится от общего префикса документа),
+	дальше каждый готовый раздел сразу отдаёт своих детей в пул, так что братья и
+	кузены идут параллельно. Дерево собирается в исходном порядке независимо от
+	порядка завершения задач.
+	"""
+	from concurrent.futures import FIRST_COMPLETED, wait
+
+	if _depth >= max_depth:
+		return _depth_limit_section(section_ptr)
+	if (hit := _reused(section_ptr, reuse)) is not None:
+		return hit
+	root = _PendingSection(section_ptr, _depth)
+	root.result = extract_sections(llm, section_ptr, context=context, prefix=prefix, depth=_depth)
+
+	pending = {}
+
+	def expand(node: _PendingSection) -> None:
+		node.children = [_PendingSection(p, node.depth + 1) for p in _child_ptrs(node.ptr, node.result)]
+		for child in node.children:
+			child.reused = _reused(child.ptr, reuse)
+			if child.reused is None and child.depth < max_depth:
+				pending[workers.submit(child.ptr, child.depth)] = child
+
+	expand(root)
+	try:
+		while pending:
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			checkpoint()
+			for fut in done:
+				node = pending.pop(fut)
+				result_json, stats, spans = fut.result()
+				for stage, delta in stats.items():
+					_record_reasoning(stage, ReasoningStats(**delta))
+				if spans and (prof := profiling.current()) is not None:
+					prof.merge(spans)
+				node.result = ExtractResult.model_validate_json(result_json)
+				expand(node)
+	finally:
+		for fut in pending:
+			fut.cancel()
+
+	def build(node: _PendingSection) -> Section:
+		if node.reused is not None:
+			return node.reused
+		if node.result is None:
+			return _depth_limit_section(node.ptr)
+		return _assemble(node.ptr, node.result, [build(c) for c in node.children])
+
+	return build(root)
+
+def parse_section_tree(llm, section_ptr: SectionPtr, *, workers: Optional[SectionWorkers] = None, **kwargs) -> Section:
+	if workers is None:
+		return parse_section_recursive(llm, section_ptr, **kwargs)
+	return parse_section_parallel(llm, section_ptr, workers, **kwargs)
+
+def count_tokens(tok, text: str) -> int:
+	return len(tok.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+def chunk_text(
+	text: str,
+	tok,
+	max_chunk_size: int = CHUNK_TOKENS,
+	overlap: int = CHUNK_OVERLAP_TOKENS,
+) -> Generator[str, None, None]:
+	"""
+	Режет HTML marker'а на чанки не больше max_chunk_size токенов по границам блоков
+	(предпочтительно перед заголовком), с перекрытием overlap токенов между соседними чанками.
+	Таблицы и абзацы не разрываются, поэтому и многобайтный UTF-8 не ломается.
+	"""
+	if not hasattr(tok, "tokenize"):
+		raise TypeError("tok must иметь метод tokenize(...) как у llama_cpp.Llama")
+
+	for chunk in iter_chunks(text, lambda s: count_tokens(tok, s), max_tokens=max_chunk_size, overlap_tokens=overlap):
+		yield chunk.text
+
+def chunk_stream(
+	pieces: Iterable[str],
+	tok,
+	max_chunk_size: int = CHUNK_TOKENS,
+	overlap: int = CHUNK_OVERLAP_TOKENS,
+) -> Generator[Chunk, None, None]:
+	"""
+	chunk_text для HTML, приходящего окнами страниц: чанк отдаётся, как только за ним появляется
+	продолжение. Отдаёт Chunk со смещениями в склеенном тексте — по ним видно перекрытие соседей.
+	"""
+	if not hasattr(tok, "tokenize"):
+		raise TypeError("tok must иметь метод tokenize(...) как у llama_cpp.Llama")
+
+	for chunk in iter_chunks_stream(pieces, lambda s: count_tokens(tok, s), max_tokens=max_chunk_size, overlap_tokens=overlap):
+		yield chunk
+
+def _merge_tables(a: List[TablePtr], b: List[TablePtr]) -> List[TablePtr]:
+	seen = {t.source_id or t.caption for t in a}
+	return a + [t for t in b if (t.source_id or t.caption) not in seen]
+
+def _merge_children(a: List[Section], b: List[Section]) -> List[Section]:
+	# Раздел, разрезанный границей чанка (или повторённый перекрытием), склеиваем по заголовку
+	if a and b and a[-1].heading.strip() == b[0].heading.strip():
+		return a[:-1] + [merge_sections(a[-1], b[0])] + b[1:]
+	return a + b
+
+def _append_text(section: Section, body: str) -> Section:
+	"""Дописывает текст в последний открытый подраздел — на конце раздела читался именно он."""
+	if not body:
+		return section
+	if section.children:
+		update = {"children": section.children[:-1] + [_append_text(section.children[-1], body)]}
+	else:
+		update = {"xml_shell": _append_shell(section.xml_shell, body)}
+	# Исходник раздела вырос: прежние хэши к нему больше не относятся
+	return section.model_copy(update={**update, "source_digest": None, "intro_digest": None})
+
+def merge_sections(a: Section, b: Section, html: Optional[str] = None) -> Section:
+	"""
+	Дописывает к разделу a его продолжение b из следующего чанка: раздел с тем же заголовком
+	или текст чанка до его первого нового раздела. Вступление b продолжает последний открытый
+	подраздел a, подразделы b добавляются к детям a (совпавший по заголовку сливается так же).
+	html — исходник слитого раздела: по нему пересчитываются source_digest/intro_digest, чтобы
+	повторный разбор мог взять раздел целиком; без него хэшей нет.
+	"""
+	merged = _append_text(a, _shell_body(b.xml_shell))
+	children = _merge_children(merged.children, b.children)
 	return Section(
-		heading=result.heading,
-		base_level=result.base_level,
-		xml_shell=result.xml_shell,
-		tables=normalized_tables,
-		children=children
+		heading=a.heading,
+		base_level=a.base_level,
+		xml_shell=merged.xml_shell,
+		tables=_merge_tables(a.tables, b.tables),
+		children=children,
+		source_digest=text_digest(html) if html is not None else None,
+		intro_digest=intro_digest(html, children[0].heading) if html is not None and children else None,
 	)
 
+def process_chunk(
+	lm,
+	chunk: str,
+	*,
+	prefix: Optional[PrefixCache] = None,
+	workers: Optional[SectionWorkers] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+) -> Tuple[Header, Section]:
+	"""
+	Классификация, метаданные и разбор корня — ветки от одного префикса с документом:
+	документ префиллится один раз, дальше считаются только инструкции стадий.
+	"""
+	context = document_context(lm, chunk)
+	if prefix is None:
+		prefix = PrefixCache(lm)
 
-
-def chunk_text(text: str, tok, max_chunk_size: int = 25_000) -> Generator[str, None, None]:
-	if max_chunk_size <= 0:
-		raise ValueError("max_chunk_size must be > 0")
-	if not hasattr(tok, "tokenize") or not hasattr(tok, "detokenize"):
-		raise TypeError("tok must иметь методы tokenize(...) и detokenize(...) как у llama_cpp.Llama")
-
-	# Токенизируем текст (без BOS, со спецтокенами)
-	token_ids = tok.tokenize(text.encode("utf-8"), add_bos=False, special=True)
-	n = len(token_ids)
-	if n == 0:
-		return  # пустой генератор
-
-	# Идём блоками по max_chunk_size токенов и детокенизируем каждый блок
-	for start in range(0, n, max_chunk_size):
-		end = min(start + max_chunk_size, n)
-		chunk_ids = token_ids[start:end]
-		# detokenize -> bytes; декодируем в UTF-8
-		chunk_text_bytes = tok.detokenize(chunk_ids)
-		# В норме это корректный UTF-8; используем strict, чтобы сохранить точность
-		chunk_str = chunk_text_bytes.decode("utf-8", errors="strict")
-		yield chunk_str
-
-def process_chunk(lm, chunk: str) -> str:
-	document_class = classify_document(lm, chunk)
-	header = extract_metainfo(lm, document_class, chunk)
+	document_class = classify_document(lm, chunk, context=context, prefix=prefix)
+	header = extract_metainfo(lm, document_class, chunk, context=context, prefix=prefix)
 	root_ptr = SectionPtr(heading=header.title, raw_html=chunk, base_level=1)
-	section = parse_section_recursive(lm, root_ptr)
+	section = parse_section_tree(lm, root_ptr, workers=workers, context=context, prefix=prefix, reuse=reuse)
 
 	return header, section
 
-def html(path: str, mime: Optional[str]):
-	document = converter(path)
+def iter_chunk_sections(
+	lm,
+	root_ptr: SectionPtr,
+	*,
+	workers: Optional[SectionWorkers] = None,
+	context=None,
+	prefix: Optional[PrefixCache] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+	max_depth: int = 32,
+	skip_before: int = 0,
+) -> Iterator[Union[ExtractResult, Section]]:
+	"""
+	Сначала ExtractResult корня, затем его подразделы по одному — как только готово поддерево.
+	Подразделы, начинающиеся раньше смещения skip_before (перекрытие с прошлым чанком), не разбираются.
+	"""
+	result = extract_sections(lm, root_ptr, context=context, prefix=prefix, depth=0)
+	yield result
+	for child_ptr in _child_ptrs(root_ptr, result, skip_before):
+		yield parse_section_tree(lm, child_ptr, workers=workers, reuse=reuse, max_depth=max_depth, _depth=1)
+
+@dataclass
+class DocumentStart:
+	"""Первое событие потока: всё, что нужно для пролога XML до разбора разделов."""
+	header: Header
+	root: Section  # оболочка корня без детей
+	# Заголовки верхнего уровня, известные после разбора корня первого чанка с разделами: у длинного
+	# документа это не всё оглавление, разделы следующих чанков в toc не попадают
+	toc: List[str]
+
+def iter_document(
+	lm,
+	tok,
+	html: str,
+	*,
+	max_chunk_tokens: int = CHUNK_TOKENS,
+	overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+	workers: Optional[SectionWorkers] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+	tables: Optional[Dict[str, TablePtr]] = None,
+) -> Iterator[Union[DocumentStart, Section]]:
+	"""
+	Потоковый разбор документа по чанкам, чтобы промпт не выходил за n_ctx: сначала
+	DocumentStart, затем готовые разделы верхнего уровня в порядке документа. Классификация
+	и метаданные берутся с первого чанка. Перекрытие с прошлым чанком модель видит как контекст,
+	но его разделы не разбираются повторно; текст чанка до первого нового раздела продолжает
+	раздел, открытый на конце прошлого чанка (пока разделов не было — корень, и DocumentStart
+	ждёт первого раздела). Последний раздел чанка придерживается до разбора следующего: если
+	тот начинается с того же заголовка, они сливаются. В памяти одновременно живёт не больше
+	пары поддеревьев верхнего уровня.
+	tables — таблицы, уже вырезанные из html через split_tables; без него вырезаются здесь.
+	"""
+	if tables is None:
+		html, tables = split_tables(html)
+	yield from _document_events(lm, chunk_stream([html], tok, max_chunk_tokens, overlap_tokens), workers=workers, reuse=reuse, tables=tables)
+
+def iter_document_windows(
+	lm,
+	tok,
+	windows: Iterable[str],
+	*,
+	max_chunk_tokens: int = CHUNK_TOKENS,
+	overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+	workers: Optional[SectionWorkers] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+	on_html: Optional[Callable[[str], None]] = None,
+) -> Iterator[Union[DocumentStart, Section]]:
+	"""
+	iter_document по HTML, который приходит окнами страниц (iter_pdf_windows): первый чанк
+	разбирается, как только набран, не дожидаясь конвертации остальных страниц. Чанки те же,
+	что у склеенного HTML. on_html получает каждое окно с плейсхолдерами таблиц — из них
+	склеивается html для document_root.
+	"""
+	tables: Dict[str, TablePtr] = {}
+
+	def pieces() -> Iterator[str]:
+		for window in windows:
+			# id таблицы зависит только от её содержимого, так что вырезать можно по окнам
+			stripped, found = split_tables(window)
+			tables.update(found)
+			if on_html is not None:
+				on_html(stripped)
+			yield stripped
+
+	chunks = chunk_stream(pieces(), tok, max_chunk_tokens, overlap_tokens)
+	yield from _document_events(lm, chunks, workers=workers, reuse=reuse, tables=tables)
+
+def _chunk_lead(lm, root_ptr: SectionPtr, root: ExtractResult, start: int, end: int, owner: Section, **kwargs) -> Optional[Section]:
+	"""
+	Текст чанка [start, end) до его первого нового раздела как продолжение раздела owner.
+	Продолжение корня без перекрытия — это оболочка корня чанка. Иначе фрагмент разбирается
+	отдельно: оболочка корня покрывает и перекрытие, уже разобранное с прошлым чанком, а
+	подразделы owner в ней не выделены.
+	"""
+	html = root_ptr.raw_html[start:end]
+	if not normalize_text(html):
+		return None
+	if start == 0 and owner.base_level == root_ptr.base_level:
+		return _assemble(root_ptr, root, [])
+	lead_ptr = SectionPtr(heading=owner.heading, raw_html=html, base_level=owner.base_level)
+	return parse_section_tree(lm, lead_ptr, _depth=1, **kwargs)
+
+def _document_events(
+	lm,
+	chunks: Iterable[Chunk],
+	*,
+	workers: Optional[SectionWorkers],
+	reuse: Optional[Dict[str, Section]],
+	tables: Dict[str, TablePtr],
+) -> Iterator[Union[DocumentStart, Section]]:
+	header, doc, held = None, None, None
+	# Исходный HTML придержанного раздела — по нему пересчитываются хэши после слияния; None — неизвестен
+	held_html: Optional[str] = None
+	started, prev_end = False, 0
+	for chunk in chunks:
+		# Начало чанка до конца прошлого — перекрытие: модели оно нужно как контекст, но уже разобрано
+		skip = max(0, prev_end - chunk.start) if header is not None else 0
+		prev_end = chunk.end
+		if header is None:
+			context = document_context(lm, chunk.text)
+			prefix = PrefixCache(lm)
+			document_class = classify_document(lm, chunk.text, context=context, prefix=prefix)
+			header = extract_metainfo(lm, document_class, chunk.text, context=context, prefix=prefix)
+			root_ptr = SectionPtr(heading=header.title, raw_html=chunk.text, base_level=1)
+			parts = iter_chunk_sections(lm, root_ptr, workers=workers, context=context, prefix=prefix, reuse=reuse)
+		else:
+			root_ptr = SectionPtr(heading=header.title, raw_html=chunk.text, base_level=1)
+			parts = iter_chunk_sections(lm, root_ptr, workers=workers, reuse=reuse, skip_before=skip)
+		root = next(parts)
+		spans = [span for span in _child_spans(root_ptr, root) if span[1] >= skip]
+
+		if doc is None:
+			doc = _assemble(root_ptr, root, [])
+		else:
+			end = spans[0][1] if spans else len(chunk.text)
+			lead = _chunk_lead(lm, root_ptr, root, skip, end, held or doc, workers=workers, reuse=reuse)
+			if lead is None:
+				pass
+			elif held is not None:
+				held_html = held_html + chunk.text[skip:end] if held_html is not None else None
+				held = merge_sections(held, lead, held_html)
+			else:
+				doc = merge_sections(doc, lead)
+		# Подразделы, найденные во вступлении корня, — тоже разделы верхнего уровня
+		found, doc = doc.children, doc.model_copy(update={"children": []})
+		if not started and (spans or found):
+			yield DocumentStart(header, attach_tables(doc, tables), [c.heading for c in found] + [heading for heading, _, _ in spans])
+			started = True
+		for child in found:
+			if held is not None:
+				yield attach_tables(held, tables)
+			held, held_html = child, None
+
+		last = len(spans) - 1
+		for i, child in enumerate(parts):
+			html = chunk.text[spans[i][1]:spans[i][2]]
+			if i == 0 and held is not None:
+				if heading_key(held.heading) == heading_key(child.heading):
+					html = held_html + html if held_html is not None else None
+					child = merge_sections(held, child, html)
+				else:
+					yield attach_tables(held, tables)
+				held = None
+			if i == last:
+				held, held_html = child, html
+			else:
+				yield attach_tables(child, tables)
+
+	if header is None:
+		raise ValueError("document is empty")
+	if not started:
+		yield DocumentStart(header, attach_tables(doc, tables), [])
+	if held is not None:
+		yield attach_tables(held, tables)
+
+def process_document(
+	lm,
+	tok,
+	html: str,
+	*,
+	max_chunk_tokens: int = CHUNK_TOKENS,
+	overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+	workers: Optional[SectionWorkers] = None,
+	reuse: Optional[Dict[str, Section]] = None,
+) -> Tuple[Header, Section]:
+	"""Разбор документа целиком в дерево (см. iter_document)."""
+	html, tables = split_tables(html)
+	events = iter_document(
+		lm, tok, html,
+		max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens, workers=workers, reuse=reuse, tables=tables,
+	)
+	start = next(events)
+	return start.header, document_root(start, list(events), html)
+
+def process_windows(
+	lm,
+	tok,
+	windows: Iterable[str],
+	*,
+	max_chunk_tokens: int = CHUNK_TOKENS,
+	overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+	workers: Optional[SectionWorkers] = None,
+) -> Tuple[Header, Section]:
+	"""Разбор документа, приходящего окнами страниц, целиком в дерево (см. iter_document_windows)."""
+	parts: List[str] = []
+	events = iter_document_windows(
+		lm, tok, windows,
+		max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens, workers=workers, on_html=parts.append,
+	)
+	start = next(events)
+	children = list(events)
+	return start.header, document_root(start, children, "".join(parts))
+
+def document_root(start: DocumentStart, children: List[Section], html: str) -> Section:
+	"""Корень дерева из событий iter_document; html — тот, что разбирался (с плейсхолдерами таблиц)."""
+	# Корень после слияния чанков описывает весь документ
+	return start.root.model_copy(update={
+		"children": children,
+		"source_digest": text_digest(html),
+		"intro_digest": intro_digest(html, children[0].heading) if children else None,
+	})
+
+def _index_sections(section: Section, out: Dict[str, Section]) -> Dict[str, Section]:
+	if section.source_digest:
+		out.setdefault(section.source_digest, section)
+	for child in section.children:
+		_index_sections(child, out)
+	return out
+
+def _parse_fragment(
+	lm,
+	tok,
+	ptr: SectionPtr,
+	*,
+	reuse: Dict[str, Section],
+	workers: Optional[SectionWorkers],
+	max_chunk_tokens: int,
+) -> Section:
+	"""
+	Разбор фрагмента документа как раздела. Фрагмент длиннее max_chunk_tokens не влезет в n_ctx
+	одним промптом: он режется chunk_stream без перекрытия, куски разбираются как продолжения
+	одного раздела и склеиваются merge_sections.
+	"""
+	if count_tokens(tok, ptr.raw_html) <= max_chunk_tokens:
+		return parse_section_tree(lm, ptr, workers=workers, reuse=reuse)
+	section = None
+	for chunk in chunk_stream([ptr.raw_html], tok, max_chunk_tokens, 0):
+		part_ptr = SectionPtr(heading=ptr.heading, raw_html=chunk.text, base_level=ptr.base_level)
+		part = parse_section_tree(lm, part_ptr, workers=workers, reuse=reuse)
+		section = part if section is None else merge_sections(section, part, ptr.raw_html[:chunk.end])
+	return section
+
+def reparse_section(
+	lm,
+	tok,
+	previous: Section,
+	html: str,
+	*,
+	reuse: Dict[str, Section],
+	workers: Optional[SectionWorkers] = None,
+	max_chunk_tokens: int = CHUNK_TOKENS,
+) -> Optional[Section]:
+	"""
+	Сопоставляет раздел прошлого разбора с его фрагментом html в новой редакции.
+	Текст не изменился — раздел возвращается как есть. Изменились только подразделы —
+	вступление остаётся, а заново разбираются лишь изменённые и новые подразделы
+	(новыми считаются незнакомые заголовки того же или более высокого уровня, что у
+	известных детей); подраздел длиннее max_chunk_tokens разбирается по чанкам.
+	Иначе возвращает None: раздел нужно разобрать целиком.
+	"""
+	if previous.source_digest == text_digest(html):
+		return previous
+	if not previous.children or previous.intro_digest is None:
+		return None
+	if intro_digest(html, previous.children[0].heading) != previous.intro_digest:
+		return None
+
+	blocks = html_blocks(html)
+	known: Dict[int, Section] = {}
+	pos = 0
+	for child in previous.children:
+		i = find_heading(html, blocks, child.heading, pos)
+		if i is None:
+			return None  # подраздел удалён или переименован
+		known[i] = child
+		pos = i + 1
+
+	first = min(known)
+	level = min(heading_level(blocks[i]) for i in known)
+	starts = sorted(set(known) | {
+		i for i in range(first, len(blocks))
+		if blocks[i].is_heading and heading_level(blocks[i]) <= level
+	})
+
+	children: List[Section] = []
+	child_level = min(previous.base_level + 1, 6)
+	for n, i in enumerate(starts):
+		end = blocks[starts[n + 1]].start if n + 1 < len(starts) else len(html)
+		fragment = html[blocks[i].start:end]
+		child = known.get(i)
+		node = None
+		if child is not None:
+			node = reparse_section(lm, tok, child, fragment, reuse=reuse, workers=workers, max_chunk_tokens=max_chunk_tokens)
+		if node is None:
+			heading = child.heading if child is not None else visible_text(html[blocks[i].start:blocks[i].end])
+			ptr = SectionPtr(heading=heading, raw_html=fragment, base_level=child_level)
+			node = _parse_fragment(lm, tok, ptr, reuse=reuse, workers=workers, max_chunk_tokens=max_chunk_tokens)
+		children.append(node)
+
+	return previous.model_copy(update={"children": children, "source_digest": text_digest(html)})
+
+def reparse_document(
+	lm,
+	tok,
+	previous: DocumentTree,
+	html: str,
+	*,
+	workers: Optional[SectionWorkers] = None,
+	**chunking,
+) -> Tuple[Header, Section]:
+	"""
+	Инкрементальный разбор новой редакции документа: LLM вызывается только для
+	изменившихся поддеревьев, остальное берётся из прошлого дерева. Если изменилось
+	вступление самого документа, он разбирается заново, но совпавшие разделы всё равно
+	переиспользуются по хэшу текста.
+	"""
+	reuse = _index_sections(previous.section, {})
+	stripped, tables = split_tables(html)
+	max_chunk_tokens = chunking.get("max_chunk_tokens", CHUNK_TOKENS)
+	section = reparse_section(lm, tok, previous.section, stripped, reuse=reuse, workers=workers, max_chunk_tokens=max_chunk_tokens)
+	if section is None:
+		return process_document(lm, tok, html, workers=workers, reuse=reuse, **chunking)
+	return previous.header, attach_tables(section, tables)
+
+def _marker_version() -> str:
+	from importlib.metadata import PackageNotFoundError, version
+	try:
+		return version("marker-pdf")
+	except PackageNotFoundError:
+		return "unknown"
+
+def _cached_conversion(key: str, store: ImageStore) -> Optional[str]:
+	hit = _RESULT_CACHE.get_json("marker", key)
+	if hit is None or "image_ids" not in hit:
+		return None
+	for name, image_key in hit["image_ids"].items():
+		path = _RESULT_CACHE.path("images", image_key)
+		if path is None:
+			return None  # картинку вытеснили из кэша — конвертируем заново
+		store.add_file(name, path)
+	profiling.count(cache_hits=1)
+	return hit["html"]
+
+def _convert(converter: Callable[[], Any], path: str, key: Optional[str], store: ImageStore) -> str:
+	"""
+	Один вызов marker'а (converter() строит конвертер, только если кэш промахнулся). Картинки
+	сразу уходят на диск (store, ключи — имена из <img src>), в памяти их не держим.
+	"""
+	if key is not None:
+		html = _cached_conversion(key, store)
+		if html is not None:
+			return html
+
+	document = converter()(path)
 	html, images = document.html, document.images
+	del document
+	image_ids = {}
+	while images:
+		name, image = images.popitem()
+		data = encode_image(image)
+		del image
+		image_ids[name] = store.add(name, data)
+		if key is not None:
+			_RESULT_CACHE.put("images", image_id(data), data)
+	if key is not None:
+		_RESULT_CACHE.put_json("marker", key, {"html": html, "image_ids": image_ids})
+	check_memory()
+	return html
+
+@profiling.traced("marker")
+def convert_pdf(path: str) -> Tuple[str, ImageStore]:
+	"""HTML и картинки marker'а; при включённом кэше повторный PDF с теми же байтами не конвертируется."""
+	store = ImageStore(SETTINGS.image_dir)
+	key = content_key("marker", _marker_version(), file_digest(path)) if _RESULT_CACHE is not None else None
+	return _convert(get_converter, path, key, store), store
+
+def page_count(path: str) -> int:
+	import pypdfium2  # ставится вместе с marker
+
+	pdf = pypdfium2.PdfDocument(path)
+	try:
+		return len(pdf)
+	finally:
+		pdf.close()
+
+def _read_ahead(items: Iterator[Any], ahead: int = 1) -> Iterator[Any]:
+	"""
+	Элементы items, которые вычисляются в фоновом потоке не больше чем на ahead шагов вперёд
+	(поток наследует контекст: профиль и отмену). Закрытие итератора останавливает поток
+	после текущего элемента.
+	"""
+	q: "queue.Queue[Tuple[Any, Optional[BaseException]]]" = queue.Queue(maxsize=ahead)
+	stop = threading.Event()
+	done = object()
+
+	def put(item) -> bool:
+		while not stop.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def produce() -> None:
+		try:
+			for item in items:
+				if not put((item, None)):
+					return
+			put((done, None))
+		except BaseException as e:
+			put((done, e))
+
+	ctx = copy_context()
+	threading.Thread(target=ctx.run, args=(produce,), name="caterpillar-marker", daemon=True).start()
+	try:
+		while True:
+			item, error = q.get()
+			if item is done:
+				if error is not None:
+					raise error
+				return
+			yield item
+	finally:
+		stop.set()
 
-	lm = LlamaCpp(model="models/Qwen3-4B-Thinking-2507-F16.gguf", 
-			chat_template=Qwen3ChatTemplate,
-			n_ctx=45000, 
-			echo=True,
-			n_gpu_layers=-1)
-	tok = Llama(model_path="models/Qwen3-4B-Thinking-2507-F16.gguf", vocab_only=True, verbose=False)
+def iter_pdf_windows(path: str, window_pages: Optional[int] = None, store: Optional[ImageStore] = None) -> Iterator[str]:
+	"""
+	HTML документа окнами по window_pages страниц (по умолчанию SETTINGS.page_window). marker
+	конвертирует следующее окно в фоновом потоке, пока вызывающий разбирает текущее; заголовки
+	на границе окон склеиваются (chunking.stitch_windows). Картинки всех окон — в store.
+	Кэш marker'а — по окнам: ключ включает диапазон страниц.
+	"""
+	window_pages = window_pages or SETTINGS.page_window
+	if window_pages <= 0:
+		raise ValueError("window_pages must be > 0")
+	if store is None:
+		store = ImageStore(SETTINGS.image_dir)
+	digest = file_digest(path) if _RESULT_CACHE is not None else None
+
+	def convert_windows() -> Iterator[str]:
+		n_pages = page_count(path)
+		for first in range(0, n_pages, window_pages):
+			check_cancelled()
+			page_range = f"{first}-{min(first + window_pages, n_pages) - 1}"
+			key = content_key("marker", _marker_version(), digest, page_range) if digest is not None else None
+			# yield вне стадии: время, пока окно ждёт в очереди read-ahead, — не время marker'а
+			with profiling.stage("marker", pages=page_range):
+				html = _convert(lambda: _build_converter(page_range), path, key, store)
+			yield html
+
+	yield from stitch_windows(_read_ahead(convert_windows()))
+
+def parse_pdf(path: str, *, workers: int = 1, previous: Optional[DocumentTree] = None) -> Tuple[Header, Section]:
+	"""
+	Полный прогон одного PDF на резидентных моделях процесса.
+	workers > 1 — подразделы разбираются пулом из стольких процессов с моделью.
+	previous — дерево прошлой редакции документа для инкрементального разбора.
+	При SETTINGS.page_window разбор идёт параллельно с конвертацией по окнам страниц.
+	"""
+	tok = get_tokenizer()
+	if previous is None and SETTINGS.page_window:
+		# Длина документа до конвертации неизвестна — окна идут для длинных PDF, берём старший ярус
+		with tier_models(SETTINGS.ctx_tiers[-1], workers) as (lm, pool):
+			return process_windows(lm, tok, iter_pdf_windows(path), workers=pool)
+
+	html, images = convert_pdf(path)
+	with tier_models(context_tier(tok, html), workers) as (lm, pool):
+		if previous is not None:
+			return reparse_document(lm, tok, previous, html, workers=pool)
+		return process_document(lm, tok, html, workers=pool)
+
+def parse_reasoning_args(default: Optional[ReasoningPolicy], per_stage: List[str]) -> Dict[str, ReasoningPolicy]:
+	"""--reasoning и --reasoning-stage STAGE=POLICY в словарь политик для Settings.reasoning."""
+	policies = {stage: default for stage in REASONING_STAGES} if default is not None else {}
+	for item in per_stage:
+		stage, _, spec = item.partition("=")
+		if stage not in REASONING_STAGES or not spec:
+			raise ValueError(f"expected STAGE=POLICY with STAGE in {REASONING_STAGES}, got {item!r}")
+		policies[stage] = ReasoningPolicy.parse(spec)
+	return policies
 
-	header, section = process_chunk(lm, html)
-	print(header)
-	print(section)
+def parse_ctx_tiers(spec: str) -> Tuple[ContextTier, ...]:
+	"""--ctx-tiers '12288x4,32768:q8_0' в ярусы Settings.ctx_tiers, по возрастанию n_ctx."""
+	tiers = tuple(sorted((ContextTier.parse(part) for part in spec.split(",") if part.strip()), key=lambda t: t.n_ctx))
+	if not tiers:
+		raise ValueError("at least one context tier is required")
+	return tiers
+
+def stream_pdf(path: str, *, workers: int = 1) -> Iterator[str]:
+	"""
+	XML документа кусками: пролог и <nav> — как только есть Header, дальше по разделу верхнего уровня.
+	<nav> перечисляет только разделы первого чанка (см. stream_document_xml).
+	"""
+	tok = get_tokenizer()
+	if SETTINGS.page_window:
+		with tier_models(SETTINGS.ctx_tiers[-1], workers) as (lm, pool):
+			yield from stream_document_xml(iter_document_windows(lm, tok, iter_pdf_windows(path), workers=pool))
+		return
+	html, images = convert_pdf(path)
+	with tier_models(context_tier(tok, html), workers) as (lm, pool):
+		yield from stream_document_xml(iter_document(lm, tok, html, workers=pool))
+
+def html(
+	path: str,
+	mime: Optional[str],
+	*,
+	workers: int = 1,
+	previous_tree: Optional[str] = None,
+	tree_out: Optional[str] = None,
+	out=sys.stdout,
+):
+	if not previous_tree and not tree_out:
+		for part in stream_pdf(path, workers=workers):
+			out.write(part)
+			out.flush()
+		return
+
+	# Нужно целое дерево — собираем его и пишем XML в конце
+	previous = None
+	if previous_tree:
+		with open(previous_tree, "r", encoding="utf-8") as f:
+			previous = DocumentTree.model_validate_json(f.read())
+	header, section = parse_pdf(path, workers=workers, previous=previous)
+	if tree_out:
+		with open(tree_out, "w", encoding="utf-8") as f:
+			f.write(DocumentTree(header=header, section=section).model_dump_json())
+	out.write(render_document(header, section))
 
 if __name__ == "__main__":
-	print(html(sys.argv[1], "application/pdf"))
+	import argparse
+
+	ap = argparse.ArgumentParser(description="PDF -> XML")
+	ap.add_argument("path")
+	ap.add_argument("--workers", type=int, default=1, help="процессов с моделью для параллельного разбора подразделов")
+	ap.add_argument("--cache-dir", help="дисковый кэш результатов marker и LLM-стадий")
+	ap.add_argument("--cache-max-bytes", type=int, default=DEFAULT_MAX_BYTES)
+	ap.add_argument("--tree-out", help="сохранить дерево разбора в JSON для следующего инкрементального прогона")
+	ap.add_argument("--previous", help="JSON-дерево прошлой редакции: разобрать заново только изменившиеся разделы")
+	ap.add_argument("--classify-mode", choices=("levels", "trie"), default=SETTINGS.classify_mode,
+		help="levels — генерация на каждый уровень классификатора, trie — весь путь за одну генерацию")
+	ap.add_argument("--reasoning", type=ReasoningPolicy.parse, metavar="POLICY",
+		help="бюджет <think> для всех стадий: free, off, N (не больше N токенов) или adaptive[:ratio[:min[:max]]]")
+	ap.add_argument("--reasoning-stage", action="append", default=[], metavar="STAGE=POLICY",
+		help=f"бюджет для одной стадии ({', '.join(REASONING_STAGES)}), можно повторять")
+	ap.add_argument("--reasoning-report", action="store_true", help="вывести в stderr токены рассуждений по стадиям")
+	ap.add_argument("--memory-limit-mb", type=int, help="потолок приватной памяти процесса; при превышении разбор прерывается")
+	ap.add_argument("--image-dir", help="каталог для картинок marker'а (по умолчанию временный)")
+	ap.add_argument("--draft", metavar="lookup|GGUF",
+		help="спекулятивное декодирование: lookup — продолжения из самого промпта, или путь к маленькой модели с тем же словарём")
+	ap.add_argument("--draft-tokens", type=int, default=SETTINGS.draft_tokens, help="токенов черновика за шаг")
+	ap.add_argument("--ctx-tiers", default=",".join(t.spec() for t in CTX_TIERS), metavar="N[:KV][xWORKERS],...",
+		help="ярусы контекста по возрастанию с типом KV-кэша (f16, q8_0, q4_0) и числом процессов пула на ярусе; "
+			"один ярус — фиксированный n_ctx")
+	ap.add_argument("--resident-tiers", type=int, default=SETTINGS.resident_tiers, help="сколько ярусов держать загруженными")
+	ap.add_argument("--page-window", type=int, default=0, metavar="PAGES",
+		help="конвертировать PDF окнами по PAGES страниц и начинать разбор с первого окна")
+	ap.add_argument("--profile", metavar="TRACE_JSON", help="сохранить профиль стадий: время, токены, tok/s, RSS на входе и выходе стадии")
+	ap.add_argument("--profile-chrome", metavar="TRACE_JSON", help="тот же профиль в формате Chrome trace (chrome://tracing, Perfetto)")
+	args = ap.parse_args()
+	configure_cache(args.cache_dir, args.cache_max_bytes)
+	configure(
+		classify_mode=args.classify_mode,
+		reasoning=parse_reasoning_args(args.reasoning, args.reasoning_stage),
+		memory_limit_mb=args.memory_limit_mb,
+		image_dir=args.image_dir,
+		page_window=args.page_window,
+		draft=args.draft,
+		draft_tokens=args.draft_tokens,
+		ctx_tiers=parse_ctx_tiers(args.ctx_tiers),
+		resident_tiers=args.resident_tiers,
+	)
+	if args.profile or args.profile_chrome:
+		with profiling.profile(args.path) as prof:
+			html(args.path, "application/pdf", workers=args.workers, previous_tree=args.previous, tree_out=args.tree_out)
+		if args.profile:
+			prof.save(args.profile, chrome_path=args.profile_chrome)
+		else:
+			with open(args.profile_chrome, "w", encoding="utf-8") as f:
+				json.dump(prof.to_chrome_trace(), f)
+	else:
+		html(args.path, "application/pdf", workers=args.workers, previous_tree=args.previous, tree_out=args.tree_out)
+	if args.reasoning_report:
+		print(json.dumps(reasoning_stats(), indent=2), file=sys.stderr)
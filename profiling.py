@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Профилирование стадий разбора: время, токены промпта и генерации, скорость и память.
+
+	with profiling.profile("doc.pdf") as prof:
+		parse_pdf("doc.pdf")
+	prof.save("trace.json", chrome_path="trace.chrome.json")
+
+Стадии размечаются через stage(...); счётчики токенов добавляются в текущую стадию
+через count(...) — из kvcache.PrefixCache (префилл) и из самих стадий (генерация).
+Профайлер и текущая стадия живут в contextvars, поэтому без profile() всё это —
+пара обращений к ContextVar, а в aio.py профиль следует за документом между потоками.
+Разделы, разобранные в дочерних процессах, возвращают свои стадии через spans()/merge().
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+	import resource
+except ImportError:  # не POSIX
+	resource = None
+
+# Счётчики, которые складываются при сводке по стадиям: prompt_tokens_reused/tokens_evaluated
+# приходят из PrefixCache (evaluated = досчитанный префилл + генерация), остальные — из стадий
+COUNTERS = ("prompt_tokens_reused", "tokens_evaluated", "generated_tokens", "thought_tokens", "cache_hits")
+
+def process_peak_rss_kb() -> int:
+	"""Пиковый RSS процесса с момента старта (Linux отдаёт ru_maxrss в КБ) — не пик отдельной стадии."""
+	if resource is None:
+		return 0
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def rss_kb() -> int:
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+	except (OSError, ValueError, IndexError):
+		return 0
+
+def private_rss_kb() -> int:
+	"""RSS без разделяемых страниц: веса GGUF через mmap сюда не входят, их ядро может выгрузить само."""
+	try:
+		with open("/proc/self/statm") as f:
+			fields = f.read().split()
+		return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE") // 1024
+	except (OSError, ValueError, IndexError):
+		return 0
+
+@dataclass
+class Span:
+	name: str
+	start: float  # time.time(): сопоставимо между процессами
+	seconds: float = 0.0
+	pid: int = 0
+	tid: int = 0
+	args: Dict[str, Any] = field(default_factory=dict)  # depth, cached, ...
+	counters: Dict[str, int] = field(default_factory=dict)
+	# Текущий RSS на входе в стадию и на выходе; пика внутри стадии ОС не отдаёт, только пик процесса
+	rss_start_kb: int = 0
+	rss_kb: int = 0
+	process_peak_rss_kb: int = 0  # ru_maxrss на выходе: максимум процесса с его старта, а не этой стадии
+
+	@property
+	def rss_delta_kb(self) -> int:
+		return self.rss_kb - self.rss_start_kb
+
+	@property
+	def key(self) -> str:
+		"""Имя для сводки: разделы группируются ещё и по глубине рекурсии."""
+		depth = self.args.get("depth")
+		return self.name if depth is None else f"{self.name}@{depth}"
+
+class Profiler:
+	def __init__(self, document: str = ""):
+		self.document = document
+		self.started = time.time()
+		self._spans: List[Span] = []
+		self._lock = threading.Lock()
+
+	def add(self, span: Span) -> None:
+		with self._lock:
+			self._spans.append(span)
+
+	def spans(self) -> List[Dict[str, Any]]:
+		with self._lock:
+			return [asdict(s) for s in self._spans]
+
+	def merge(self, spans: List[Dict[str, Any]]) -> None:
+		"""Стадии из другого процесса (см. spans())."""
+		for s in spans:
+			self.add(Span(**s))
+
+	def summary(self) -> Dict[str, Dict[str, Any]]:
+		out: Dict[str, Dict[str, Any]] = {}
+		with self._lock:
+			spans = list(self._spans)
+		for s in spans:
+			row = out.setdefault(s.key, {
+				"calls": 0, "seconds": 0.0, "rss_delta_kb": 0, "max_rss_delta_kb": 0, "max_rss_kb": 0, "process_peak_rss_kb": 0,
+				**{c: 0 for c in COUNTERS},
+			})
+			row["calls"] += 1
+			row["seconds"] += s.seconds
+			# Прирост RSS за стадию: суммарный по вызовам и наибольший за один вызов
+			row["rss_delta_kb"] += s.rss_delta_kb
+			row["max_rss_delta_kb"] = max(row["max_rss_delta_kb"], s.rss_delta_kb)
+			row["max_rss_kb"] = max(row["max_rss_kb"], s.rss_start_kb, s.rss_kb)
+			row["process_peak_rss_kb"] = max(row["process_peak_rss_kb"], s.process_peak_rss_kb)
+			for c in COUNTERS:
+				row[c] += s.counters.get(c, 0)
+		for row in out.values():
+			row["prefill_tokens"] = max(row["tokens_evaluated"] - row["generated_tokens"], 0)
+			row["prompt_tokens"] = row["prompt_tokens_reused"] + row["prefill_tokens"]
+			row["tokens_per_sec"] = row["generated_tokens"] / row["seconds"] if row["seconds"] else 0.0
+		return out
+
+	def to_json(self) -> Dict[str, Any]:
+		return {
+			"document": self.document,
+			"started": self.started,
+			"process_peak_rss_kb": process_peak_rss_kb(),
+			"stages": self.summary(),
+			"spans": self.spans(),
+		}
+
+	def to_chrome_trace(self) -> Dict[str, Any]:
+		"""Формат chrome://tracing / Perfetto: complete-события с микросекундами от начала профиля."""
+		events = []
+		for s in self.spans():
+			events.append({
+				"name": s["name"],
+				"cat": "caterpillar",
+				"ph": "X",
+				"ts": (s["start"] - self.started) * 1e6,
+				"dur": s["seconds"] * 1e6,
+				"pid": s["pid"],
+				"tid": s["tid"],
+				"args": {
+					**s["args"], **s["counters"],
+					"rss_start_kb": s["rss_start_kb"], "rss_kb": s["rss_kb"], "rss_delta_kb": s["rss_kb"] - s["rss_start_kb"],
+					"process_peak_rss_kb": s["process_peak_rss_kb"],
+				},
+			})
+		return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"document": self.document}}
+
+	def save(self, path: str, *, chrome_path: Optional[str] = None) -> None:
+		with open(path, "w", encoding="utf-8") as f:
+			json.dump(self.to_json(), f, ensure_ascii=False, indent=1)
+		if chrome_path:
+			with open(chrome_path, "w", encoding="utf-8") as f:
+				json.dump(self.to_chrome_trace(), f)
+
+_PROFILER: ContextVar[Optional[Profiler]] = ContextVar("caterpillar_profiler", default=None)
+_SPAN: ContextVar[Optional[Span]] = ContextVar("caterpillar_span", default=None)
+
+def current() -> Optional[Profiler]:
+	return _PROFILER.get()
+
+def enabled() -> bool:
+	return _PROFILER.get() is not None
+
+@contextmanager
+def profile(document: str = "") -> Iterator[Profiler]:
+	"""Включает профилирование для кода внутри блока (и всего, что унаследует контекст)."""
+	prof = Profiler(document)
+	token = _PROFILER.set(prof)
+	try:
+		yield prof
+	finally:
+		_PROFILER.reset(token)
+
+@contextmanager
+def stage(name: str, **args) -> Iterator[Optional[Span]]:
+	"""Размечает стадию; без активного профайлера ничего не делает и отдаёт None."""
+	prof = _PROFILER.get()
+	if prof is None:
+		yield None
+		return
+	span = Span(name, time.time(), pid=os.getpid(), tid=threading.get_ident(), args=args, rss_start_kb=rss_kb())
+	token = _SPAN.set(span)
+	t0 = time.perf_counter()
+	try:
+		yield span
+	finally:
+		span.seconds = time.perf_counter() - t0
+		span.rss_kb = rss_kb()
+		span.process_peak_rss_kb = process_peak_rss_kb()
+		_SPAN.reset(token)
+		prof.add(span)
+
+def traced(name: str, *arg_names: str):
+	"""Декоратор: вызов функции — стадия name; именованные аргументы из arg_names попадают в её args."""
+	def wrap(fn):
+		@functools.wraps(fn)
+		def inner(*args, **kwargs):
+			if _PROFILER.get() is None:
+				return fn(*args, **kwargs)
+			with stage(name, **{k: kwargs[k] for k in arg_names if k in kwargs}):
+				return fn(*args, **kwargs)
+		return inner
+	return wrap
+
+def count(**counters: int) -> None:
+	"""Добавляет счётчики к текущей стадии (если профилирование включено)."""
+	span = _SPAN.get()
+	if span is None:
+		return
+	for k, v in counters.items():
+		span.counters[k] = span.counters.get(k, 0) + v
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Долгоживущий режим парсера: модели загружаются один раз и остаются в памяти между документами.
+
+	python server.py --port 8765
+
+	curl --data-binary @doc.pdf -H 'Content-Type: application/pdf' http://127.0.0.1:8765/parse
+	curl -d '{"path": "/abs/path/doc.pdf"}' -H 'Content-Type: application/json' http://127.0.0.1:8765/parse
+
+Задания ставятся в ограниченную очередь и выполняются одним воркером по порядку:
+llama.cpp-контекст один на процесс, поэтому параллелизм здесь — только приём запросов.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import parser as caterpillar
+from xml_writer import render_document
+
+
+@dataclass
+class Job:
+	path: str
+	cleanup: bool = False
+	result: Future = field(default_factory=Future)
+
+class JobQueue:
+	def __init__(self, maxsize: int = 64, *, workers: int = 1):
+		self.workers = workers
+		self._jobs: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=maxsize)
+		self._worker = threading.Thread(target=self._run, name="caterpillar-worker", daemon=True)
+
+	def start(self) -> None:
+		self._worker.start()
+
+	def stop(self) -> None:
+		self._jobs.put(None)
+		self._worker.join()
+
+	def submit(self, path: str, *, cleanup: bool = False) -> Future:
+		"""Ставит PDF в очередь; при переполнении бросает queue.Full."""
+		job = Job(path, cleanup)
+		self._jobs.put_nowait(job)
+		return job.result
+
+	def pending(self) -> int:
+		return self._jobs.qsize()
+
+	def _run(self) -> None:
+		while True:
+			job = self._jobs.get()
+			if job is None:
+				return
+			if not job.result.set_running_or_notify_cancel():
+				continue
+			try:
+				header, section = caterpillar.parse_pdf(job.path, workers=self.workers)
+				job.result.set_result(render_document(header, section))
+			except BaseException as e:
+				job.result.set_exception(e)
+			finally:
+				if job.cleanup:
+					os.unlink(job.path)
+
+class ParseHandler(BaseHTTPRequestHandler):
+	jobs: JobQueue
+
+	def _reply(self, code: int, body: str, content_type: str = "text/plain; charset=utf-8") -> None:
+		data = body.encode("utf-8")
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		if self.path != "/health":
+			return self._reply(404, "not found\n")
+		self._reply(200, json.dumps({"pending": self.jobs.pending()}), "application/json")
+
+	def do_POST(self):
+		if self.path != "/parse":
+			return self._reply(404, "not found\n")
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		ctype = self.headers.get("Content-Type", "application/pdf").split(";")[0].strip()
+
+		if ctype == "application/json":
+			try:
+				path, cleanup = json.loads(body)["path"], False
+			except (ValueError, KeyError, TypeError):
+				return self._reply(400, 'expected {"path": "..."}\n')
+			if not os.path.isfile(path):
+				return self._reply(404, f"no such file: {path}\n")
+		else:
+			with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+				f.write(body)
+			path, cleanup = f.name, True
+
+		try:
+			result = self.jobs.submit(path, cleanup=cleanup)
+		except queue.Full:
+			if cleanup:
+				os.unlink(path)
+			return self._reply(503, "queue is full\n")
+
+		try:
+			xml = result.result()
+		except Exception as e:
+			return self._reply(500, f"{type(e).__name__}: {e}\n")
+		self._reply(200, xml, "application/xml; charset=utf-8")
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description="Caterpillar parser daemon")
+	ap.add_argument("--host", default="127.0.0.1")
+	ap.add_argument("--port", type=int, default=8765)
+	ap.add_argument("--queue-size", type=int, default=64)
+	ap.add_argument("--workers", type=int, default=1, help="процессов с моделью для параллельного разбора подразделов")
+	ap.add_argument("--no-warmup", action="store_true", help="грузить модели на первом запросе, а не при старте")
+	ap.add_argument("--cache-dir", help="дисковый кэш результатов marker и LLM-стадий")
+	ap.add_argument("--cache-max-bytes", type=int, default=caterpillar.DEFAULT_MAX_BYTES)
+	args = ap.parse_args()
+	caterpillar.configure_cache(args.cache_dir, args.cache_max_bytes)
+
+	if not args.no_warmup:
+		caterpillar.warmup()
+
+	jobs = JobQueue(args.queue_size, workers=args.workers)
+	jobs.start()
+	handler = type("Handler", (ParseHandler,), {"jobs": jobs})
+	httpd = ThreadingHTTPServer((args.host, args.port), handler)
+	print(f"listening on http://{args.host}:{args.port}", file=sys.stderr)
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		httpd.server_close()
+		jobs.stop()
+
+if __name__ == "__main__":
+	main()
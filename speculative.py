@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Спекулятивное декодирование для движка llama.cpp под guidance.
+
+Guidance на каждом шаге просит у движка логиты для всей последовательности и сам
+накладывает маску грамматики и выбирает токен. SpeculativeEngine перехватывает этот вызов:
+при промахе к последовательности добавляются k токенов черновика и llama.cpp считает их
+одним батчем с логитами на каждой из k + 1 последних позиций. Пока guidance выбирает токены
+черновика, следующие шаги отдаются из этих логитов без вызова модели; на первом расхождении
+лишний хвост KV отрезается и всё идёт как обычно.
+
+Логиты — настоящие логиты основной модели, а выбор токена остаётся за guidance, поэтому
+грамматика соблюдается и результат совпадает с обычным декодированием (при temperature=0 —
+побайтно). Черновики:
+	PromptLookupDrafter — продолжение последнего n-грамма там, где он уже встречался в промпте
+	                      (JSON стадий копирует куски HTML документа);
+	DraftModelDrafter   — жадная генерация маленькой GGUF-модели с тем же словарём.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from kvcache import _common_prefix, llama_engine, token_attr
+
+
+@dataclass
+class SpeculativeStats:
+	drafted: int = 0  # предложено токенов черновика
+	accepted: int = 0  # из них совпало с выбором guidance
+	decodes: int = 0  # вызовов llama_decode для генерации (батч с черновиком — один вызов)
+
+	@property
+	def acceptance(self) -> float:
+		return self.accepted / self.drafted if self.drafted else 0.0
+
+class PromptLookupDrafter:
+	"""
+	Prompt lookup: ищем самое позднее более раннее вхождение последних n токенов (от max_ngram
+	до min_ngram) и предлагаем то, что шло за ним.
+	"""
+
+	def __init__(self, num_pred_tokens: int = 10, max_ngram: int = 3, min_ngram: int = 1):
+		self.num_pred_tokens = num_pred_tokens
+		self.max_ngram = max_ngram
+		self.min_ngram = min_ngram
+
+	def __call__(self, token_ids: Sequence[int]) -> List[int]:
+		ids = np.asarray(token_ids, dtype=np.int64)
+		for n in range(min(self.max_ngram, len(ids) - 1), self.min_ngram - 1, -1):
+			windows = np.lib.stride_tricks.sliding_window_view(ids[:-1], n)
+			starts = np.nonzero((windows == ids[-n:]).all(axis=1))[0]
+			if len(starts):
+				follow = starts[-1] + n
+				return ids[follow:follow + self.num_pred_tokens].tolist()
+		return []
+
+class DraftModelDrafter:
+	"""
+	Маленькая модель с тем же словарём (например, Qwen3-0.6B для Qwen3-4B) жадно дописывает
+	num_pred_tokens токенов. Llama.generate сам переиспользует общий префикс своего KV,
+	так что промпт черновая модель считает один раз.
+	"""
+
+	def __init__(self, model_path: str, num_pred_tokens: int = 8, **llama_kwargs):
+		from llama_cpp import Llama
+
+		self.num_pred_tokens = num_pred_tokens
+		self.llama = Llama(model_path=model_path, verbose=False, **llama_kwargs)
+
+	def __call__(self, token_ids: Sequence[int]) -> List[int]:
+		out: List[int] = []
+		for token in self.llama.generate(list(token_ids), top_k=1, temp=0.0):
+			out.append(token)
+			if len(out) >= self.num_pred_tokens:
+				break
+		return out
+
+class SpeculativeEngine:
+	"""
+	Подменяет get_logits движка; движок остаётся тем же объектом, PrefixCache с ним совместим.
+
+	Контракт get_logits отличается между версиями guidance: до 0.2.1 — get_logits(token_ids) и
+	строка логитов, с 0.2.4 — get_logits(token_ids, include_all_uncached_tokens) и словарь
+	{"logits", "n_tokens", "n_cached"}. Какой из них у движка, видно по первому ответу исходного
+	get_logits; при незнакомом контракте, имени списка токенов или API KV-кэша все вызовы уходят
+	в исходный get_logits без черновика.
+	"""
+
+	def __init__(self, engine, drafter):
+		import llama_cpp
+
+		self._llama_cpp = llama_cpp
+		self.engine = engine
+		self.drafter = drafter
+		self.stats = SpeculativeStats()
+		self._get_logits = engine.get_logits
+		self._attr = token_attr(engine)
+		self._seq_rm = _kv_seq_rm(llama_cpp, engine.model_obj.ctx)
+		# None — ещё не видели ответа движка; "array" | "dict" — знакомый контракт; "other" — только исходный вызов
+		self._contract: Optional[str] = None if self._attr and self._seq_rm else "other"
+		self._n_vocab = engine.model_obj.n_vocab()
+		self._n_batch = engine.model_obj.n_batch
+		self._batch = llama_cpp.llama_batch_init(self._n_batch, 0, 1)
+		# Логиты после каждого префикса _draft_ids длиной от _draft_base + 1 до len(_draft_ids)
+		self._draft_ids: List[int] = []
+		self._draft_base = 0
+		self._draft_logits: Optional[np.ndarray] = None
+		self._served = 0  # до какой длины префикса логиты черновика уже отданы
+		engine.get_logits = self.get_logits
+
+	def close(self) -> None:
+		"""Возвращает движку обычный get_logits."""
+		if self._batch is not None:
+			self.engine.get_logits = self._get_logits
+			self._llama_cpp.llama_batch_free(self._batch)
+			self._batch = None
+
+	def _passthrough(self, token_ids, *args, **kwargs):
+		self._draft_logits = None
+		out = self._get_logits(token_ids, *args, **kwargs)
+		if self._contract is None:
+			if isinstance(out, dict) and "logits" in out:
+				self._contract = "dict"
+			elif isinstance(out, np.ndarray) and out.ndim == 1:
+				self._contract = "array"
+			else:
+				self._contract = "other"
+		return out
+
+	def _output(self, rows: np.ndarray, n_tokens: int, n_cached: int):
+		if self._contract == "dict":
+			return {"logits": rows.copy(), "n_tokens": n_tokens, "n_cached": n_cached}
+		return rows[-1].copy()
+
+	def get_logits(self, token_ids, *args, **kwargs):
+		include_all = kwargs.get("include_all_uncached_tokens", args[0] if args else False)
+		extra = args[1:] if args else [k for k in kwargs if k != "include_all_uncached_tokens"]
+		if self._contract not in ("array", "dict") or extra or (args and self._contract != "dict"):
+			return self._passthrough(token_ids, *args, **kwargs)
+
+		token_ids = list(token_ids)
+		n = len(token_ids)
+		if self._draft_logits is not None and self._draft_base < n <= len(self._draft_ids) and token_ids == self._draft_ids[:n]:
+			# guidance выбрал токены черновика (может и несколько сразу, если грамматика их вынуждает)
+			if n > self._served:
+				self.stats.accepted += n - self._served
+				self._served = n
+			# Как и сам движок, считаем непосчитанным только последний токен: одна строка логитов
+			row = n - self._draft_base - 1
+			return self._output(self._draft_logits[row:row + 1], n, n - 1)
+
+		draft = self.drafter(token_ids)[:self._n_batch - 1] if token_ids else []
+		cached = _common_prefix(token_ids, getattr(self.engine, self._attr))
+		if not draft or (include_all and cached < n - 1):
+			# Логиты всех непосчитанных токенов промпта батч черновика не даёт — считает движок
+			return self._passthrough(token_ids, *args, **kwargs)
+		rows, start = self._decode(token_ids, draft)
+		self.stats.drafted += len(draft)
+		return self._output(rows[:1], n, start)
+
+	def _decode(self, token_ids: List[int], draft: List[int]) -> Tuple[np.ndarray, int]:
+		"""
+		Досчитывает token_ids + draft; логиты — для позиций от последнего токена token_ids до конца.
+		Второе значение — сколько токенов было взято из KV без пересчёта.
+		"""
+		lc, engine = self._llama_cpp, self.engine
+		ctx = engine.model_obj.ctx
+		full = token_ids + draft
+		cached = _common_prefix(full, list(getattr(engine, self._attr)))
+		# Логиты нужны начиная с последнего токена token_ids — его пересчитываем, даже если он в KV
+		start = min(cached, len(token_ids) - 1)
+		self._seq_rm(start)
+		n_rows = len(draft) + 1
+		batch = self._batch
+		for i in range(start, len(full), self._n_batch):
+			n_tokens = min(i + self._n_batch, len(full)) - i
+			last_chunk = i + n_tokens == len(full)
+			if last_chunk and n_tokens < n_rows:
+				# Строки логитов должны попасть в один батч: последний кусок начинаем раньше
+				self._seq_rm(len(full) - n_rows)
+				i, n_tokens = len(full) - n_rows, n_rows
+			batch.n_tokens = n_tokens
+			for j in range(n_tokens):
+				batch.token[j] = full[i + j]
+				batch.pos[j] = i + j
+				batch.seq_id[j][0] = 0
+				batch.n_seq_id[j] = 1
+				batch.logits[j] = last_chunk and j >= n_tokens - n_rows
+			if lc.llama_decode(ctx, batch) != 0:
+				raise RuntimeError("llama_decode failed")
+			self.stats.decodes += 1
+			if last_chunk:
+				break
+
+		rows = np.empty((n_rows, self._n_vocab), dtype=np.float32)
+		for r in range(n_rows):
+			ptr = lc.llama_get_logits_ith(ctx, batch.n_tokens - n_rows + r)
+			rows[r] = np.ctypeslib.as_array(ptr, shape=(self._n_vocab,))
+		# KV теперь содержит и черновик: так движок на следующем промахе отрежет ровно лишнее
+		setattr(engine, self._attr, full)
+		engine._cached_logits = rows[-1:].copy() if self._contract == "dict" else rows[-1].copy()
+		self._draft_ids = full
+		self._draft_base = len(token_ids) - 1
+		self._draft_logits = rows
+		self._served = len(token_ids)
+		return rows, start
+
+def _kv_seq_rm(lc, ctx) -> Optional[Callable[[int], None]]:
+	"""Отрезает KV последовательности начиная с позиции; API llama_cpp_python менялся между версиями."""
+	if hasattr(lc, "llama_memory_seq_rm") and hasattr(lc, "llama_get_memory"):
+		return lambda p0: lc.llama_memory_seq_rm(lc.llama_get_memory(ctx), -1, p0, -1)
+	if hasattr(lc, "llama_kv_cache_seq_rm"):
+		return lambda p0: lc.llama_kv_cache_seq_rm(ctx, -1, p0, -1)
+	return None
+
+def parse_draft(spec: str, *, num_pred_tokens: int = 8, n_ctx: int = 0):
+	"""'lookup' — prompt lookup, иначе путь к черновой GGUF-модели."""
+	if spec == "lookup":
+		return PromptLookupDrafter(num_pred_tokens=num_pred_tokens)
+	return DraftModelDrafter(spec, num_pred_tokens=num_pred_tokens, n_ctx=n_ctx, n_gpu_layers=-1)
+
+def enable(lm, drafter) -> Optional[SpeculativeEngine]:
+	"""Включает спекулятивное декодирование на движке lm; None, если это не llama.cpp."""
+	engine = llama_engine(lm)
+	if engine is None:
+		return None
+	spec = getattr(engine, "_speculative", None)
+	if spec is None:
+		spec = engine._speculative = SpeculativeEngine(engine, drafter)
+	return spec
+
+def disable(lm) -> None:
+	engine = llama_engine(lm)
+	spec = getattr(engine, "_speculative", None)
+	if spec is not None:
+		spec.close()
+		del engine._speculative
+
+def stats(lm) -> Optional[SpeculativeStats]:
+	engine = llama_engine(lm)
+	spec = getattr(engine, "_speculative", None)
+	return spec.stats if spec is not None else None
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Детерминированное извлечение таблиц из HTML marker'а: плейсхолдеры для LLM и нормализация rowspan/colspan в сетку."""
+
+import hashlib
+import re
+from dataclasses import dataclass
+from html import escape, unescape
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+# <table data-source-id="..."/> или <table data-source-id="..."></table> — модель может записать и так, и так
+PLACEHOLDER_RE = re.compile(r"""<table\s+data-source-id\s*=\s*(["'])(.*?)\1\s*(?:/>|>\s*</table\s*>)""", re.I | re.S)
+
+# Пределы из спецификации HTML: больше браузеры тоже не растягивают
+MAX_COLSPAN = 1000
+MAX_ROWSPAN = 65534
+
+CELL_TAGS = {"td", "th"}
+# Элементы HTML без закрывающего тега: в XML пишутся как <br/>
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+XML_NAME_RE = re.compile(r"^[A-Za-z_][\w.-]*$")
+
+def placeholder(source_id: str) -> str:
+	return f'<table data-source-id="{escape(source_id)}"/>'
+
+def placeholder_ids(html: str, start: int = 0, end: Optional[int] = None) -> List[str]:
+	"""Идентификаторы плейсхолдеров html[start:end] (без копирования среза) в порядке появления, без повторов."""
+	matches = PLACEHOLDER_RE.finditer(html, start, len(html) if end is None else end)
+	return list(dict.fromkeys(m.group(2) for m in matches))
+
+@dataclass
+class Cell:
+	html: str  # внутренний HTML ячейки как есть
+	header: bool
+	rowspan: int = 1
+	colspan: int = 1
+
+@dataclass
+class RawTable:
+	start: int  # смещения <table ...> ... </table> в исходной строке
+	end: int
+	caption: str
+	rows: List[List[Cell]]
+
+@dataclass
+class NormalizedTable:
+	source_id: str
+	caption: str
+	html: str  # прямоугольная таблица без rowspan/colspan
+	n_rows: int
+	n_cols: int
+
+def _span(value: Optional[str], limit: int) -> int:
+	try:
+		return min(max(int(value or 1), 1), limit)
+	except ValueError:
+		return 1
+
+class _TableScanner(HTMLParser):
+	"""Внешние <table> на любой глубине; вложенные таблицы остаются содержимым ячеек."""
+
+	def __init__(self, html: str):
+		super().__init__(convert_charrefs=False)
+		self.html = html
+		self.tables: List[RawTable] = []
+		self._line_starts = [0]
+		pos = html.find("\n")
+		while pos >= 0:
+			self._line_starts.append(pos + 1)
+			pos = html.find("\n", pos + 1)
+		self._depth = 0  # вложенность <table>
+		self._table: Optional[RawTable] = None
+		self._row: Optional[List[Cell]] = None
+		self._cell: Optional[Cell] = None
+		self._cell_start = -1
+		self._caption_start = -1
+
+	def _offset(self) -> int:
+		line, col = self.getpos()
+		return self._line_starts[line - 1] + col
+
+	def _tag_end(self, pos: int) -> int:
+		return self.html.index(">", pos) + 1
+
+	def _close_cell(self, end: int) -> None:
+		if self._cell is not None:
+			self._cell.html = self.html[self._cell_start:end].strip()
+			self._row.append(self._cell)
+			self._cell = None
+
+	def _close_row(self, end: int) -> None:
+		self._close_cell(end)
+		if self._row is not None:
+			self._table.rows.append(self._row)
+			self._row = None
+
+	def handle_starttag(self, tag, attrs):
+		pos = self._offset()
+		if tag == "table":
+			self._depth += 1
+			if self._depth == 1:
+				self._table = RawTable(pos, -1, "", [])
+			return
+		if self._depth != 1:
+			return
+		if tag == "tr":
+			self._close_row(pos)
+			self._row = []
+		elif tag in CELL_TAGS:
+			self._close_cell(pos)
+			if self._row is None:
+				self._row = []
+			a = dict(attrs)
+			self._cell = Cell("", tag == "th", _span(a.get("rowspan"), MAX_ROWSPAN), _span(a.get("colspan"), MAX_COLSPAN))
+			self._cell_start = self._tag_end(pos)
+		elif tag == "caption":
+			self._caption_start = self._tag_end(pos)
+
+	def handle_startendtag(self, tag, attrs):
+		# <table .../> — уже плейсхолдер, повторное извлечение его не трогает
+		pass
+
+	def handle_endtag(self, tag):
+		pos = self._offset()
+		if tag == "table":
+			if self._depth == 1:
+				self._close_row(pos)
+				self._table.end = self._tag_end(pos)
+				self.tables.append(self._table)
+				self._table = None
+			self._depth = max(self._depth - 1, 0)
+			return
+		if self._depth != 1:
+			return
+		if tag in CELL_TAGS:
+			self._close_cell(pos)
+		elif tag == "tr":
+			self._close_row(pos)
+		elif tag == "caption" and self._caption_start >= 0:
+			self._table.caption = re.sub(r"\s+", " ", re.sub(r"<[^>]*>", " ", self.html[self._caption_start:pos])).strip()
+			self._caption_start = -1
+
+	def close(self):
+		super().close()
+		if self._table is not None:
+			# оборванная таблица в конце документа — берём до конца
+			self._close_row(len(self.html))
+			self._table.end = len(self.html)
+			self.tables.append(self._table)
+			self._table = None
+
+def scan_tables(html: str) -> List[RawTable]:
+	scanner = _TableScanner(html)
+	scanner.feed(html)
+	scanner.close()
+	return scanner.tables
+
+class _CellSerializer(HTMLParser):
+	"""Пересобирает HTML ячейки в well-formed XML: void-теги закрыты, сущности — символы, незакрытые теги закрыты."""
+
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.out: List[str] = []
+		self._open: List[str] = []
+
+	def _tag(self, tag: str, attrs, close: str) -> str:
+		seen, parts = set(), [tag]
+		for name, value in attrs:
+			if name in seen or not XML_NAME_RE.match(name):
+				continue
+			seen.add(name)
+			parts.append(f'{name}="{escape(name if value is None else value)}"')
+		return "<" + " ".join(parts) + close
+
+	def handle_starttag(self, tag, attrs):
+		if tag in VOID_TAGS:
+			self.out.append(self._tag(tag, attrs, "/>"))
+		elif XML_NAME_RE.match(tag):
+			self.out.append(self._tag(tag, attrs, ">"))
+			self._open.append(tag)
+
+	def handle_startendtag(self, tag, attrs):
+		if XML_NAME_RE.match(tag):
+			self.out.append(self._tag(tag, attrs, "/>"))
+
+	def handle_endtag(self, tag):
+		# Закрывающий тег без открывающего (и </br>) пропускаем, пропущенные внутри — закрываем
+		if tag not in self._open:
+			return
+		while self._open:
+			top = self._open.pop()
+			self.out.append(f"</{top}>")
+			if top == tag:
+				break
+
+	def handle_data(self, data):
+		self.out.append(escape(data, quote=False))
+
+	def close(self):
+		super().close()
+		self.out.extend(f"</{tag}>" for tag in reversed(self._open))
+		self._open = []
+
+def cell_xml(html: str) -> str:
+	"""Содержимое ячейки как фрагмент XML: таблица вклеивается в XML-документ без разбора HTML."""
+	serializer = _CellSerializer()
+	serializer.feed(html)
+	serializer.close()
+	return "".join(serializer.out)
+
+def to_grid(rows: List[List[Cell]]) -> List[List[Optional[Cell]]]:
+	"""
+	Раскладывает строки с rowspan/colspan в прямоугольную сетку: объединённая ячейка
+	занимает все покрытые позиции, пропуски в коротких строках — None.
+	rowspan не выходит за последнюю строку таблицы.
+	"""
+	grid: List[List[Optional[Cell]]] = [[] for _ in rows]
+	for r, row in enumerate(rows):
+		c = 0
+		for cell in row:
+			line = grid[r]
+			while c < len(line) and line[c] is not None:
+				c += 1
+			for dr in range(min(cell.rowspan, len(rows) - r)):
+				line = grid[r + dr]
+				if len(line) < c + cell.colspan:
+					line.extend([None] * (c + cell.colspan - len(line)))
+				for dc in range(cell.colspan):
+					line[c + dc] = cell
+			c += cell.colspan
+	width = max((len(line) for line in grid), default=0)
+	for line in grid:
+		line.extend([None] * (width - len(line)))
+	return grid
+
+def render_grid(grid: List[List[Optional[Cell]]], caption: str = "") -> str:
+	"""
+	Таблица без объединений в виде XML: ведущие строки из одних <th> уходят в <thead>, содержимое
+	объединённых ячеек повторяется.
+	"""
+	n_head = 0
+	while n_head < len(grid) and grid[n_head] and all(c is not None and c.header for c in grid[n_head]):
+		n_head += 1
+
+	def row(line: List[Optional[Cell]]) -> str:
+		cells = []
+		for c in line:
+			tag = "th" if c is not None and c.header else "td"
+			cells.append(f"<{tag}>{cell_xml(c.html) if c is not None else ''}</{tag}>")
+		return "<tr>" + "".join(cells) + "</tr>"
+
+	out = ["<table>"]
+	if caption:
+		out.append(f"<caption>{escape(unescape(caption), quote=False)}</caption>")
+	if n_head:
+		out.append("<thead>" + "".join(row(line) for line in grid[:n_head]) + "</thead>")
+	out.append("<tbody>" + "".join(row(line) for line in grid[n_head:]) + "</tbody>")
+	out.append("</table>")
+	return "".join(out)
+
+def normalize_table(table: RawTable) -> NormalizedTable:
+	grid = to_grid(table.rows)
+	html = render_grid(grid, table.caption)
+	# id по содержимому: неизменная таблица в новой редакции документа получает тот же плейсхолдер
+	source_id = "t-" + hashlib.sha256(html.encode("utf-8")).hexdigest()[:12]
+	return NormalizedTable(source_id, table.caption, html, len(grid), len(grid[0]) if grid else 0)
+
+def extract_tables(html: str) -> Tuple[str, List[NormalizedTable]]:
+	"""
+	Вырезает таблицы из HTML и ставит на их место плейсхолдеры <table data-source-id="..."/>.
+	Возвращает HTML с плейсхолдерами и нормализованные таблицы в порядке документа;
+	для HTML, где таблицы уже вырезаны, ничего не меняет.
+	"""
+	raw = scan_tables(html)
+	if not raw:
+		return html, []
+	parts, tables, pos = [], [], 0
+	for t in raw:
+		table = normalize_table(t)
+		tables.append(table)
+		parts.append(html[pos:t.start])
+		parts.append(placeholder(table.source_id))
+		pos = t.end
+	parts.append(html[pos:])
+	return "".join(parts), tables
@@ -0,0 +1,22 @@
+from xml.dom import minidom
+
+from tables import extract_tables
+
+
+def test_cell_html_is_well_formed_xml():
+	html = (
+		'<table><caption>Итоги&nbsp;&amp; план</caption>'
+		'<tr><th>a<br>b&nbsp;c</th><th colspan="2">x &lt; y</th></tr>'
+		'<tr><td><p>1<p>2</td><td><img src="a.png?x=1&y=2" alt=pic></td><td>R&amp;D</br></i></td></tr>'
+		'</table>'
+	)
+	_, (table,) = extract_tables(html)
+	dom = minidom.parseString(table.html)
+	th = dom.getElementsByTagName("th")
+	assert len(th) == 3
+	assert th[0].toxml() == "<th>a<br/>b c</th>"
+	assert th[2].firstChild.data == "x < y"
+	img = dom.getElementsByTagName("img")[0]
+	assert img.getAttribute("src") == "a.png?x=1&y=2"
+	assert dom.getElementsByTagName("caption")[0].firstChild.data == "Итоги & план"
+	assert dom.getElementsByTagName("td")[2].firstChild.data == "R&D"
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Сериализация Header/Section в XML по схеме caterpillar.xsd."""
+
+from typing import Iterable, Iterator, List
+from xml.sax.saxutils import escape, quoteattr
+
+from tables import PLACEHOLDER_RE
+
+# Модели из parser.py не импортируем: модуль подключается и из `python parser.py`,
+# где parser живёт как __main__, поэтому работаем с объектами по атрибутам.
+
+XML_PROLOGUE = '<?xml version="1.0" encoding="UTF-8"?>\n'
+CONTAINER_OPEN = (
+	'<document-container xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+	'xsi:noNamespaceSchemaLocation="caterpillar.xsd">\n'
+)
+CONTAINER_CLOSE = '</document-container>\n'
+
+def _nav_items(sections: List["Section"]) -> Iterator[str]:
+	if not sections:
+		return
+	yield "<ol>"
+	for s in sections:
+		yield f"<li>{escape(s.heading)}"
+		yield from _nav_items(s.children)
+		yield "</li>"
+	yield "</ol>"
+
+def _attach_tables(shell: str, tables: List["TablePtr"]) -> str:
+	# Плейсхолдеры <table data-source-id="..."/> заменяем на таблицы с тем же source_id (в старых деревьях — caption)
+	by_id = {}
+	for t in tables:
+		if getattr(t, "raw_html", ""):
+			by_id.setdefault(getattr(t, "source_id", None) or t.caption, t.raw_html)
+	if not by_id:
+		return shell
+	return PLACEHOLDER_RE.sub(lambda m: by_id.get(m.group(2), m.group(0)), shell)
+
+def _split_shell(section: "Section") -> tuple:
+	"""Делит оболочку раздела на открывающую и закрывающую части, чтобы вложить между ними детей."""
+	shell = _attach_tables(section.xml_shell.strip(), section.tables)
+	if shell.startswith("<section") and shell.endswith("</section>"):
+		return shell[:-len("</section>")], "</section>"
+	return f"<section>{shell}", "</section>"
+
+def iter_section_xml(section: "Section") -> Iterator[str]:
+	head, tail = _split_shell(section)
+	yield head
+	for child in section.children:
+		yield from iter_section_xml(child)
+	yield tail + "\n"
+
+def iter_article_open(header: "Header") -> Iterator[str]:
+	yield XML_PROLOGUE
+	yield CONTAINER_OPEN
+	yield f"<article lang={quoteattr(header.language)}>\n"
+	yield f"<h1>{escape(header.title)}</h1>\n"
+	if header.authors:
+		yield f"<author>{escape(', '.join(header.authors))}</author>\n"
+	if header.date:
+		yield f"<date>{header.date.isoformat()}</date>\n"
+
+def iter_nav(sections: List["Section"]) -> Iterator[str]:
+	yield "<nav>" + "".join(_nav_items(sections)) + "</nav>\n"
+
+def iter_toc(headings: List[str]) -> Iterator[str]:
+	"""<nav> из одних заголовков верхнего уровня — для потокового вывода, когда дерева ещё нет."""
+	items = "".join(f"<li>{escape(h)}</li>" for h in headings)
+	yield f"<nav><ol>{items}</ol></nav>\n" if items else "<nav></nav>\n"
+
+def iter_article_close() -> Iterator[str]:
+	yield "</article>\n"
+	yield CONTAINER_CLOSE
+
+def iter_document_xml(header: "Header", section: "Section") -> Iterator[str]:
+	yield from iter_article_open(header)
+	yield from iter_nav(section.children)
+	yield from iter_section_xml(section)
+	yield from iter_article_close()
+
+def stream_document_xml(events: Iterable) -> Iterator[str]:
+	"""
+	XML по событиям parser.iter_document: DocumentStart, затем готовые разделы верхнего уровня.
+	Каждый раздел сериализуется и отпускается сразу, поэтому память не зависит от длины документа.
+	<nav> по схеме идёт до разделов, поэтому в нём только заголовки из DocumentStart.toc —
+	найденные в первом чанке с разделами; полное оглавление даёт render_document по готовому дереву.
+	"""
+	events = iter(events)
+	start = next(events)
+	yield from iter_article_open(start.header)
+	yield from iter_toc(start.toc)
+	head, tail = _split_shell(start.root)
+	yield head
+	for section in events:
+		yield from iter_section_xml(section)
+	yield tail + "\n"
+	yield from iter_article_close()
+
+def render_document(header: "Header", section: "Section") -> str:
+	return "".join(iter_document_xml(header, section))